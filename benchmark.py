@@ -32,7 +32,9 @@
 
 from __future__ import print_function
 import random
+import sys
 import time
+from friendlydb.backends import MemoryBackend
 from friendlydb.db import FriendlyDB
 
 
@@ -44,12 +46,28 @@ db = 15
 user_count = 10000
 relation_count = 1000000
 followers_check = 1000
+bulk_chunk_size = 10000
+bulk_workers = 4
+routing_checks = 100000
+
+# Pass ``--bulk`` to build the relations with ``FriendlyDB.bulk_load``.
+use_bulk = '--bulk' in sys.argv
+# Pass ``--memory`` to use the in-process backend instead of Redis.
+use_memory = '--memory' in sys.argv
+# Pass ``--interned`` to store usernames as integer ids.
+use_interned = '--interned' in sys.argv
+# Pass ``--routing`` to only time the HTTP server's request routing.
+use_routing = '--routing' in sys.argv
 
 
 # Go go go!
 chars = [char for char in all_chars]
 users = []
-fdb = FriendlyDB(host=host, port=port, db=db)
+
+if use_memory:
+    fdb = FriendlyDB(backend=MemoryBackend(), intern_ids=use_interned)
+else:
+    fdb = FriendlyDB(host=host, port=port, db=db, intern_ids=use_interned)
 
 
 def time_taken(func):
@@ -76,6 +94,29 @@ def build_relations():
             user.unfollow(username_2)
 
 
+def build_relations_bulk():
+    def random_edges():
+        for i in range(0, relation_count):
+            yield (random.choice(users), random.choice(users))
+
+    def progress(stats):
+        print("  {0} edges ({1:.0f}/sec)".format(stats['edges'], stats['rate']))
+
+    fdb.bulk_load(random_edges(), chunk_size=bulk_chunk_size, workers=bulk_workers, callback=progress)
+
+
+def used_memory():
+    # Only Redis can tell us this.
+    if fdb.conn is None:
+        return None
+
+    return fdb.conn.info()['used_memory']
+
+
+def count_edges():
+    return sum([counts['following'] for counts in fdb.counts_many(users).values()])
+
+
 def check_followers():
     times = []
     results = {}
@@ -100,6 +141,33 @@ def check_followers():
     return results
 
 
+def check_routing():
+    # Importing the server greens the world (via gevent), so only do it here.
+    from friendlydb.server import router
+
+    paths = [
+        '/',
+        '/daniel/',
+        '/daniel/following/',
+        '/daniel/followers/',
+        '/daniel/follow/alice/',
+        '/daniel/is_following/alice/',
+        '/daniel/is_followed_by/',
+        '/nope/nope/nope/',
+    ]
+    start = time.time()
+
+    for i in range(0, routing_checks):
+        router.match(paths[i % len(paths)])
+
+    return (time.time() - start) / routing_checks
+
+
+if __name__ == '__main__' and use_routing:
+    print('Routing %s requests...' % routing_checks)
+    print("  per-request: %.2f usec" % (check_routing() * 1000000))
+    sys.exit(0)
+
 if __name__ == '__main__':
     fdb.clear()
 
@@ -107,6 +175,9 @@ if __name__ == '__main__':
     print('  User Count: %s' % user_count)
     print('  Relation Count: %s' % relation_count)
     print('  Followers Check Count: %s' % followers_check)
+    print('  Bulk Load: %s' % use_bulk)
+    print('  Backend: %s' % fdb.backend.__class__.__name__)
+    print('  Interned IDs: %s' % use_interned)
 
     print('')
     print('')
@@ -115,7 +186,18 @@ if __name__ == '__main__':
     print("Generating %s took %s" % (user_count, time_taken(generate_users)))
     print('')
     print('Building relations...')
-    print("Building %s relations took %s" % (relation_count, time_taken(build_relations)))
+    memory_before = used_memory()
+
+    if use_bulk:
+        print("Building %s relations took %s" % (relation_count, time_taken(build_relations_bulk)))
+    else:
+        print("Building %s relations took %s" % (relation_count, time_taken(build_relations)))
+
+    if memory_before is not None:
+        edge_count = count_edges()
+        memory_used = used_memory() - memory_before
+        print("  %s edges used %s bytes (%.1f bytes/edge)" % (edge_count, memory_used, float(memory_used) / max(edge_count, 1)))
+
     print('')
 
     print('Checking followers...')
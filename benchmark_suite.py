@@ -0,0 +1,431 @@
+# Scenario benchmarks for friendlydb.
+#
+# Builds a power-law (Zipf) graph, where a few celebrity accounts have most
+# of the followers, then runs a set of workloads against it with concurrent
+# clients, either through the library or over HTTP against ``server.py``.
+# Reports p50/p95/p99 latency & throughput per scenario (& per operation),
+# optionally as JSON & compared against a saved baseline.
+#
+# Against the in-process backend:
+#
+#     python benchmark_suite.py --memory
+#
+# Against a local Redis (db 15 gets wiped):
+#
+#     python benchmark_suite.py --json=results.json
+#     # ...change things...
+#     python benchmark_suite.py --baseline=results.json
+#
+# Over HTTP (the graph is loaded straight into the server's Redis db):
+#
+#     python friendlydb/server.py --redis_db=15
+#     python benchmark_suite.py --http=http://127.0.0.1:8008
+#
+# Exits with a status of 1 if any scenario regressed against the baseline.
+
+from __future__ import print_function
+import bisect
+import json
+import platform
+import random
+import sys
+import threading
+import time
+from optparse import OptionParser
+from friendlydb import get_version
+from friendlydb.backends import MemoryBackend
+from friendlydb.db import FriendlyDB
+try:
+    from httplib import HTTPConnection
+    from urllib import quote
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import quote, urlparse
+
+
+# The workloads, as ``operation => weight``.
+scenarios = [
+    ('write_heavy', {'follow': 70, 'unfollow': 20, 'is_following': 10}),
+    ('read_heavy', {'followers_page': 40, 'following': 20, 'is_following': 25, 'counts': 15}),
+    ('mixed', {'follow': 20, 'unfollow': 5, 'followers_page': 25, 'is_following': 20, 'friends': 15, 'counts': 15}),
+    ('is_following', {'is_following': 100}),
+    ('friends', {'friends': 100}),
+    ('pagination', {'paginate': 100}),
+    # Destructive, so it goes last.
+    ('delete_user', {'delete_user': 100}),
+]
+page_size = 50
+
+
+class ZipfSampler(object):
+    # Picks ``0..count-1``, with ``k`` weighted by ``1 / (k + 1) ** exponent``.
+    def __init__(self, count, exponent):
+        self.cumulative = []
+        total = 0
+
+        for k in range(count):
+            total += 1.0 / (k + 1) ** exponent
+            self.cumulative.append(total)
+
+        self.total = total
+
+    def sample(self, rand):
+        return bisect.bisect_left(self.cumulative, rand.random() * self.total)
+
+
+class LibraryClient(object):
+    def __init__(self, fdb):
+        self.fdb = fdb
+
+    def follow(self, username, other_username):
+        self.fdb[username].follow(other_username)
+
+    def unfollow(self, username, other_username):
+        self.fdb[username].unfollow(other_username)
+
+    def is_following(self, username, other_username):
+        self.fdb[username].is_following(other_username)
+
+    def following(self, username):
+        self.fdb[username].following(limit=page_size)
+
+    def followers_page(self, username, cursor=None):
+        return self.fdb[username].followers_page(limit=page_size, cursor=cursor)[1]
+
+    def friends(self, username):
+        self.fdb[username].friends(limit=page_size)
+
+    def counts(self, username):
+        self.fdb[username].counts()
+
+    def delete_user(self, username):
+        self.fdb.delete_user(username)
+
+
+class HttpClient(object):
+    # One keep-alive connection per client.
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.conn = HTTPConnection(parsed.hostname, parsed.port or 80)
+
+    def request(self, method, path):
+        self.conn.request(method, path)
+        response = self.conn.getresponse()
+        body = response.read()
+
+        if response.status >= 400:
+            raise RuntimeError('{0} {1} failed with {2}: {3}'.format(method, path, response.status, body))
+
+        return json.loads(body.decode('utf-8'))
+
+    def follow(self, username, other_username):
+        self.request('POST', '/{0}/follow/{1}/'.format(quote(username), quote(other_username)))
+
+    def unfollow(self, username, other_username):
+        self.request('POST', '/{0}/unfollow/{1}/'.format(quote(username), quote(other_username)))
+
+    def is_following(self, username, other_username):
+        self.request('GET', '/{0}/is_following/{1}/'.format(quote(username), quote(other_username)))
+
+    def following(self, username):
+        self.request('GET', '/{0}/following/?limit={1}'.format(quote(username), page_size))
+
+    def followers_page(self, username, cursor=None):
+        path = '/{0}/followers/?limit={1}'.format(quote(username), page_size)
+
+        if cursor is not None:
+            path += '&cursor=' + quote(cursor)
+
+        return self.request('GET', path)['cursor']
+
+    def friends(self, username):
+        self.request('GET', '/{0}/friends/?limit={1}'.format(quote(username), page_size))
+
+    def counts(self, username):
+        self.request('GET', '/{0}/counts/'.format(quote(username)))
+
+
+class Worker(object):
+    # Runs ``ops`` operations picked from ``weights`` on one client, timing
+    # each one.
+    def __init__(self, client, weights, ops, users, sampler, seed, deletable):
+        self.client = client
+        self.ops = ops
+        self.users = users
+        self.sampler = sampler
+        self.rand = random.Random(seed)
+        self.deletable = deletable
+        self.choices = []
+        self.cursor = None
+        self.paging = None
+        self.timings = {}
+        self.errors = 0
+        self.first_error = None
+
+        for name, weight in sorted(weights.items()):
+            self.choices.extend([name] * weight)
+
+    def popular_user(self):
+        return self.users[self.sampler.sample(self.rand)]
+
+    def any_user(self):
+        return self.rand.choice(self.users)
+
+    def run_one(self, name):
+        client = self.client
+
+        if name in ('follow', 'unfollow', 'is_following'):
+            getattr(client, name)(self.any_user(), self.popular_user())
+        elif name == 'followers_page':
+            client.followers_page(self.popular_user())
+        elif name == 'paginate':
+            # Walk a popular user's followers, a page at a time.
+            if self.paging is None:
+                self.paging = self.popular_user()
+
+            self.cursor = client.followers_page(self.paging, self.cursor)
+
+            if self.cursor is None:
+                self.paging = None
+        elif name == 'delete_user':
+            client.delete_user(self.deletable.pop())
+        else:
+            getattr(client, name)(self.popular_user())
+
+    def run(self):
+        for i in range(self.ops):
+            name = self.rand.choice(self.choices)
+            start = time.time()
+
+            try:
+                self.run_one(name)
+            except Exception as e:
+                self.errors += 1
+
+                if self.first_error is None:
+                    self.first_error = '{0} failed: {1}'.format(name, e)
+
+                continue
+
+            self.timings.setdefault(name, []).append(time.time() - start)
+
+
+def percentile(ordered, fraction):
+    # Nearest-rank.
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(timings, seconds):
+    ordered = sorted(timings)
+    ms = lambda value: None if value is None else round(value * 1000, 4)
+    return {
+        'ops': len(ordered),
+        'throughput': round(len(ordered) / seconds, 1) if seconds else None,
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, 0.5)),
+        'p95_ms': ms(percentile(ordered, 0.95)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1]) if ordered else None,
+    }
+
+
+def build_graph(fdb, users, sampler, avg_following, rand):
+    def edges():
+        for username in users:
+            for i in range(rand.randint(1, avg_following * 2 - 1)):
+                other = users[sampler.sample(rand)]
+
+                if other != username:
+                    yield (username, other)
+
+    return fdb.bulk_load(edges(), chunk_size=10000)
+
+
+def run_scenario(name, weights, options, make_client, users, sampler, deletable):
+    per_client = options.ops // options.clients
+    workers = []
+
+    for i in range(options.clients):
+        # Each client deletes its own users.
+        mine = deletable[i::options.clients]
+        workers.append(Worker(make_client(), weights, per_client, users, sampler, options.seed + i, mine))
+
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    start = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    seconds = time.time() - start
+    timings = {}
+
+    for worker in workers:
+        for op, values in worker.timings.items():
+            timings.setdefault(op, []).extend(values)
+
+    result = summarize([value for values in timings.values() for value in values], seconds)
+    result['errors'] = sum(worker.errors for worker in workers)
+    result['first_error'] = ([worker.first_error for worker in workers if worker.first_error] or [None])[0]
+    result['operations'] = dict((op, summarize(values, seconds)) for op, values in timings.items())
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions, printing a comparison as it goes.
+    regressions = []
+    print('')
+    print('Compared to the baseline (tolerance {0:.0%}):'.format(tolerance))
+
+    for key in ('backend', 'via', 'users', 'zipf', 'clients', 'ops'):
+        if baseline.get('meta', {}).get(key) != results['meta'][key]:
+            print('  Warning: the baseline used a different {0} ({1} vs. {2}).'.format(key, baseline.get('meta', {}).get(key), results['meta'][key]))
+
+    for name, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+
+        if base is None:
+            print('  {0}: no baseline'.format(name))
+            continue
+
+        changes = []
+
+        for key, higher_is_better in (('throughput', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)):
+            old, new = base.get(key), result.get(key)
+
+            if not old or new is None:
+                continue
+
+            change = (new - old) / float(old)
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            changes.append('{0} {1} -> {2} ({3:+.1%}){4}'.format(key, old, new, change, ' REGRESSED' if worse else ''))
+
+            if worse and key != 'p99_ms':
+                # p99 is too noisy to fail on.
+                regressions.append((name, key, old, new))
+
+        print('  {0}: {1}'.format(name, ', '.join(changes)))
+
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--memory", dest="memory", action="store_true", default=False, help="Use the in-process backend instead of Redis.")
+    parser.add_option("--redis_host", dest="redis_host", default='localhost', help="The hostname Redis is running on.")
+    parser.add_option("--redis_port", dest="redis_port", type="int", default=6379, help="The port Redis is running on.")
+    parser.add_option("--redis_db", dest="redis_db", type="int", default=15, help="The db within Redis to use (it gets wiped). Default: 15")
+    parser.add_option("--http", dest="http", default=None, help="Run the workloads over HTTP against a running server.py at this URL (which must use the same Redis db).")
+    parser.add_option("--users", dest="users", type="int", default=10000, help="How many users to create. Default: 10000")
+    parser.add_option("--avg_following", dest="avg_following", type="int", default=20, help="How many users each user follows, on average. Default: 20")
+    parser.add_option("--zipf", dest="zipf", type="float", default=1.1, help="The Zipf exponent for who gets followed (& read). Higher is more skewed. Default: 1.1")
+    parser.add_option("--ops", dest="ops", type="int", default=5000, help="Operations per scenario. Default: 5000")
+    parser.add_option("--clients", dest="clients", type="int", default=4, help="Concurrent clients (threads). Default: 4")
+    parser.add_option("--scenarios", dest="scenarios", default=None, help="A comma-separated subset of: {0}.".format(', '.join(name for name, weights in scenarios)))
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="The random seed. Default: 1")
+    parser.add_option("--json", dest="json", default=None, help="Write the results to this file (usable as a --baseline).")
+    parser.add_option("--baseline", dest="baseline", default=None, help="Compare against results saved with --json.")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2, help="How much worse than the baseline counts as a regression. Default: 0.2")
+    (options, args) = parser.parse_args()
+
+    if options.http and options.memory:
+        parser.error("--http needs Redis (the server can't see an in-process backend).")
+
+    selected = scenarios
+
+    if options.scenarios:
+        names = options.scenarios.split(',')
+        selected = [(name, weights) for name, weights in scenarios if name in names]
+
+    if options.http:
+        # There's no HTTP endpoint for deleting users.
+        selected = [(name, weights) for name, weights in selected if 'delete_user' not in weights]
+
+    if options.memory:
+        fdb = FriendlyDB(backend=MemoryBackend())
+    else:
+        fdb = FriendlyDB(host=options.redis_host, port=options.redis_port, db=options.redis_db)
+
+    if options.http:
+        make_client = lambda: HttpClient(options.http)
+    else:
+        make_client = lambda: LibraryClient(fdb)
+
+    rand = random.Random(options.seed)
+    users = ['user{0}'.format(i) for i in range(options.users)]
+    sampler = ZipfSampler(len(users), options.zipf)
+    # The least popular users, for ``delete_user``.
+    deletable = users[-options.ops:]
+
+    print('Running benchmark suite...')
+    print('  Backend: {0}'.format(fdb.backend.__class__.__name__))
+    print('  Via: {0}'.format(options.http or 'library'))
+    print('  Users: {0} (Zipf {1}, ~{2} following each)'.format(options.users, options.zipf, options.avg_following))
+    print('  Clients: {0}, operations per scenario: {1}'.format(options.clients, options.ops))
+    print('')
+
+    fdb.clear()
+    stats = build_graph(fdb, users, sampler, options.avg_following, rand)
+    top = fdb.counts_many(users[:3])
+    print('Built {0} edges in {1:.2f}s (top followers: {2})'.format(
+        stats['edges'], stats['seconds'], ', '.join(str(top[username]['followers']) for username in users[:3])
+    ))
+
+    results = {
+        'meta': {
+            'version': get_version(),
+            'python': platform.python_version(),
+            'backend': fdb.backend.__class__.__name__,
+            'via': 'http' if options.http else 'library',
+            'users': options.users,
+            'edges': stats['edges'],
+            'zipf': options.zipf,
+            'clients': options.clients,
+            'ops': options.ops,
+            'seed': options.seed,
+            'timestamp': time.time(),
+        },
+        'scenarios': {},
+    }
+
+    for name, weights in selected:
+        result = run_scenario(name, weights, options, make_client, users, sampler, deletable)
+        results['scenarios'][name] = result
+        print('{0:>14}: {1:>9} ops/s  p50 {2}ms  p95 {3}ms  p99 {4}ms  ({5} errors)'.format(
+            name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']
+        ))
+
+        if result['first_error']:
+            print('{0:>18}  {1}'.format('', result['first_error']))
+
+        for op, op_result in sorted(result['operations'].items()):
+            if len(result['operations']) > 1:
+                print('{0:>18}: p50 {1}ms  p95 {2}ms  p99 {3}ms'.format(op, op_result['p50_ms'], op_result['p95_ms'], op_result['p99_ms']))
+
+    fdb.clear()
+
+    if options.json:
+        with open(options.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+
+        print('')
+        print('Wrote {0}'.format(options.json))
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if compare(results, baseline, options.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
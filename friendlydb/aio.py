@@ -0,0 +1,815 @@
+"""
+asyncio versions of ``FriendlyDB`` & ``FriendlyUser`` (Python 3.6+ only).
+
+They talk to Redis through a small asyncio Redis client (also here), so
+they don't need threads or ``gevent``. The data is stored exactly like the
+regular ``FriendlyDB`` stores it, so the two can be used side by side.
+"""
+import asyncio
+import time
+import weakref
+from friendlydb.backends import (intersect_arguments, score_pairs, stream_add_arguments, stream_entries, stream_read_arguments,
+                                 tally_arguments)
+from friendlydb.db import format_changes, plan_counts_many, plan_get_many
+from friendlydb.user import FriendlyUser, planned
+
+
+# (``asyncio.current_task`` is new in Python 3.7.)
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class ResponseError(Exception):
+    # An error reply from Redis.
+    pass
+
+
+# The Redis client.
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+
+    return str(value).encode('utf-8')
+
+
+def pack_command(args):
+    args = [_encode(arg) for arg in args]
+    packed = [b'*' + str(len(args)).encode('utf-8') + b'\r\n']
+
+    for arg in args:
+        packed.append(b'$' + str(len(arg)).encode('utf-8') + b'\r\n' + arg + b'\r\n')
+
+    return b''.join(packed)
+
+
+class AsyncRedisConnection(object):
+    """
+    A single connection to Redis, speaking RESP over asyncio streams.
+
+    Replies are decoded as UTF-8. Error replies are returned (not raised) as
+    ``ResponseError``s, so a pipeline can report each one where it happened.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Whether it's been used successfully before.
+        self.used = False
+
+    @classmethod
+    async def connect(cls, host='localhost', port=6379, db=0, unix_socket_path=None):
+        if unix_socket_path:
+            reader, writer = await asyncio.open_unix_connection(unix_socket_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        connection = cls(reader, writer)
+
+        if db:
+            reply = (await connection.execute_many([('SELECT', db)]))[0]
+
+            if isinstance(reply, ResponseError):
+                connection.close()
+                raise reply
+
+        return connection
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by Redis.')
+
+        kind, rest = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return rest.decode('utf-8')
+
+        if kind == b'-':
+            return ResponseError(rest.decode('utf-8'))
+
+        if kind == b':':
+            return int(rest)
+
+        if kind == b'$':
+            length = int(rest)
+
+            if length == -1:
+                return None
+
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2].decode('utf-8')
+
+        if kind == b'*':
+            length = int(rest)
+
+            if length == -1:
+                return None
+
+            return [await self.read_reply() for i in range(length)]
+
+        raise ConnectionError('Unexpected reply from Redis: {0!r}'.format(line))
+
+    async def execute_many(self, commands):
+        # Sends all the commands in one go, then reads all the replies.
+        self.writer.write(b''.join([pack_command(command) for command in commands]))
+        await self.writer.drain()
+        replies = [await self.read_reply() for command in commands]
+        self.used = True
+        return replies
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of ``AsyncRedisConnection``s.
+
+    With ``max_connections``, callers wait (up to ``timeout`` seconds, if
+    given) for a free connection rather than opening more.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, unix_socket_path=None, max_connections=None,
+                 timeout=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.unix_socket_path = unix_socket_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = []
+        self.created = 0
+        self.in_use = 0
+        self.slots = None
+
+    async def acquire(self, fresh=False):
+        if self.max_connections:
+            # Made here, so it belongs to the running loop.
+            if self.slots is None:
+                self.slots = asyncio.Semaphore(self.max_connections)
+
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+
+        try:
+            if self.idle and not fresh:
+                connection = self.idle.pop()
+            else:
+                connection = await AsyncRedisConnection.connect(self.host, self.port, self.db, self.unix_socket_path)
+                self.created += 1
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+
+            raise
+
+        self.in_use += 1
+        return connection
+
+    def release(self, connection, broken=False):
+        self.in_use -= 1
+
+        if broken:
+            connection.close()
+            self.created -= 1
+        else:
+            self.idle.append(connection)
+
+        if self.slots is not None:
+            self.slots.release()
+
+    async def execute_many(self, commands):
+        connection = await self.acquire()
+
+        try:
+            replies = await connection.execute_many(commands)
+        except (OSError, EOFError):
+            self.release(connection, broken=True)
+
+            if not connection.used:
+                raise
+
+            # Idle connections can go stale (say, Redis restarted), so retry
+            # once on a new one, like redis-py does.
+            connection = await self.acquire(fresh=True)
+
+            try:
+                replies = await connection.execute_many(commands)
+            except BaseException:
+                self.release(connection, broken=True)
+                raise
+        except BaseException:
+            # Who knows what state it's in.
+            self.release(connection, broken=True)
+            raise
+
+        self.release(connection)
+        return replies
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+
+        self.created -= len(self.idle)
+        self.idle = []
+
+    def stats(self):
+        return {
+            'address': self.unix_socket_path or '{0}:{1}'.format(self.host, self.port),
+            'db': self.db,
+            'max_connections': self.max_connections,
+            'created': self.created,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+        }
+
+
+# The backends.
+
+def _float_or_none(reply):
+    if reply is None:
+        return None
+
+    return float(reply)
+
+
+class RedisCommandBuilder(object):
+    # The backend operations, as ``(Redis command, reply parser)``.
+    def add(self, key, member, score):
+        return ('ZADD', key, score, member), None
+
+    def remove(self, key, member):
+        return ('ZREM', key, member), None
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        if min_score is None and max_score is None:
+            end = -1
+
+            if limit is not None:
+                end = offset + limit - 1
+
+            if limit == 0:
+                # ``end`` could be -1 here, which Redis reads as "to the end".
+                offset, end = 1, 0
+
+            return ('ZREVRANGE', key, offset, end, 'WITHSCORES'), score_pairs
+
+        if min_score is None:
+            min_score = '-inf'
+
+        if max_score is None:
+            max_score = '+inf'
+
+        if limit is None:
+            limit = -1
+
+        return ('ZREVRANGEBYSCORE', key, max_score, min_score, 'WITHSCORES', 'LIMIT', offset, limit), score_pairs
+
+    def score(self, key, member):
+        return ('ZSCORE', key, member), _float_or_none
+
+    def card(self, key):
+        return ('ZCARD', key), None
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return ('ZINTERSTORE', dest, len(keys)) + tuple(keys) + ('AGGREGATE', aggregate.upper()), None
+
+    def union(self, dest, keys, aggregate='sum'):
+        return ('ZUNIONSTORE', dest, len(keys)) + tuple(keys) + ('AGGREGATE', aggregate.upper()), None
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return ('EVAL',) + tuple(intersect_arguments(keys, offset=offset, limit=limit, aggregate=aggregate)), score_pairs
+
+    def intersect_card(self, keys):
+        return ('EVAL',) + tuple(intersect_arguments(keys, count_only=True)), None
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        return ('EVAL',) + tuple(tally_arguments(dest, keys, limit=limit, exclude=exclude)), None
+
+    def exists(self, key):
+        return ('EXISTS', key), bool
+
+    def expire(self, key, seconds):
+        return ('EXPIRE', key, seconds), bool
+
+    def delete(self, key):
+        return ('DEL', key), None
+
+    def set_add(self, key, member):
+        return ('SADD', key, member), None
+
+    def set_remove(self, key, member):
+        return ('SREM', key, member), None
+
+    def set_members(self, key):
+        return ('SMEMBERS', key), set
+
+    def increment(self, key, amount=1):
+        return ('INCRBY', key, amount), None
+
+    def hash_get(self, key, fields):
+        return ('HMGET', key) + tuple(fields), None
+
+    def hash_set(self, key, field, value):
+        return ('HSET', key, field, value), None
+
+    def hash_set_if_missing(self, key, field, value):
+        return ('HSETNX', key, field, value), None
+
+    def stream_add(self, key, fields, max_length=None):
+        return tuple(stream_add_arguments(key, fields, max_length=max_length)), None
+
+    def stream_read(self, key, after=None, count=None):
+        return tuple(stream_read_arguments(key, after=after, count=count)), stream_entries
+
+    def publish(self, channel, message):
+        return ('PUBLISH', channel, message), None
+
+
+def _parse(reply, parser):
+    if isinstance(reply, ResponseError):
+        raise reply
+
+    if parser is None:
+        return reply
+
+    return parser(reply)
+
+
+class AsyncRedisPipeline(object):
+    def __init__(self, backend, transaction=True):
+        self.backend = backend
+        self.transaction = transaction
+        self.commands = []
+        # ``(operation, args)`` for the observer.
+        self.operations = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        builder = getattr(self.backend.commands, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append(builder(*args, **kwargs))
+            self.operations.append((name, args))
+            return self
+
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        operations, self.operations = self.operations, []
+
+        if not commands:
+            return []
+
+        if self.backend.observer is None:
+            return await self._execute(commands)
+
+        start = time.time()
+        results = None
+
+        try:
+            results = await self._execute(commands)
+            return results
+        finally:
+            self.backend.observer(operations, time.time() - start, results)
+
+    async def _execute(self, commands):
+        if not self.transaction:
+            replies = await self.backend.pool.execute_many([command for command, parser in commands])
+        else:
+            replies = await self.backend.pool.execute_many([('MULTI',)] + [command for command, parser in commands] + [('EXEC',)])
+            # The last reply is the ``EXEC``, holding all of the others (or an
+            # error, if the transaction was aborted).
+            for reply in replies[:-1]:
+                if isinstance(reply, ResponseError):
+                    raise reply
+
+            replies = replies[-1]
+
+            if isinstance(replies, ResponseError):
+                raise replies
+
+        return [_parse(reply, parser) for reply, (command, parser) in zip(replies, commands)]
+
+
+class AsyncRedisBackend(object):
+    """
+    The asyncio counterpart of ``RedisBackend``. Every operation is a
+    coroutine, as is a pipeline's ``execute``.
+
+    If given, ``observer`` is called like ``ObservedBackend``'s after each
+    round-trip.
+    """
+    commands = RedisCommandBuilder()
+
+    def __init__(self, pool=None, observer=None):
+        self.pool = pool
+        self.observer = observer
+
+        if self.pool is None:
+            self.pool = AsyncConnectionPool()
+
+    def pipeline(self, transaction=True):
+        return AsyncRedisPipeline(self, transaction=transaction)
+
+    def __getattr__(self, name):
+        builder = getattr(self.commands, name)
+
+        async def run(*args, **kwargs):
+            command, parser = builder(*args, **kwargs)
+
+            if self.observer is None:
+                return _parse((await self.pool.execute_many([command]))[0], parser)
+
+            start = time.time()
+            results = None
+
+            try:
+                results = [_parse((await self.pool.execute_many([command]))[0], parser)]
+                return results[0]
+            finally:
+                self.observer([(name, args)], time.time() - start, results)
+
+        return run
+
+    async def flush(self):
+        return _parse((await self.pool.execute_many([('FLUSHDB',)]))[0], None)
+
+    def pool_stats(self):
+        return [self.pool.stats()]
+
+    def close(self):
+        self.pool.close()
+
+
+class AsyncPipeline(object):
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __getattr__(self, name):
+        queue = getattr(self.pipe, name)
+
+        def wrapped(*args, **kwargs):
+            queue(*args, **kwargs)
+            return self
+
+        return wrapped
+
+    async def execute(self):
+        return self.pipe.execute()
+
+
+class AsyncBackend(object):
+    """
+    Makes a regular backend that never blocks (like ``MemoryBackend``)
+    usable from ``AsyncFriendlyDB``.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def pipeline(self, transaction=True):
+        return AsyncPipeline(self.backend.pipeline(transaction=transaction))
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        async def run(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return run
+
+    def pool_stats(self):
+        return self.backend.pool_stats()
+
+    def close(self):
+        pass
+
+
+class TaskLocal(object):
+    """
+    Like ``threading.local``, but per asyncio task (say, for a
+    ``friendlydb.metrics.Metrics`` in an asyncio server).
+    """
+    def __init__(self):
+        object.__setattr__(self, 'tasks', weakref.WeakKeyDictionary())
+
+    def __getattr__(self, name):
+        try:
+            return self.tasks[current_task()][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.tasks.setdefault(current_task(), {})[name] = value
+
+
+# The API.
+
+class AsyncFriendlyUser(FriendlyUser):
+    """
+    A ``FriendlyUser`` whose methods are all coroutines (& whose ``iter_*``
+    methods are async iterators).
+    """
+    def __init__(self, username, backend, separator=None, change_feed_length=None):
+        super(AsyncFriendlyUser, self).__init__(username, separator=separator, backend=backend, change_feed_length=change_feed_length)
+        self.is_setup = True
+
+    def setup(self):
+        self.is_setup = True
+
+    async def _fetch(self, key_type, offset=0, limit=None, since=None, until=None):
+        key = self.generate_key(self.username, key_type)
+        return await self.backend.range(key, offset=offset, limit=limit, min_score=since, max_score=until)
+
+    async def _execute(self, pipe, touched_keys):
+        return await pipe.execute()
+
+    async def _page(self, key_type, limit=50, cursor=None, since=None, until=None):
+        offset, until = self._page_start(cursor, until)
+        follow_infos = await self._fetch(key_type, offset=offset, limit=limit, since=since, until=until)
+        return follow_infos, self._next_cursor(follow_infos, limit, offset, until)
+
+    async def following(self, with_dates=False, offset=0, limit=None, since=None, until=None):
+        follow_infos = await self._fetch('following', offset=offset, limit=limit, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates)
+
+    async def followers(self, with_dates=False, offset=0, limit=None, since=None, until=None):
+        follow_infos = await self._fetch('followers', offset=offset, limit=limit, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates)
+
+    async def following_page(self, limit=50, cursor=None, with_dates=False, since=None, until=None):
+        follow_infos, next_cursor = await self._page('following', limit=limit, cursor=cursor, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates), next_cursor
+
+    async def followers_page(self, limit=50, cursor=None, with_dates=False, since=None, until=None):
+        follow_infos, next_cursor = await self._page('followers', limit=limit, cursor=cursor, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates), next_cursor
+
+    async def _iter_batches(self, key_type, batch_size=1000, with_dates=False, since=None, until=None):
+        cursor = None
+
+        while True:
+            follow_infos, cursor = await self._page(key_type, limit=batch_size, cursor=cursor, since=since, until=until)
+
+            if follow_infos:
+                yield self._format(follow_infos, with_dates=with_dates)
+
+            if cursor is None:
+                return
+
+    async def iter_following(self, batch_size=1000, with_dates=False, since=None, until=None):
+        async for batch in self.iter_following_batches(batch_size=batch_size, with_dates=with_dates, since=since, until=until):
+            for following in batch:
+                yield following
+
+    async def iter_followers(self, batch_size=1000, with_dates=False, since=None, until=None):
+        async for batch in self.iter_follower_batches(batch_size=batch_size, with_dates=with_dates, since=since, until=until):
+            for follower in batch:
+                yield follower
+
+    async def following_count(self):
+        return await self.backend.card(self.generate_key(self.username, 'following'))
+
+    async def follower_count(self):
+        return await self.backend.card(self.generate_key(self.username, 'followers'))
+
+    async def friend_count(self):
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._friend_count)
+        return finish(await pipe.execute())
+
+    async def counts(self):
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._counts)
+        return finish(await pipe.execute())
+
+    async def follow(self, username):
+        if self.username == username:
+            return False
+
+        pipe = self.backend.pipeline()
+        touched_keys = self._follow(pipe, username, self.current_time_score())
+        await self._execute(pipe, touched_keys)
+        return True
+
+    async def unfollow(self, username):
+        if self.username == username:
+            return False
+
+        pipe = self.backend.pipeline()
+        touched_keys = self._unfollow(pipe, username)
+        await self._execute(pipe, touched_keys)
+        return True
+
+    async def follow_many(self, usernames):
+        time_score = self.current_time_score()
+        pipe = self.backend.pipeline()
+        results, touched_keys = self._many(pipe, usernames, lambda pipe, username: self._follow(pipe, username, time_score))
+        await self._execute(pipe, touched_keys)
+        return results
+
+    async def unfollow_many(self, usernames):
+        pipe = self.backend.pipeline()
+        results, touched_keys = self._many(pipe, usernames, self._unfollow)
+        await self._execute(pipe, touched_keys)
+        return results
+
+    async def is_following(self, username):
+        key = self.generate_key(self.username, 'following')
+        return (await self.backend.score(key, username)) is not None
+
+    async def is_followed_by(self, username):
+        key = self.generate_key(self.username, 'followers')
+        return (await self.backend.score(key, username)) is not None
+
+    async def is_following_many(self, usernames):
+        pipe = self.backend.pipeline(transaction=False)
+        finish = planned(pipe, self._has_members, 'following', usernames)
+        return finish(await pipe.execute())
+
+    async def is_followed_by_many(self, usernames):
+        pipe = self.backend.pipeline(transaction=False)
+        finish = planned(pipe, self._has_members, 'followers', usernames)
+        return finish(await pipe.execute())
+
+    async def friends(self, limit=None, offset=0, cache_ttl=None):
+        if cache_ttl:
+            pipe = self.backend.pipeline()
+            finish = planned(pipe, self._cached_friends, limit=limit, offset=offset)
+            friends = finish(await pipe.execute())
+
+            if friends is not None:
+                return friends
+
+            pipe = self.backend.pipeline()
+            finish = planned(pipe, self._cache_friends, limit=limit, offset=offset, cache_ttl=cache_ttl)
+            return finish(await pipe.execute())
+
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._friends, limit=limit, offset=offset)
+        return finish(await pipe.execute())
+
+    async def suggestions(self, limit=10, max_following=200, max_fanout=200):
+        following = await self._fetch('following', limit=max_following)
+
+        if not following:
+            return []
+
+        pipe = self.backend.pipeline()
+        self._suggestions(pipe, following, limit, max_fanout)
+        return self._format_suggestions(await pipe.execute())
+
+    async def mutual_followers(self, username, limit=None, offset=0):
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._mutual_followers, username, limit=limit, offset=offset)
+        return finish(await pipe.execute())
+
+    async def tombstone(self):
+        pipe = self.backend.pipeline()
+        await self._execute(pipe, self._tombstone(pipe))
+        return True
+
+    async def reap(self, batch_size=1000, callback=None):
+        stats = {
+            'following': 0,
+            'followers': 0,
+        }
+
+        for key_type, other_key_type in (('following', 'followers'), ('followers', 'following')):
+            async for batch in self._iter_batches('deleted_' + key_type, batch_size=batch_size):
+                pipe = self.backend.pipeline(transaction=False)
+                finish = planned(pipe, self._has_members, key_type, batch)
+                recreated = finish(await pipe.execute())
+                pipe = self.backend.pipeline()
+                await self._execute(pipe, self._reap(pipe, other_key_type, batch, recreated))
+                stats[key_type] += len(batch)
+
+                if callback is not None:
+                    callback(dict(stats))
+
+        pipe = self.backend.pipeline()
+        self._finish_reap(pipe)
+        await pipe.execute()
+        return stats
+
+    async def delete(self, batch_size=1000, callback=None):
+        await self.tombstone()
+        await self.reap(batch_size=batch_size, callback=callback)
+        return True
+
+
+class AsyncFriendlyDB(object):
+    """
+    The asyncio counterpart of ``FriendlyDB``, for use from asyncio code
+    (without any thread offloading).
+
+    Everything is stored in a single Redis server (``host``/``port``/``db``
+    or ``unix_socket_path``), through a pool of up to ``max_connections``
+    connections. Alternatively, pass a ``backend`` (say,
+    ``AsyncBackend(MemoryBackend())``).
+
+    Bulk loading & the in-process cache are only available on the regular
+    ``FriendlyDB``. The change feed (``change_feed_length``) & ``observer``
+    (for the Redis connections made here) work the same.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, user_klass=None, separator=None, backend=None,
+                 max_connections=None, pool_timeout=None, unix_socket_path=None, change_feed_length=None,
+                 observer=None):
+        self.user_klass = user_klass
+        self.separator = separator
+        self.backend = backend
+        self.change_feed_length = change_feed_length
+
+        if self.user_klass is None:
+            self.user_klass = AsyncFriendlyUser
+
+        if self.backend is None:
+            pool = AsyncConnectionPool(
+                host=host,
+                port=port,
+                db=db,
+                unix_socket_path=unix_socket_path,
+                max_connections=max_connections,
+                timeout=pool_timeout
+            )
+            self.backend = AsyncRedisBackend(pool, observer=observer)
+
+    def __getitem__(self, username):
+        return self.user_klass(username, backend=self.backend, separator=self.separator,
+                               change_feed_length=self.change_feed_length)
+
+    def generate_key(self, username, key_type):
+        return self[username].generate_key(username, key_type)
+
+    async def clear(self):
+        await self.backend.flush()
+        return True
+
+    def close(self):
+        self.backend.close()
+
+    def pool_stats(self):
+        return self.backend.pool_stats()
+
+    async def delete_user(self, username, batch_size=1000, callback=None):
+        return await self[username].delete(batch_size=batch_size, callback=callback)
+
+    async def tombstones(self):
+        return await self.backend.set_members(self.generate_key('', 'tombstones'))
+
+    async def reap_tombstones(self, batch_size=1000):
+        reaped = 0
+
+        for username in await self.tombstones():
+            await self[username].reap(batch_size=batch_size)
+            reaped += 1
+
+        return reaped
+
+    async def read_changes(self, checkpoint=None, count=1000):
+        entries = await self.backend.stream_read(self.generate_key('', 'changes'), after=checkpoint, count=count)
+        return format_changes(entries, checkpoint)
+
+    async def iter_change_batches(self, checkpoint=None, batch_size=1000):
+        while True:
+            events, checkpoint = await self.read_changes(checkpoint, count=batch_size)
+
+            if events:
+                yield events, checkpoint
+
+            if len(events) < batch_size:
+                return
+
+    async def change_checkpoint(self, consumer):
+        return (await self.backend.hash_get(self.generate_key('', 'change_checkpoints'), [consumer]))[0]
+
+    async def save_change_checkpoint(self, consumer, checkpoint):
+        await self.backend.hash_set(self.generate_key('', 'change_checkpoints'), consumer, checkpoint)
+        return True
+
+    async def consume_changes(self, consumer, callback, batch_size=1000):
+        handled = 0
+
+        async for events, checkpoint in self.iter_change_batches(await self.change_checkpoint(consumer), batch_size=batch_size):
+            callback(events)
+            await self.save_change_checkpoint(consumer, checkpoint)
+            handled += len(events)
+
+        return handled
+
+    async def counts_many(self, usernames):
+        pipe = self.backend.pipeline()
+        finish = plan_counts_many(self, pipe, usernames)
+        return finish(await pipe.execute())
+
+    async def get_many(self, usernames, fields=('following', 'followers', 'counts'), limit=50, with_dates=False):
+        pipe = self.backend.pipeline()
+        finish = plan_get_many(self, pipe, usernames, fields, limit, with_dates)
+        return finish(await pipe.execute())
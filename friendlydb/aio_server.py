@@ -0,0 +1,512 @@
+"""
+An asyncio HTTP server for FriendlyDB, serving the same API as ``server.py``
+(but without ``gevent`` or monkey-patching). Python 3.6+ only.
+
+Run it with ``python -m friendlydb.aio_server``.
+"""
+from __future__ import print_function
+import asyncio
+import time
+import traceback
+from urllib.parse import parse_qs, unquote
+from friendlydb import get_version
+from friendlydb.aio import AsyncFriendlyDB, TaskLocal
+from friendlydb.metrics import Metrics
+from friendlydb.web import (BadRequest, StreamedList, build_router, dump_batch, dump_json, finish_batch, get_int,
+                            get_list, is_streamed, json_parts, parse_batch, plan_batch)
+
+
+fdb = None
+friends_cache_ttl = None
+# Request metrics, served at ``/_stats/``.
+metrics = Metrics(local=TaskLocal())
+# How many users to read (& send) at a time when streaming a big list.
+stream_batch_size = 1000
+# The most operations a single ``/_batch/`` request can run.
+batch_max_operations = 1000
+# The largest request line, header line & body (in bytes) & the most headers
+# a request can have.
+max_request_line = 8190
+max_header_size = 8190
+max_header_fields = 100
+max_body_size = 1024 * 1024
+
+OK = '200 OK'
+CREATED = '201 CREATED'
+BAD_REQUEST = '400 BAD REQUEST'
+NOT_FOUND = '404 NOT FOUND'
+NOT_ALLOWED = '405 METHOD NOT ALLOWED'
+TOO_LARGE = '413 REQUEST ENTITY TOO LARGE'
+URI_TOO_LONG = '414 REQUEST-URI TOO LONG'
+HEADERS_TOO_LARGE = '431 REQUEST HEADER FIELDS TOO LARGE'
+SERVER_ERROR = '500 INTERNAL SERVER ERROR'
+
+
+def setup(options):
+    global fdb
+    global friends_cache_ttl
+    fdb = AsyncFriendlyDB(
+        host=options.redis_host,
+        port=options.redis_port,
+        db=options.redis_db,
+        max_connections=options.max_connections,
+        pool_timeout=options.pool_timeout,
+        unix_socket_path=options.redis_socket,
+        change_feed_length=options.change_feed_length,
+        observer=metrics.observe_redis
+    )
+    friends_cache_ttl = options.friends_cache_ttl
+
+
+async def _next(batches, default):
+    try:
+        return await batches.__anext__()
+    except StopAsyncIteration:
+        return default
+
+async def _chain(first_batches, batches):
+    for batch in first_batches:
+        yield batch
+
+    async for batch in batches:
+        yield batch
+
+async def _list_or_stream(batches):
+    # Lists that fit in a single batch are sent as-is. Anything bigger gets
+    # streamed.
+    first = await _next(batches, [])
+    second = await _next(batches, None)
+
+    if second is None:
+        return first
+
+    return StreamedList(_chain([first, second], batches))
+
+
+# The application itself. Each handler returns ``(status, body)``, the body
+# being a dict (sent as JSON) or text.
+async def index(request_method, query):
+    return OK, {'version': get_version()}
+
+async def user_detail(request_method, query, username):
+    user = fdb[username]
+    return OK, {
+        'username': username,
+        'following': await _list_or_stream(user.iter_following_batches(batch_size=stream_batch_size)),
+        'followers': await _list_or_stream(user.iter_follower_batches(batch_size=stream_batch_size)),
+    }
+
+batch_methods = {
+    'following': 'iter_following_batches',
+    'followers': 'iter_follower_batches',
+}
+
+async def _list_relations(user, key_type, query):
+    limit = get_int(query, 'limit', minimum=1)
+    offset = get_int(query, 'offset', 0)
+    since = get_int(query, 'since')
+    until = get_int(query, 'until')
+    cursor = query.get('cursor', [None])[0]
+    body = {'username': user.username}
+
+    if cursor is not None and offset:
+        raise BadRequest("The 'cursor' & 'offset' parameters can't be combined.")
+
+    if cursor is not None or (limit is not None and not offset):
+        if limit is None:
+            limit = 50
+
+        try:
+            body[key_type], body['cursor'] = await getattr(user, key_type + '_page')(limit=limit, cursor=cursor, since=since, until=until)
+        except ValueError as e:
+            raise BadRequest(str(e))
+    elif limit is None and not offset:
+        # The whole list, which could be huge.
+        batches = getattr(user, batch_methods[key_type])(batch_size=stream_batch_size, since=since, until=until)
+        body[key_type] = await _list_or_stream(batches)
+    else:
+        body[key_type] = await getattr(user, key_type)(offset=offset, limit=limit, since=since, until=until)
+
+    return body
+
+async def user_following(request_method, query, username):
+    return OK, await _list_relations(fdb[username], 'following', query)
+
+async def user_followers(request_method, query, username):
+    return OK, await _list_relations(fdb[username], 'followers', query)
+
+async def user_counts(request_method, query, username):
+    return OK, {
+        'username': username,
+        'counts': await fdb[username].counts(),
+    }
+
+async def counts_many(request_method, query):
+    return OK, {
+        'counts': await fdb.counts_many(get_list(query, 'usernames')),
+    }
+
+async def get_many(request_method, query):
+    fields = ('following', 'followers', 'counts')
+
+    if query.get('fields'):
+        fields = get_list(query, 'fields')
+
+    try:
+        users = await fdb.get_many(get_list(query, 'usernames'), fields=fields, limit=get_int(query, 'limit', 50, minimum=1))
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+    return OK, {
+        'users': users,
+    }
+
+async def user_friends(request_method, query, username):
+    return OK, {
+        'username': username,
+        'friends': await fdb[username].friends(
+            limit=get_int(query, 'limit', minimum=1),
+            offset=get_int(query, 'offset', 0),
+            cache_ttl=friends_cache_ttl
+        ),
+    }
+
+async def user_suggestions(request_method, query, username):
+    return OK, {
+        'username': username,
+        'suggestions': await fdb[username].suggestions(limit=get_int(query, 'limit', 10, minimum=1)),
+    }
+
+async def mutual_followers(request_method, query, username, other_username):
+    return OK, {
+        'username': username,
+        'other_username': other_username,
+        'mutual_followers': await fdb[username].mutual_followers(
+            other_username,
+            limit=get_int(query, 'limit', minimum=1),
+            offset=get_int(query, 'offset', 0)
+        ),
+    }
+
+async def follow(request_method, query, username, other_username):
+    return CREATED, {
+        'username': username,
+        'other_username': other_username,
+        'followed': await fdb[username].follow(other_username),
+    }
+
+async def unfollow(request_method, query, username, other_username):
+    return CREATED, {
+        'username': username,
+        'other_username': other_username,
+        'unfollowed': await fdb[username].unfollow(other_username),
+    }
+
+async def is_following(request_method, query, username, other_username):
+    return CREATED, {
+        'username': username,
+        'other_username': other_username,
+        'is_following': await fdb[username].is_following(other_username),
+    }
+
+async def is_followed_by(request_method, query, username, other_username):
+    return CREATED, {
+        'username': username,
+        'other_username': other_username,
+        'is_followed_by': await fdb[username].is_followed_by(other_username),
+    }
+
+async def is_following_many(request_method, query, username):
+    return OK, {
+        'username': username,
+        'is_following': await fdb[username].is_following_many(get_list(query, 'usernames')),
+    }
+
+async def is_followed_by_many(request_method, query, username):
+    return OK, {
+        'username': username,
+        'is_followed_by': await fdb[username].is_followed_by_many(get_list(query, 'usernames')),
+    }
+
+async def batch(request_method, query, body=None):
+    # Everything goes out in a single pipeline (see ``friendlydb.web``).
+    ops = parse_batch(body, batch_max_operations)
+    pipe = fdb.backend.pipeline()
+    touched_keys, pending = plan_batch(fdb, pipe, ops)
+    results = []
+
+    if len(pipe):
+        results = await pipe.execute()
+
+    return OK, {
+        'results': finish_batch(pending, results),
+    }
+
+# Read the request body for ``batch``.
+batch.reads_body = True
+
+async def stats(request_method, query):
+    pool_stats = None
+
+    if fdb is not None:
+        pool_stats = fdb.pool_stats()
+
+    if query.get('format', [''])[0] == 'json':
+        return OK, metrics.as_dict(pool_stats)
+
+    return OK, metrics.render_prometheus(pool_stats)
+
+router = build_router(globals())
+
+
+async def dispatch(request_method, path, query_string, body, request):
+    # ``request['route']`` gets filled in, for the metrics.
+    handlers, url_params = router.match(path)
+
+    if handlers is None:
+        request['route'] = 'not_found'
+        return NOT_FOUND, {'error': 'Not found.'}
+
+    handler = handlers.get(request_method)
+
+    if handler is None:
+        request['route'] = 'not_allowed'
+        return NOT_ALLOWED, {'error': 'That HTTP method is not allowed at this endpoint.'}
+
+    request['route'] = handler.__name__
+    query = parse_qs(query_string)
+
+    if getattr(handler, 'reads_body', False):
+        url_params['body'] = body
+
+    try:
+        return await handler(request_method, query, **url_params)
+    except BadRequest as e:
+        return BAD_REQUEST, {'error': str(e)}
+
+
+# The HTTPs.
+class HttpError(Exception):
+    # A request that can't be served, & the status to refuse it with.
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+async def _read_line(reader, max_size, status):
+    # A line of the request head, refused with ``status`` if it's longer
+    # than ``max_size`` bytes.
+    try:
+        line = await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        # The client went away.
+        return e.partial
+    except asyncio.LimitOverrunError:
+        line = None
+
+    if line is None or len(line) > max_size:
+        raise HttpError(status, 'The request is too large.')
+
+    return line
+
+async def read_request(reader):
+    # Reads a request off the connection, as ``(method, target, version,
+    # headers, body)``. ``None`` if the client is done.
+    request_line = await _read_line(reader, max_request_line, URI_TOO_LONG)
+
+    if not request_line:
+        return None
+
+    try:
+        request_method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(BAD_REQUEST, 'Malformed request.')
+
+    headers = {}
+
+    for count in range(max_header_fields + 1):
+        line = await _read_line(reader, max_header_size, HEADERS_TOO_LARGE)
+
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+        if count == max_header_fields:
+            raise HttpError(HEADERS_TOO_LARGE, 'Too many headers.')
+
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'transfer-encoding' in headers:
+        raise HttpError(BAD_REQUEST, 'Request bodies need a Content-Length.')
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        length = -1
+
+    if length < 0:
+        raise HttpError(BAD_REQUEST, 'Malformed Content-Length.')
+
+    if length > max_body_size:
+        raise HttpError(TOO_LARGE, 'The request body is too large.')
+
+    body = ''
+
+    if length > 0:
+        try:
+            body = (await reader.readexactly(length)).decode('utf-8')
+        except UnicodeDecodeError:
+            raise HttpError(BAD_REQUEST, 'The request body should be UTF-8.')
+
+    return request_method, target, version, headers, body
+
+async def stream_json(body):
+    # ``friendlydb.web.stream_json``, reading the batches asynchronously.
+    for part in json_parts(body):
+        if not isinstance(part, StreamedList):
+            yield part
+            continue
+
+        started = False
+
+        async for batch in part.batches:
+            if batch:
+                yield dump_batch(batch, started)
+                started = True
+
+async def write_response(writer, status, body, keep_alive, chunked):
+    # Returns how many bytes of body were sent.
+    headers = ['HTTP/1.1 ' + status, 'Content-Type: text/plain']
+
+    if keep_alive:
+        headers.append('Connection: keep-alive')
+    else:
+        headers.append('Connection: close')
+
+    if isinstance(body, str) or not is_streamed(body):
+        if isinstance(body, str):
+            data = body.encode('utf-8')
+        else:
+            data = dump_json(body)
+
+        headers.append('Content-Length: {0}'.format(len(data)))
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + data)
+        await writer.drain()
+        return len(data)
+
+    if chunked:
+        headers.append('Transfer-Encoding: chunked')
+
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+    response_bytes = 0
+
+    async for data in stream_json(body):
+        response_bytes += len(data)
+
+        if chunked:
+            data = '{0:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n'
+
+        writer.write(data)
+        await writer.drain()
+
+    if chunked:
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    return response_bytes
+
+async def respond(writer, request_method, target, version, headers, body):
+    # Handles a request, keeping the metrics. Returns whether the connection
+    # can be kept alive.
+    request = {
+        'started': time.time(),
+        # Filled in by ``dispatch``.
+        'route': None,
+    }
+    connection = headers.get('connection', '').lower()
+    http_11 = version.upper() == 'HTTP/1.1'
+    keep_alive = connection == 'keep-alive' or (http_11 and connection != 'close')
+    path, _, query_string = target.partition('?')
+    status = SERVER_ERROR
+    response_bytes = 0
+    metrics.start_request()
+
+    try:
+        try:
+            status, response_body = await dispatch(request_method.upper(), unquote(path), query_string, body, request)
+        except Exception:
+            traceback.print_exc()
+            status, response_body = SERVER_ERROR, {'error': 'Something went wrong.'}
+
+        # Without chunking, the end of a streamed body is the end of the
+        # connection.
+        if not isinstance(response_body, str) and is_streamed(response_body) and not http_11:
+            keep_alive = False
+
+        response_bytes = await write_response(writer, status, response_body, keep_alive, http_11)
+        return keep_alive
+    finally:
+        metrics.finish_request(request['route'], int(status.split(' ', 1)[0]), time.time() - request['started'], response_bytes)
+
+async def handle_connection(reader, writer):
+    # Serves HTTP/1.x requests off the connection until the client is done.
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except HttpError as e:
+                await write_response(writer, e.status, {'error': str(e)}, False, False)
+                break
+
+            if request is None:
+                break
+
+            if not await respond(writer, *request):
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve(host='127.0.0.1', port=8008):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_server(handle_connection, host, port))
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        fdb.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--redis_host", dest="redis_host", default='localhost', help="The hostname Redis is running on.")
+    parser.add_option("--redis_port", dest="redis_port", type="int", default=6379, help="The port Redis is running on.")
+    parser.add_option("--redis_db", dest="redis_db", type="int", default=0, help="The db within Redis to use.")
+    parser.add_option("--redis_socket", dest="redis_socket", default=None, help="Connect to Redis over this unix socket, rather than TCP.")
+    parser.add_option("--max_connections", dest="max_connections", type="int", default=None, help="The most connections to open to Redis. Default: unlimited")
+    parser.add_option("--pool_timeout", dest="pool_timeout", type="float", default=None, help="Seconds a request waits for a free Redis connection before erroring. Default: forever")
+    parser.add_option("--friends_cache_ttl", dest="friends_cache_ttl", type="int", default=None, help="Seconds to cache each user's friends for. Default: no caching")
+    parser.add_option("--change_feed_length", dest="change_feed_length", type="int", default=None, help="Record follows/unfollows/deletes in a change feed (a Redis stream) of about this many events. Default: off")
+    parser.add_option("-H", "--host", dest="host", default='127.0.0.1', help="Choose the host IP/domain name to run the service on. Default: '127.0.0.1'")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8008, help="Choose the port to run the service on. Default: 8008")
+    (options, args) = parser.parse_args()
+
+    # Set up the DB.
+    setup(options)
+
+    # Start handling requests.
+    print("Welcome to FriendlyDB (v{0})!".format(get_version()))
+    print("Serving on http://{0}:{1} (asyncio)...".format(options.host, options.port))
+
+    try:
+        serve(options.host, options.port)
+    except KeyboardInterrupt:
+        print("Shutting down. Have a nice day!")
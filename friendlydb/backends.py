@@ -0,0 +1,1883 @@
+import bisect
+import hashlib
+import itertools
+import redis
+import threading
+import time
+from collections import OrderedDict
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+
+def key_username(key, separator):
+    # The username a per-user key belongs to (``None`` for other keys).
+    if separator not in key:
+        return None
+
+    return key.rsplit(separator, 1)[0]
+
+
+class BaseBackend(object):
+    """
+    The storage operations FriendlyDB is built on.
+
+    Relationships live in sorted sets of ``member => score`` (the score being
+    when the follow happened). A handful of plain sets & pub/sub round it
+    out.
+
+    Every operation is also available on the batch returned by ``pipeline``,
+    where it's queued up until ``execute`` is called. ``execute`` returns the
+    results of each operation in order.
+    """
+    def pipeline(self, transaction=True):
+        raise NotImplementedError()
+
+    def add(self, key, member, score):
+        raise NotImplementedError()
+
+    def remove(self, key, member):
+        raise NotImplementedError()
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        """
+        Returns ``(member, score)`` pairs, highest score first.
+
+        ``min_score``/``max_score`` are inclusive.
+        """
+        raise NotImplementedError()
+
+    def score(self, key, member):
+        raise NotImplementedError()
+
+    def card(self, key):
+        raise NotImplementedError()
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        """
+        Stores the intersection of the ``keys`` in ``dest``, returning how
+        many members it has.
+        """
+        raise NotImplementedError()
+
+    def union(self, dest, keys, aggregate='sum'):
+        """
+        Stores the union of the ``keys`` in ``dest``, returning how many
+        members it has.
+        """
+        raise NotImplementedError()
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        """
+        Returns ``(member, score)`` pairs of the intersection of the ``keys``,
+        highest score first (like ``range``).
+
+        Unlike ``intersect``, nothing is stored, so it's a read (& can be
+        answered by a replica).
+        """
+        raise NotImplementedError()
+
+    def intersect_card(self, keys):
+        """
+        Returns how many members the intersection of the ``keys`` has,
+        without storing it.
+        """
+        raise NotImplementedError()
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        """
+        Stores how many of the ``keys`` each member is in (as its score) in
+        ``dest``, returning how many members it has.
+
+        Only the ``limit`` highest-scored members of each key are counted &
+        members of the ``exclude`` key are skipped.
+        """
+        raise NotImplementedError()
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def expire(self, key, seconds):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def set_add(self, key, member):
+        raise NotImplementedError()
+
+    def set_remove(self, key, member):
+        raise NotImplementedError()
+
+    def set_members(self, key):
+        raise NotImplementedError()
+
+    def increment(self, key, amount=1):
+        raise NotImplementedError()
+
+    def hash_get(self, key, fields):
+        """
+        Returns the values of the ``fields`` in order, ``None`` for missing
+        ones.
+        """
+        raise NotImplementedError()
+
+    def hash_set(self, key, field, value):
+        raise NotImplementedError()
+
+    def hash_set_if_missing(self, key, field, value):
+        raise NotImplementedError()
+
+    def stream_add(self, key, fields, max_length=None):
+        """
+        Appends an entry (a dict of ``fields``) to the stream at ``key``,
+        returning its id. The oldest entries are trimmed once there are more
+        than about ``max_length``.
+        """
+        raise NotImplementedError()
+
+    def stream_read(self, key, after=None, count=None):
+        """
+        Returns up to ``count`` ``(id, fields)`` entries from the stream at
+        ``key``, oldest first, starting after the ``after`` id (or at the
+        start).
+        """
+        raise NotImplementedError()
+
+    def publish(self, channel, message):
+        raise NotImplementedError()
+
+    def listen(self, channel, callback):
+        """
+        Calls ``callback`` with every message published to ``channel`` (in
+        the background).
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        raise NotImplementedError()
+
+    # The exceptions that mean the backend couldn't be reached.
+    connection_errors = ()
+
+    def pool_stats(self):
+        """
+        Returns a list of stats for each connection pool in use.
+        """
+        return []
+
+
+# ``tally`` for Redis. ``KEYS`` are ``dest``, the keys to count & (if
+# ``ARGV[2]`` is '1') the key to exclude. ``ARGV[1]`` is the last rank to
+# count in each key.
+TALLY_SCRIPT = """
+local last = #KEYS
+local exclude = nil
+
+if ARGV[2] == '1' then
+    exclude = KEYS[last]
+    last = last - 1
+end
+
+redis.call('DEL', KEYS[1])
+
+for i = 2, last do
+    for _, member in ipairs(redis.call('ZREVRANGE', KEYS[i], 0, ARGV[1])) do
+        if not exclude or not redis.call('ZSCORE', exclude, member) then
+            redis.call('ZINCRBY', KEYS[1], 1, member)
+        end
+    end
+end
+
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+def tally_arguments(dest, keys, limit=None, exclude=None):
+    # The arguments to ``EVAL`` ``TALLY_SCRIPT`` with.
+    script_keys = [dest] + list(keys)
+
+    if exclude is not None:
+        script_keys.append(exclude)
+
+    stop = -1
+
+    if limit is not None:
+        stop = limit - 1
+
+    return [TALLY_SCRIPT, len(script_keys)] + script_keys + [stop, int(exclude is not None)]
+
+
+# ``intersect_range``/``intersect_card`` for Redis. It only reads, so (unlike
+# ``ZINTERSTORE``) it runs on read-only replicas. ``KEYS`` are the sorted sets
+# to intersect. ``ARGV`` is the aggregate, the offset, the limit (-1 for
+# everything) & '1' to just count the members.
+INTERSECT_SCRIPT = """
+local smallest = 1
+local smallest_size = redis.call('ZCARD', KEYS[1])
+
+for i = 2, #KEYS do
+    local size = redis.call('ZCARD', KEYS[i])
+
+    if size < smallest_size then
+        smallest, smallest_size = i, size
+    end
+end
+
+local found = {}
+local count = 0
+local members = redis.call('ZRANGE', KEYS[smallest], 0, -1, 'WITHSCORES')
+
+for m = 1, #members, 2 do
+    local member = members[m]
+    local score = tonumber(members[m + 1])
+    local missing = false
+
+    for i = 1, #KEYS do
+        if i ~= smallest then
+            local other = redis.call('ZSCORE', KEYS[i], member)
+
+            if not other then
+                missing = true
+                break
+            end
+
+            other = tonumber(other)
+
+            if ARGV[1] == 'max' then
+                score = math.max(score, other)
+            elseif ARGV[1] == 'min' then
+                score = math.min(score, other)
+            else
+                score = score + other
+            end
+        end
+    end
+
+    if not missing then
+        count = count + 1
+
+        if ARGV[4] ~= '1' then
+            found[count] = {member, score}
+        end
+    end
+end
+
+if ARGV[4] == '1' then
+    return count
+end
+
+-- The same order as ZREVRANGE.
+table.sort(found, function(a, b)
+    if a[2] ~= b[2] then
+        return a[2] > b[2]
+    end
+
+    return a[1] > b[1]
+end)
+
+local offset = tonumber(ARGV[2])
+local last = #found
+
+if tonumber(ARGV[3]) >= 0 then
+    last = math.min(last, offset + tonumber(ARGV[3]))
+end
+
+local reply = {}
+
+for i = offset + 1, last do
+    table.insert(reply, found[i][1])
+    table.insert(reply, string.format('%.17g', found[i][2]))
+end
+
+return reply
+"""
+
+
+def intersect_arguments(keys, offset=0, limit=None, aggregate='sum', count_only=False):
+    # The arguments to ``EVAL`` ``INTERSECT_SCRIPT`` with.
+    keys = list(keys)
+
+    if limit is None:
+        limit = -1
+
+    return [INTERSECT_SCRIPT, len(keys)] + keys + [aggregate.lower(), offset, limit, int(count_only)]
+
+
+def score_pairs(reply):
+    # ``[member, score, member, score, ...]`` => ``[(member, score), ...]``.
+    return [(reply[offset], float(reply[offset + 1])) for offset in range(0, len(reply), 2)]
+
+
+def stream_id(entry_id):
+    # ``'<milliseconds>-<sequence>'`` => a sortable tuple.
+    milliseconds, _, sequence = entry_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+def stream_add_arguments(key, fields, max_length=None):
+    # The arguments to ``XADD``.
+    arguments = ['XADD', key]
+
+    if max_length is not None:
+        # Trimming whole nodes of the stream at a time is much cheaper.
+        arguments.extend(['MAXLEN', '~', max_length])
+
+    arguments.append('*')
+
+    for field, value in sorted(fields.items()):
+        arguments.extend([field, value])
+
+    return arguments
+
+
+def stream_read_arguments(key, after=None, count=None):
+    # The arguments to ``XREAD`` (which starts after the given id).
+    arguments = ['XREAD']
+
+    if count is not None:
+        arguments.extend(['COUNT', count])
+
+    return arguments + ['STREAMS', key, after or '0-0']
+
+
+def stream_entries(reply):
+    # An ``XREAD`` reply for a single stream => ``[(id, fields), ...]``.
+    if not reply:
+        return []
+
+    return [(entry_id, dict(zip(values[::2], values[1::2]))) for entry_id, values in reply[0][1]]
+
+
+class RedisCommands(object):
+    # The operations, in terms of a ``redis.StrictRedis`` client or one of its
+    # pipelines (both of which take the same commands).
+    def _parsed(self, parser, *args):
+        # For commands redis-py has no method (or reply parsing) for.
+        return parser(self.client.execute_command(*args))
+
+    def add(self, key, member, score):
+        return self.client.zadd(key, score, member)
+
+    def remove(self, key, member):
+        return self.client.zrem(key, member)
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        if min_score is None and max_score is None:
+            end = -1
+
+            if limit is not None:
+                end = offset + limit - 1
+
+            if limit == 0:
+                # ``end`` could be -1 here, which Redis reads as "to the end".
+                offset, end = 1, 0
+
+            return self.client.zrevrange(key, offset, end, withscores=True)
+
+        if min_score is None:
+            min_score = '-inf'
+
+        if max_score is None:
+            max_score = '+inf'
+
+        if limit is None:
+            limit = -1
+
+        return self.client.zrevrangebyscore(key, max_score, min_score, start=offset, num=limit, withscores=True)
+
+    def score(self, key, member):
+        return self.client.zscore(key, member)
+
+    def card(self, key):
+        return self.client.zcard(key)
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return self.client.zinterstore(dest, keys, aggregate=aggregate.upper())
+
+    def union(self, dest, keys, aggregate='sum'):
+        return self.client.zunionstore(dest, keys, aggregate=aggregate.upper())
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return self._parsed(score_pairs, 'EVAL', *intersect_arguments(keys, offset=offset, limit=limit, aggregate=aggregate))
+
+    def intersect_card(self, keys):
+        return self.client.eval(*intersect_arguments(keys, count_only=True))
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        # Server-side, so none of the members have to come back over the wire.
+        return self.client.eval(*tally_arguments(dest, keys, limit=limit, exclude=exclude))
+
+    def exists(self, key):
+        return self.client.exists(key)
+
+    def expire(self, key, seconds):
+        return self.client.expire(key, seconds)
+
+    def delete(self, key):
+        return self.client.delete(key)
+
+    def set_add(self, key, member):
+        return self.client.sadd(key, member)
+
+    def set_remove(self, key, member):
+        return self.client.srem(key, member)
+
+    def set_members(self, key):
+        return self.client.smembers(key)
+
+    def increment(self, key, amount=1):
+        return self.client.incr(key, amount)
+
+    def hash_get(self, key, fields):
+        return self.client.hmget(key, fields)
+
+    def hash_set(self, key, field, value):
+        return self.client.hset(key, field, value)
+
+    def hash_set_if_missing(self, key, field, value):
+        return self.client.hsetnx(key, field, value)
+
+    def stream_add(self, key, fields, max_length=None):
+        return self.client.execute_command(*stream_add_arguments(key, fields, max_length=max_length))
+
+    def stream_read(self, key, after=None, count=None):
+        return self._parsed(stream_entries, *stream_read_arguments(key, after=after, count=count))
+
+    def publish(self, channel, message):
+        return self.client.publish(channel, message)
+
+
+class RedisPipeline(RedisCommands):
+    def __init__(self, client):
+        self.client = client
+        # ``position => parser`` for the replies that need parsing.
+        self.parsers = {}
+
+    def __len__(self):
+        return len(self.client)
+
+    def _parsed(self, parser, *args):
+        self.parsers[len(self.client)] = parser
+        return self.client.execute_command(*args)
+
+    def execute(self):
+        parsers, self.parsers = self.parsers, {}
+        results = self.client.execute()
+
+        for position, parser in parsers.items():
+            results[position] = parser(results[position])
+
+        return results
+
+
+class RedisBackend(RedisCommands, BaseBackend):
+    """
+    Stores everything in Redis, via a ``redis.StrictRedis`` connection.
+    """
+    # (``TimeoutError`` is redis-py 2.10+.)
+    connection_errors = (redis.ConnectionError, getattr(redis, 'TimeoutError', redis.ConnectionError))
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.client = conn
+
+    def pipeline(self, transaction=True):
+        return RedisPipeline(self.client.pipeline(transaction=transaction))
+
+    def _listen(self, pubsub, callback):
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                callback(message['data'])
+
+    def listen(self, channel, callback):
+        pubsub = self.conn.pubsub()
+        pubsub.subscribe(channel)
+        listener = threading.Thread(target=self._listen, args=(pubsub, callback))
+        listener.daemon = True
+        listener.start()
+        return listener
+
+    def flush(self):
+        return self.conn.flushdb()
+
+    def pool_stats(self):
+        pool = self.conn.connection_pool
+        kwargs = pool.connection_kwargs
+        stats = {
+            'address': kwargs.get('path') or '{0}:{1}'.format(kwargs.get('host'), kwargs.get('port')),
+            'db': kwargs.get('db'),
+            # (Unbounded pools use ``2 ** 31``.)
+            'max_connections': pool.max_connections if pool.max_connections < 2 ** 31 else None,
+        }
+
+        if isinstance(pool, redis.BlockingConnectionPool):
+            idle = len([connection for connection in list(pool.pool.queue) if connection is not None])
+            stats['created'] = len(pool._connections)
+        else:
+            idle = len(pool._available_connections)
+            stats['created'] = pool._created_connections
+
+        stats['idle'] = idle
+        stats['in_use'] = stats['created'] - idle
+        return [stats]
+
+
+class Highest(object):
+    # Sorts after any member, for inclusive upper bounds on
+    # ``(score, member)`` pairs.
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+HIGHEST = Highest()
+
+
+class QueuedPipeline(object):
+    """
+    A pipeline that queues ``(operation, args, kwargs)`` up in
+    ``commands``, for ``execute`` to run in one go.
+
+    Only the backend's ``operations`` can be queued.
+    """
+    def __init__(self, backend, transaction=True):
+        self.backend = backend
+        self.transaction = transaction
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        if name not in self.backend.operations:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.queue(name, args, kwargs)
+            return self
+
+        return queue
+
+    def queue(self, name, args, kwargs):
+        self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        raise NotImplementedError()
+
+
+class MemoryPipeline(QueuedPipeline):
+    def execute(self):
+        # Everything runs under the backend's lock, so a pipeline is atomic
+        # (like a MULTI/EXEC) whether or not ``transaction`` was requested.
+        with self.backend.lock:
+            results = [getattr(self.backend, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+        self.commands = []
+        return results
+
+
+class MemoryBackend(BaseBackend):
+    """
+    Stores everything in-process, in dicts of ``sortedcontainers`` lists.
+
+    There's no network involved, which makes it handy for embedding, tests &
+    single-node services. Nothing is persisted & pub/sub only reaches
+    listeners within the same process.
+
+    Requires the ``sortedcontainers`` package.
+    """
+    operations = (
+        'add', 'remove', 'range', 'score', 'card', 'intersect', 'union',
+        'intersect_range', 'intersect_card', 'tally', 'exists', 'expire', 'delete', 'set_add', 'set_remove', 'set_members',
+        'increment', 'hash_get', 'hash_set', 'hash_set_if_missing', 'stream_add',
+        'stream_read', 'publish',
+    )
+
+    def __init__(self):
+        if SortedList is None:
+            raise ImportError("The memory backend requires the 'sortedcontainers' package.")
+
+        self.lock = threading.RLock()
+        # ``key => {member: score}``, alongside ``key => SortedList`` of
+        # ``(score, member)`` pairs for the ranged reads.
+        self.scores = {}
+        self.ordered = {}
+        self.sets = {}
+        self.hashes = {}
+        self.counters = {}
+        # ``key => [((milliseconds, sequence), id, fields), ...]``, alongside
+        # the last id handed out for each (which outlives trimming).
+        self.streams = {}
+        self.last_stream_ids = {}
+        self.expires = {}
+        self.listeners = {}
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def _check_expiry(self, key):
+        expires = self.expires.get(key)
+
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+
+    def _store(self, key, scores):
+        self.delete(key)
+
+        if scores:
+            self.scores[key] = scores
+            self.ordered[key] = SortedList([(score, member) for member, score in scores.items()])
+
+        return len(scores)
+
+    def add(self, key, member, score):
+        score = float(score)
+
+        with self.lock:
+            self._check_expiry(key)
+            scores = self.scores.setdefault(key, {})
+            ordered = self.ordered.setdefault(key, SortedList())
+            old_score = scores.get(member)
+
+            if old_score is not None:
+                ordered.remove((old_score, member))
+
+            scores[member] = score
+            ordered.add((score, member))
+            return int(old_score is None)
+
+    def remove(self, key, member):
+        with self.lock:
+            self._check_expiry(key)
+            scores = self.scores.get(key, {})
+
+            if member not in scores:
+                return 0
+
+            self.ordered[key].remove((scores.pop(member), member))
+
+            if not scores:
+                self.delete(key)
+
+            return 1
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        with self.lock:
+            self._check_expiry(key)
+            ordered = self.ordered.get(key)
+
+            if ordered is None:
+                return []
+
+            start = 0
+            stop = len(ordered)
+
+            if min_score is not None:
+                start = ordered.bisect_left((float(min_score),))
+
+            if max_score is not None:
+                stop = ordered.bisect_right((float(max_score), HIGHEST))
+
+            # Highest first, so count back from ``stop``.
+            stop = max(stop - offset, start)
+
+            if limit is not None:
+                start = max(stop - limit, start)
+
+            return [(member, score) for score, member in ordered.islice(start, stop, reverse=True)]
+
+    def score(self, key, member):
+        with self.lock:
+            self._check_expiry(key)
+            return self.scores.get(key, {}).get(member)
+
+    def card(self, key):
+        with self.lock:
+            self._check_expiry(key)
+            return len(self.scores.get(key, {}))
+
+    def _aggregate(self, aggregate):
+        return {
+            'sum': lambda a, b: a + b,
+            'min': min,
+            'max': max,
+        }[aggregate.lower()]
+
+    def _intersection(self, keys, aggregate):
+        combine = self._aggregate(aggregate)
+
+        for key in keys:
+            self._check_expiry(key)
+
+        all_scores = sorted([self.scores.get(key, {}) for key in keys], key=len)
+        results = {}
+
+        for member, score in all_scores[0].items():
+            for scores in all_scores[1:]:
+                if member not in scores:
+                    break
+
+                score = combine(score, scores[member])
+            else:
+                results[member] = score
+
+        return results
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        with self.lock:
+            return self._store(dest, self._intersection(keys, aggregate))
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        with self.lock:
+            ordered = sorted([(score, member) for member, score in self._intersection(keys, aggregate).items()], reverse=True)
+            stop = None
+
+            if limit is not None:
+                stop = offset + limit
+
+            return [(member, score) for score, member in ordered[offset:stop]]
+
+    def intersect_card(self, keys):
+        with self.lock:
+            return len(self._intersection(keys, 'sum'))
+
+    def union(self, dest, keys, aggregate='sum'):
+        combine = self._aggregate(aggregate)
+
+        with self.lock:
+            results = {}
+
+            for key in keys:
+                self._check_expiry(key)
+
+                for member, score in self.scores.get(key, {}).items():
+                    if member in results:
+                        score = combine(results[member], score)
+
+                    results[member] = score
+
+            return self._store(dest, results)
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        with self.lock:
+            excluded = {}
+
+            if exclude is not None:
+                self._check_expiry(exclude)
+                excluded = self.scores.get(exclude, {})
+
+            results = {}
+
+            for key in keys:
+                for member, score in self.range(key, limit=limit):
+                    if member not in excluded:
+                        results[member] = results.get(member, 0.0) + 1
+
+            return self._store(dest, results)
+
+    def exists(self, key):
+        with self.lock:
+            self._check_expiry(key)
+            return key in self.scores or key in self.sets or key in self.hashes or key in self.counters or key in self.streams
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if not self.exists(key):
+                return False
+
+            self.expires[key] = time.time() + seconds
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.expires.pop(key, None)
+            self.ordered.pop(key, None)
+            existed = self.scores.pop(key, None) is not None
+            existed = self.sets.pop(key, None) is not None or existed
+            existed = self.hashes.pop(key, None) is not None or existed
+            existed = self.counters.pop(key, None) is not None or existed
+            existed = self.streams.pop(key, None) is not None or existed
+            self.last_stream_ids.pop(key, None)
+            return int(existed)
+
+    def set_add(self, key, member):
+        with self.lock:
+            members = self.sets.setdefault(key, set())
+            added = member not in members
+            members.add(member)
+            return int(added)
+
+    def set_remove(self, key, member):
+        with self.lock:
+            members = self.sets.get(key, set())
+
+            if member not in members:
+                return 0
+
+            members.remove(member)
+
+            if not members:
+                del self.sets[key]
+
+            return 1
+
+    def set_members(self, key):
+        with self.lock:
+            return set(self.sets.get(key, set()))
+
+    def increment(self, key, amount=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            return self.counters[key]
+
+    def hash_get(self, key, fields):
+        with self.lock:
+            values = self.hashes.get(key, {})
+            return [values.get(field) for field in fields]
+
+    def hash_set(self, key, field, value):
+        with self.lock:
+            values = self.hashes.setdefault(key, {})
+            added = field not in values
+            values[field] = value
+            return int(added)
+
+    def hash_set_if_missing(self, key, field, value):
+        with self.lock:
+            values = self.hashes.setdefault(key, {})
+
+            if field in values:
+                return 0
+
+            values[field] = value
+            return 1
+
+    def stream_add(self, key, fields, max_length=None):
+        with self.lock:
+            milliseconds = int(time.time() * 1000)
+            sequence = 0
+            last = self.last_stream_ids.get(key)
+
+            if last is not None and milliseconds <= last[0]:
+                milliseconds, sequence = last[0], last[1] + 1
+
+            entries = self.streams.setdefault(key, [])
+            self.last_stream_ids[key] = (milliseconds, sequence)
+            entry_id = '{0}-{1}'.format(milliseconds, sequence)
+            entries.append(((milliseconds, sequence), entry_id, dict(fields)))
+
+            if max_length is not None and len(entries) > max_length:
+                del entries[:len(entries) - max_length]
+
+            return entry_id
+
+    def stream_read(self, key, after=None, count=None):
+        with self.lock:
+            entries = self.streams.get(key, [])
+            start = bisect.bisect_right(entries, (stream_id(after or '0-0'), HIGHEST))
+            stop = len(entries)
+
+            if count is not None:
+                stop = min(start + count, stop)
+
+            return [(entry_id, dict(fields)) for sort_id, entry_id, fields in entries[start:stop]]
+
+    def publish(self, channel, message):
+        listeners = self.listeners.get(channel, [])
+
+        for callback in listeners:
+            callback(message)
+
+        return len(listeners)
+
+    def listen(self, channel, callback):
+        self.listeners.setdefault(channel, []).append(callback)
+
+    def flush(self):
+        with self.lock:
+            self.scores.clear()
+            self.ordered.clear()
+            self.sets.clear()
+            self.hashes.clear()
+            self.counters.clear()
+            self.streams.clear()
+            self.last_stream_ids.clear()
+            self.expires.clear()
+
+        return True
+
+
+class InternedPipeline(QueuedPipeline):
+    # Queues operations in terms of usernames, then translates the whole batch
+    # to ids (& the results back) around a single pipeline on the wrapped
+    # backend.
+    def execute(self):
+        commands, self.commands = self.commands, []
+        backend = self.backend
+        # Ordered, so new ids get handed out in the order users show up.
+        to_create = OrderedDict()
+        to_lookup = OrderedDict()
+
+        for name, args, kwargs in commands:
+            if name == 'add':
+                to_create[backend.key_username(args[0])] = True
+                to_create[args[1]] = True
+            elif name in ('remove', 'score'):
+                to_lookup[backend.key_username(args[0])] = True
+                to_lookup[args[1]] = True
+            elif name in ('intersect_range', 'intersect_card'):
+                for key in args[0]:
+                    to_lookup[backend.key_username(key)] = True
+            elif name in ('intersect', 'union', 'tally'):
+                to_lookup[backend.key_username(args[0])] = True
+
+                for key in args[1]:
+                    to_lookup[backend.key_username(key)] = True
+
+                if kwargs.get('exclude') is not None:
+                    to_lookup[backend.key_username(kwargs['exclude'])] = True
+            elif name in backend.key_operations:
+                to_lookup[backend.key_username(args[0])] = True
+
+        ids = backend.get_ids(list(to_create), create=True)
+        ids.update(backend.get_ids([username for username in to_lookup if username not in to_create]))
+
+        pipe = backend.backend.pipeline(transaction=self.transaction)
+        pending = []
+
+        for name, args, kwargs in commands:
+            translated = backend.translate(name, args, kwargs, ids)
+
+            if translated is None:
+                # Something involved doesn't have an id yet, so it can't
+                # have any data. Answer without bothering the backend.
+                pending.append((False, backend.defaults[name]))
+                continue
+
+            name, args, kwargs, default = translated
+            getattr(pipe, name)(*args, **kwargs)
+            pending.append((True, default))
+
+        backend_results = iter(pipe.execute())
+        results = []
+        range_ids = set()
+
+        for dispatched, default in pending:
+            if not dispatched:
+                results.append(default)
+                continue
+
+            result = next(backend_results)
+
+            if default is not None:
+                # Rewritten into something else (like a ``delete``), with a
+                # fixed answer.
+                result = default
+
+            results.append(result)
+
+        for (name, args, kwargs), result in zip(commands, results):
+            if name in ('range', 'intersect_range'):
+                range_ids.update([member for member, score in result])
+
+        names = backend.get_names(range_ids)
+
+        for offset, (name, args, kwargs) in enumerate(commands):
+            if name in ('range', 'intersect_range'):
+                results[offset] = [(names.get(backend.normalize_id(member), member), score) for member, score in results[offset]]
+
+        return results
+
+
+class InternedBackend(BaseBackend):
+    """
+    Wraps another backend, storing integer ids in place of usernames.
+
+    Usernames are mapped to ids (& back) through two hashes, ids being handed
+    out as users are first written to. Both the members of each sorted set
+    & the username part of each key are stored as ids, which are shorter
+    than most names (``benchmark.py --interned`` reports the bytes per edge,
+    to see what that's worth on your data). Names are resolved in batches &
+    remembered in-process (up to ``cache_size`` of each), since a username's
+    id never changes.
+
+    Don't point an interned & a non-interned ``FriendlyDB`` at the same data.
+    """
+    operations = MemoryBackend.operations
+    # Operations that only take a key (plus options).
+    key_operations = ('range', 'card', 'exists', 'expire', 'delete')
+    # What each operation answers when it involves a username with no id.
+    defaults = {
+        'remove': 0,
+        'range': [],
+        'score': None,
+        'card': 0,
+        'intersect': 0,
+        'union': 0,
+        'intersect_range': [],
+        'intersect_card': 0,
+        'tally': 0,
+        'exists': False,
+        'expire': False,
+        'delete': 0,
+    }
+
+    def __init__(self, backend, separator, cache_size=100000):
+        self.backend = backend
+        self.separator = separator
+        self.cache_size = cache_size
+        self.ids_key = self.separator.join(['', 'ids'])
+        self.names_key = self.separator.join(['', 'names'])
+        self.next_id_key = self.separator.join(['', 'next_id'])
+        self.id_cache = {}
+        self.name_cache = {}
+
+    def pipeline(self, transaction=True):
+        return InternedPipeline(self, transaction=transaction)
+
+    def _one(self, name, *args, **kwargs):
+        pipe = self.pipeline()
+        getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()[0]
+
+    # Translation.
+
+    def normalize_id(self, user_id):
+        return str(int(user_id))
+
+    def _remember(self, username, user_id):
+        user_id = self.normalize_id(user_id)
+
+        if len(self.id_cache) >= self.cache_size:
+            self.id_cache.clear()
+            self.name_cache.clear()
+
+        self.id_cache[username] = user_id
+        self.name_cache[user_id] = username
+        return user_id
+
+    def get_ids(self, usernames, create=False):
+        """
+        Returns a dictionary of ``username => id``. Usernames without an id
+        are left out, unless ``create=True``, in which case they get one.
+        """
+        ids = {}
+        missing = []
+
+        for username in usernames:
+            if not username:
+                continue
+
+            if username in self.id_cache:
+                ids[username] = self.id_cache[username]
+            else:
+                missing.append(username)
+
+        if not missing:
+            return ids
+
+        unassigned = []
+
+        for username, user_id in zip(missing, self.backend.hash_get(self.ids_key, missing)):
+            if user_id is None:
+                unassigned.append(username)
+            else:
+                ids[username] = self._remember(username, user_id)
+
+        if not create or not unassigned:
+            return ids
+
+        # Reserve a block of ids in one go, then try to claim one for each
+        # user. Anyone who got assigned an id by another process in the
+        # meantime keeps theirs (leaving a gap). The claims & the read-back go
+        # out in a single transaction, so they see the same (primary's) data
+        # even when the lookup above was answered by a lagging replica.
+        last_id = self.backend.increment(self.next_id_key, len(unassigned))
+        first_id = last_id - len(unassigned) + 1
+        pipe = self.backend.pipeline()
+
+        for offset, username in enumerate(unassigned):
+            pipe.hash_set_if_missing(self.ids_key, username, str(first_id + offset))
+
+        pipe.hash_get(self.ids_key, unassigned)
+        results = pipe.execute()
+        # Only the ids actually claimed get mapped back to a name.
+        pipe = self.backend.pipeline()
+
+        for offset, username in enumerate(unassigned):
+            if results[offset]:
+                pipe.hash_set(self.names_key, str(first_id + offset), username)
+
+        if len(pipe):
+            pipe.execute()
+
+        for username, user_id in zip(unassigned, results[-1]):
+            ids[username] = self._remember(username, user_id)
+
+        return ids
+
+    def get_names(self, user_ids):
+        """
+        Returns a dictionary of ``id => username``.
+        """
+        names = {}
+        missing = []
+
+        for user_id in user_ids:
+            user_id = self.normalize_id(user_id)
+
+            if user_id in self.name_cache:
+                names[user_id] = self.name_cache[user_id]
+            else:
+                missing.append(user_id)
+
+        if missing:
+            for user_id, username in zip(missing, self.backend.hash_get(self.names_key, missing)):
+                if username is not None:
+                    self._remember(username, user_id)
+                    names[user_id] = username
+
+        return names
+
+    def key_username(self, key):
+        return key_username(key, self.separator)
+
+    def translate_key(self, key, ids):
+        username = self.key_username(key)
+
+        if not username:
+            # Not a per-user key.
+            return key
+
+        user_id = ids.get(username)
+
+        if user_id is None:
+            return None
+
+        return self.separator.join([user_id, key.rsplit(self.separator, 1)[1]])
+
+    def translate(self, name, args, kwargs, ids):
+        # Returns ``(name, args, kwargs, fixed_result)`` to send to the wrapped
+        # backend, or ``None`` if the answer is already known.
+        if name not in self.defaults and name != 'add':
+            return name, args, kwargs, None
+
+        if name in ('intersect_range', 'intersect_card'):
+            keys = [self.translate_key(key, ids) for key in args[0]]
+
+            if None in keys:
+                # Someone without an id has nothing in common with anyone.
+                return None
+
+            return name, (keys,) + tuple(args[1:]), kwargs, None
+
+        if name in ('intersect', 'union', 'tally'):
+            dest = self.translate_key(args[0], ids)
+
+            if dest is None:
+                return None
+
+            keys = [self.translate_key(key, ids) for key in args[1]]
+            known_keys = [key for key in keys if key is not None]
+
+            if (name == 'intersect' and len(known_keys) < len(keys)) or not known_keys:
+                # The result's empty, but still replaces whatever was in
+                # ``dest``.
+                return 'delete', (dest,), {}, 0
+
+            if kwargs.get('exclude') is not None:
+                # A user without an id has nothing to exclude.
+                kwargs = dict(kwargs, exclude=self.translate_key(kwargs['exclude'], ids))
+
+            return name, (dest, known_keys) + tuple(args[2:]), kwargs, None
+
+        key = self.translate_key(args[0], ids)
+
+        if key is None:
+            return None
+
+        if name in ('add', 'remove', 'score'):
+            member = ids.get(args[1])
+
+            if member is None:
+                return None
+
+            return name, (key, member) + tuple(args[2:]), kwargs, None
+
+        return name, (key,) + tuple(args[1:]), kwargs, None
+
+    # The operations.
+
+    def add(self, key, member, score):
+        return self._one('add', key, member, score)
+
+    def remove(self, key, member):
+        return self._one('remove', key, member)
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        return self._one('range', key, offset=offset, limit=limit, min_score=min_score, max_score=max_score)
+
+    def score(self, key, member):
+        return self._one('score', key, member)
+
+    def card(self, key):
+        return self._one('card', key)
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return self._one('intersect', dest, keys, aggregate=aggregate)
+
+    def union(self, dest, keys, aggregate='sum'):
+        return self._one('union', dest, keys, aggregate=aggregate)
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return self._one('intersect_range', keys, offset=offset, limit=limit, aggregate=aggregate)
+
+    def intersect_card(self, keys):
+        return self._one('intersect_card', keys)
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        return self._one('tally', dest, keys, limit=limit, exclude=exclude)
+
+    def exists(self, key):
+        return self._one('exists', key)
+
+    def expire(self, key, seconds):
+        return self._one('expire', key, seconds)
+
+    def delete(self, key):
+        return self._one('delete', key)
+
+    def set_add(self, key, member):
+        return self.backend.set_add(key, member)
+
+    def set_remove(self, key, member):
+        return self.backend.set_remove(key, member)
+
+    def set_members(self, key):
+        return self.backend.set_members(key)
+
+    def increment(self, key, amount=1):
+        return self.backend.increment(key, amount)
+
+    def hash_get(self, key, fields):
+        return self.backend.hash_get(key, fields)
+
+    def hash_set(self, key, field, value):
+        return self.backend.hash_set(key, field, value)
+
+    def hash_set_if_missing(self, key, field, value):
+        return self.backend.hash_set_if_missing(key, field, value)
+
+    def stream_add(self, key, fields, max_length=None):
+        return self.backend.stream_add(key, fields, max_length=max_length)
+
+    def stream_read(self, key, after=None, count=None):
+        return self.backend.stream_read(key, after=after, count=count)
+
+    def publish(self, channel, message):
+        return self.backend.publish(channel, message)
+
+    def listen(self, channel, callback):
+        return self.backend.listen(channel, callback)
+
+    def flush(self):
+        self.id_cache.clear()
+        self.name_cache.clear()
+        return self.backend.flush()
+
+    def pool_stats(self):
+        return self.backend.pool_stats()
+
+
+class ShardedPipeline(QueuedPipeline):
+    # Splits the queued operations into one pipeline per shard, runs those in
+    # parallel & puts the results back in order.
+    def execute(self):
+        commands, self.commands = self.commands, []
+        results = [None] * len(commands)
+        by_shard = {}
+
+        for position, (name, args, kwargs) in enumerate(commands):
+            shard = self.backend.shard_for(name, args, kwargs)
+            by_shard.setdefault(shard, []).append((position, name, args, kwargs))
+
+        def run(shard, shard_commands):
+            pipe = self.backend.backends[shard].pipeline(transaction=self.transaction)
+
+            for position, name, args, kwargs in shard_commands:
+                getattr(pipe, name)(*args, **kwargs)
+
+            for (position, name, args, kwargs), result in zip(shard_commands, pipe.execute()):
+                results[position] = result
+
+        self.backend.scatter([(run, (shard, shard_commands)) for shard, shard_commands in by_shard.items()])
+        return results
+
+
+class CrossShardError(ValueError):
+    # An operation combining keys that live on different shards.
+    pass
+
+
+class ShardedBackend(BaseBackend):
+    """
+    Spreads the data across several backends (say, one per Redis node).
+
+    Each per-user key is placed by consistent hashing on the username, so a
+    user's following & followers always live together (which keeps things
+    like ``friends`` on a single node). Pipelines are split per node & run in
+    parallel threads, which become greenlets under ``gevent``. Pipelines are
+    only atomic within each node.
+
+    ``names`` identify each backend on the hash ring. Keep them stable (e.g.
+    ``host:port/db``) so reordering the backends doesn't move any data.
+    """
+    operations = MemoryBackend.operations
+
+    def __init__(self, backends, separator, names=None, replicas=100):
+        self.backends = list(backends)
+        self.separator = separator
+        self.names = names
+        self.ring = []
+
+        if self.names is None:
+            self.names = [str(offset) for offset in range(len(self.backends))]
+
+        for shard, name in enumerate(self.names):
+            for replica in range(replicas):
+                self.ring.append((self._hash('{0}-{1}'.format(name, replica)), shard))
+
+        self.ring.sort()
+        self.ring_hashes = [ring_hash for ring_hash, shard in self.ring]
+
+    def _hash(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def shard_for_key(self, key):
+        # Global keys (like ``::tombstones``) are placed by the whole key.
+        placement = key_username(key, self.separator) or key
+        position = bisect.bisect(self.ring_hashes, self._hash(placement)) % len(self.ring)
+        return self.ring[position][1]
+
+    def shard_for(self, name, args, kwargs=None):
+        if name == 'publish':
+            return 0
+
+        if name in ('intersect_range', 'intersect_card'):
+            keys = list(args[0])
+        elif name in ('intersect', 'union', 'tally'):
+            keys = [args[0]] + list(args[1])
+
+            if (kwargs or {}).get('exclude') is not None:
+                keys.append(kwargs['exclude'])
+        else:
+            return self.shard_for_key(args[0])
+
+        shard = self.shard_for_key(keys[0])
+
+        for key in keys[1:]:
+            if self.shard_for_key(key) != shard:
+                raise CrossShardError("The keys for '{0}' live on different shards.".format(name))
+
+        return shard
+
+    def scatter(self, calls):
+        # Runs each ``(func, args)`` in parallel, re-raising the first error.
+        if len(calls) == 1:
+            func, args = calls[0]
+            func(*args)
+            return
+
+        errors = []
+
+        def run(func, args):
+            try:
+                func(*args)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=call) for call in calls]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction=transaction)
+
+    def _route(self, name, *args, **kwargs):
+        return getattr(self.backends[self.shard_for(name, args, kwargs)], name)(*args, **kwargs)
+
+    def add(self, key, member, score):
+        return self._route('add', key, member, score)
+
+    def remove(self, key, member):
+        return self._route('remove', key, member)
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        return self._route('range', key, offset=offset, limit=limit, min_score=min_score, max_score=max_score)
+
+    def score(self, key, member):
+        return self._route('score', key, member)
+
+    def card(self, key):
+        return self._route('card', key)
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return self._route('intersect', dest, keys, aggregate=aggregate)
+
+    def union(self, dest, keys, aggregate='sum'):
+        return self._route('union', dest, keys, aggregate=aggregate)
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return self._route('intersect_range', keys, offset=offset, limit=limit, aggregate=aggregate)
+
+    def intersect_card(self, keys):
+        return self._route('intersect_card', keys)
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        return self._route('tally', dest, keys, limit=limit, exclude=exclude)
+
+    def exists(self, key):
+        return self._route('exists', key)
+
+    def expire(self, key, seconds):
+        return self._route('expire', key, seconds)
+
+    def delete(self, key):
+        return self._route('delete', key)
+
+    def set_add(self, key, member):
+        return self._route('set_add', key, member)
+
+    def set_remove(self, key, member):
+        return self._route('set_remove', key, member)
+
+    def set_members(self, key):
+        return self._route('set_members', key)
+
+    def increment(self, key, amount=1):
+        return self._route('increment', key, amount)
+
+    def hash_get(self, key, fields):
+        return self._route('hash_get', key, fields)
+
+    def hash_set(self, key, field, value):
+        return self._route('hash_set', key, field, value)
+
+    def hash_set_if_missing(self, key, field, value):
+        return self._route('hash_set_if_missing', key, field, value)
+
+    def stream_add(self, key, fields, max_length=None):
+        return self._route('stream_add', key, fields, max_length=max_length)
+
+    def stream_read(self, key, after=None, count=None):
+        return self._route('stream_read', key, after=after, count=count)
+
+    def publish(self, channel, message):
+        return self.backends[0].publish(channel, message)
+
+    def listen(self, channel, callback):
+        return self.backends[0].listen(channel, callback)
+
+    def flush(self):
+        for backend in self.backends:
+            backend.flush()
+
+        return True
+
+    def pool_stats(self):
+        return [stats for backend in self.backends for stats in backend.pool_stats()]
+
+
+class ReplicatedPipeline(QueuedPipeline):
+    # Read-only pipelines go to a replica, anything else to the primary.
+    def _execute(self, target):
+        pipe = target.pipeline(transaction=self.transaction)
+
+        for name, args, kwargs in self.commands:
+            getattr(pipe, name)(*args, **kwargs)
+
+        return pipe.execute()
+
+    def execute(self):
+        backend = self.backend
+
+        try:
+            if all(backend.is_replica_read(name, args) for name, args, kwargs in self.commands):
+                return backend.read(self._execute)
+
+            backend.wrote([args[0] for name, args, kwargs in self.commands if name in backend.pinning_operations])
+            return self._execute(backend.primary)
+        finally:
+            self.commands = []
+
+
+class ReplicatedBackend(BaseBackend):
+    """
+    Sends writes to a ``primary`` backend & load-balances reads across its
+    ``replicas`` (round-robin).
+
+    With ``read_your_writes=<seconds>``, reads of any user changed through
+    this backend go to the primary for that long afterward, so they never
+    see a lagging replica. (This is per-process.)
+
+    A replica that can't be reached is skipped for ``retry_interval``
+    seconds, doubling on each failure in a row (up to ``max_retry_interval``).
+    Reads fall back to the primary when no replica is up.
+    """
+    operations = MemoryBackend.operations
+    read_operations = (
+        'range', 'score', 'card', 'intersect_range', 'intersect_card', 'exists', 'set_members', 'hash_get',
+        'stream_read',
+    )
+    # The writes that change a user's data (as opposed to scratch keys like
+    # ``friends``).
+    pinning_operations = ('add', 'remove', 'union', 'hash_set', 'hash_set_if_missing')
+
+    def __init__(self, primary, replicas, separator, read_your_writes=None, retry_interval=1,
+                 max_retry_interval=30):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.separator = separator
+        self.read_your_writes = read_your_writes
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # ``replica offset => (retry at, failures in a row)``.
+        self.down = {}
+        # ``username => pinned until``, oldest first.
+        self.pinned = OrderedDict()
+
+    # Read-your-writes.
+
+    def wrote(self, keys):
+        if not self.read_your_writes or not keys:
+            return
+
+        until = time.time() + self.read_your_writes
+
+        with self.lock:
+            for key in keys:
+                username = key_username(key, self.separator)
+                self.pinned.pop(username, None)
+                self.pinned[username] = until
+
+            # Everything is pinned for the same length of time, so the
+            # expired entries are all at the front.
+            now = time.time()
+
+            while self.pinned:
+                username, pinned_until = next(iter(self.pinned.items()))
+
+                if pinned_until > now:
+                    break
+
+                del self.pinned[username]
+
+    def is_pinned(self, key):
+        if not self.pinned:
+            return False
+
+        return self.pinned.get(key_username(key, self.separator), 0) > time.time()
+
+    def is_replica_read(self, name, args):
+        if name not in self.read_operations:
+            return False
+
+        if name in ('intersect_range', 'intersect_card'):
+            return not any(self.is_pinned(key) for key in args[0])
+
+        return not self.is_pinned(args[0])
+
+    # Picking a replica.
+
+    def available_replicas(self):
+        now = time.time()
+        start = next(self.counter)
+        replicas = []
+
+        for step in range(len(self.replicas)):
+            offset = (start + step) % len(self.replicas)
+
+            if self.down.get(offset, (0, 0))[0] <= now:
+                replicas.append(offset)
+
+        return replicas
+
+    def mark_down(self, offset):
+        with self.lock:
+            failures = self.down.get(offset, (0, 0))[1] + 1
+            interval = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+            self.down[offset] = (time.time() + interval, failures)
+
+    def mark_up(self, offset):
+        if offset in self.down:
+            with self.lock:
+                self.down.pop(offset, None)
+
+    def read(self, func):
+        # Calls ``func(backend)`` with a replica, moving on to the next one (&
+        # finally the primary) if it can't be reached.
+        for offset in self.available_replicas():
+            replica = self.replicas[offset]
+
+            try:
+                result = func(replica)
+            except replica.connection_errors:
+                self.mark_down(offset)
+                continue
+
+            self.mark_up(offset)
+            return result
+
+        return func(self.primary)
+
+    def stats(self):
+        now = time.time()
+        return {
+            'replicas': len(self.replicas),
+            'down': len([offset for offset, (retry_at, failures) in self.down.items() if retry_at > now]),
+            'pinned': len(self.pinned),
+        }
+
+    # The operations.
+
+    def pipeline(self, transaction=True):
+        return ReplicatedPipeline(self, transaction=transaction)
+
+    def _read(self, name, *args, **kwargs):
+        if not self.is_replica_read(name, args):
+            return getattr(self.primary, name)(*args, **kwargs)
+
+        return self.read(lambda backend: getattr(backend, name)(*args, **kwargs))
+
+    def _write(self, name, *args, **kwargs):
+        if name in self.pinning_operations:
+            self.wrote([args[0]])
+
+        return getattr(self.primary, name)(*args, **kwargs)
+
+    def add(self, key, member, score):
+        return self._write('add', key, member, score)
+
+    def remove(self, key, member):
+        return self._write('remove', key, member)
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        return self._read('range', key, offset=offset, limit=limit, min_score=min_score, max_score=max_score)
+
+    def score(self, key, member):
+        return self._read('score', key, member)
+
+    def card(self, key):
+        return self._read('card', key)
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return self._write('intersect', dest, keys, aggregate=aggregate)
+
+    def union(self, dest, keys, aggregate='sum'):
+        return self._write('union', dest, keys, aggregate=aggregate)
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return self._read('intersect_range', keys, offset=offset, limit=limit, aggregate=aggregate)
+
+    def intersect_card(self, keys):
+        return self._read('intersect_card', keys)
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        return self._write('tally', dest, keys, limit=limit, exclude=exclude)
+
+    def exists(self, key):
+        return self._read('exists', key)
+
+    def expire(self, key, seconds):
+        return self._write('expire', key, seconds)
+
+    def delete(self, key):
+        return self._write('delete', key)
+
+    def set_add(self, key, member):
+        return self._write('set_add', key, member)
+
+    def set_remove(self, key, member):
+        return self._write('set_remove', key, member)
+
+    def set_members(self, key):
+        return self._read('set_members', key)
+
+    def increment(self, key, amount=1):
+        return self._write('increment', key, amount)
+
+    def hash_get(self, key, fields):
+        return self._read('hash_get', key, fields)
+
+    def hash_set(self, key, field, value):
+        return self._write('hash_set', key, field, value)
+
+    def hash_set_if_missing(self, key, field, value):
+        return self._write('hash_set_if_missing', key, field, value)
+
+    def stream_add(self, key, fields, max_length=None):
+        return self._write('stream_add', key, fields, max_length=max_length)
+
+    def stream_read(self, key, after=None, count=None):
+        return self._read('stream_read', key, after=after, count=count)
+
+    def publish(self, channel, message):
+        return self.primary.publish(channel, message)
+
+    def listen(self, channel, callback):
+        return self.primary.listen(channel, callback)
+
+    def flush(self):
+        # Replicas catch up on their own.
+        return self.primary.flush()
+
+    def pool_stats(self):
+        return [stats for backend in [self.primary] + self.replicas for stats in backend.pool_stats()]
+
+
+class ObservedPipeline(QueuedPipeline):
+    def __init__(self, backend, transaction=True):
+        super(ObservedPipeline, self).__init__(backend, transaction=transaction)
+        self.pipe = backend.backend.pipeline(transaction=transaction)
+
+    def queue(self, name, args, kwargs):
+        super(ObservedPipeline, self).queue(name, args, kwargs)
+        getattr(self.pipe, name)(*args, **kwargs)
+
+    def execute(self):
+        commands = [(name, args) for name, args, kwargs in self.commands]
+        self.commands = []
+        start = time.time()
+        results = None
+
+        try:
+            results = self.pipe.execute()
+            return results
+        finally:
+            self.backend.observer(commands, time.time() - start, results)
+
+
+class ObservedBackend(BaseBackend):
+    """
+    Wraps another ``backend``, calling ``observer(commands, seconds,
+    results)`` after each round-trip to it. ``commands`` is a list of
+    ``(operation, args)`` & ``results`` their replies (``None`` if the
+    round-trip failed).
+
+    Handy for metrics & tracing. Wrap each Redis server's backend to see the
+    actual round-trips (a ``ShardedBackend`` fans out to several).
+    """
+    operations = MemoryBackend.operations
+
+    def __init__(self, backend, observer):
+        self.backend = backend
+        self.observer = observer
+        self.connection_errors = backend.connection_errors
+        self.conn = getattr(backend, 'conn', None)
+
+    def pipeline(self, transaction=True):
+        return ObservedPipeline(self, transaction=transaction)
+
+    def _observe(self, name, *args, **kwargs):
+        start = time.time()
+        results = None
+
+        try:
+            results = [getattr(self.backend, name)(*args, **kwargs)]
+            return results[0]
+        finally:
+            self.observer([(name, args)], time.time() - start, results)
+
+    def add(self, key, member, score):
+        return self._observe('add', key, member, score)
+
+    def remove(self, key, member):
+        return self._observe('remove', key, member)
+
+    def range(self, key, offset=0, limit=None, min_score=None, max_score=None):
+        return self._observe('range', key, offset=offset, limit=limit, min_score=min_score, max_score=max_score)
+
+    def score(self, key, member):
+        return self._observe('score', key, member)
+
+    def card(self, key):
+        return self._observe('card', key)
+
+    def intersect(self, dest, keys, aggregate='sum'):
+        return self._observe('intersect', dest, keys, aggregate=aggregate)
+
+    def union(self, dest, keys, aggregate='sum'):
+        return self._observe('union', dest, keys, aggregate=aggregate)
+
+    def intersect_range(self, keys, offset=0, limit=None, aggregate='sum'):
+        return self._observe('intersect_range', keys, offset=offset, limit=limit, aggregate=aggregate)
+
+    def intersect_card(self, keys):
+        return self._observe('intersect_card', keys)
+
+    def tally(self, dest, keys, limit=None, exclude=None):
+        return self._observe('tally', dest, keys, limit=limit, exclude=exclude)
+
+    def exists(self, key):
+        return self._observe('exists', key)
+
+    def expire(self, key, seconds):
+        return self._observe('expire', key, seconds)
+
+    def delete(self, key):
+        return self._observe('delete', key)
+
+    def set_add(self, key, member):
+        return self._observe('set_add', key, member)
+
+    def set_remove(self, key, member):
+        return self._observe('set_remove', key, member)
+
+    def set_members(self, key):
+        return self._observe('set_members', key)
+
+    def increment(self, key, amount=1):
+        return self._observe('increment', key, amount)
+
+    def hash_get(self, key, fields):
+        return self._observe('hash_get', key, fields)
+
+    def hash_set(self, key, field, value):
+        return self._observe('hash_set', key, field, value)
+
+    def hash_set_if_missing(self, key, field, value):
+        return self._observe('hash_set_if_missing', key, field, value)
+
+    def stream_add(self, key, fields, max_length=None):
+        return self._observe('stream_add', key, fields, max_length=max_length)
+
+    def stream_read(self, key, after=None, count=None):
+        return self._observe('stream_read', key, after=after, count=count)
+
+    def publish(self, channel, message):
+        return self._observe('publish', channel, message)
+
+    def listen(self, channel, callback):
+        return self.backend.listen(channel, callback)
+
+    def flush(self):
+        return self._observe('flush')
+
+    def pool_stats(self):
+        return self.backend.pool_stats()
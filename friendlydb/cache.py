@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class FriendlyCache(object):
+    """
+    An in-process LRU cache of list reads, keyed by the Redis key they were
+    read from.
+
+    Each Redis key can hold several cached variants (different pages, time
+    windows, etc.). The cache holds at most ``size`` Redis keys & each
+    variant lives for at most ``ttl`` seconds.
+
+    If a ``channel`` is given, writes publish the keys they touch to it &
+    ``listen`` evicts keys published by other processes.
+    """
+    def __init__(self, size=1000, ttl=60, channel=None):
+        self.size = size
+        self.ttl = ttl
+        self.channel = channel
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.is_listening = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, variant):
+        with self.lock:
+            variants = self.entries.get(key)
+
+            if variants is not None and variant in variants:
+                expires, value = variants[variant]
+
+                if self.ttl is None or expires > time.time():
+                    # Move it to the most-recently-used end.
+                    del self.entries[key]
+                    self.entries[key] = variants
+                    self.hits += 1
+                    return value
+
+                del variants[variant]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, variant, value):
+        expires = None
+
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        with self.lock:
+            variants = self.entries.pop(key, {})
+            variants[variant] = (expires, value)
+            self.entries[key] = variants
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    # Cross-process invalidation.
+
+    def publish(self, pipe, keys):
+        if self.channel is not None and keys:
+            pipe.publish(self.channel, json.dumps(list(keys)))
+
+    def _on_message(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        self.invalidate(json.loads(data))
+
+    def listen(self, backend):
+        """
+        Evicts keys published to the channel by any process (in the
+        background) from now on.
+        """
+        if self.channel is None or self.is_listening:
+            return False
+
+        backend.listen(self.channel, self._on_message)
+        self.is_listening = True
+        return True
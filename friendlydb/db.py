@@ -1,41 +1,522 @@
 import redis
-from friendlydb.user import FriendlyUser
+import threading
+import time
+from collections import OrderedDict
+from friendlydb import SEPARATOR
+from friendlydb.backends import InternedBackend, ObservedBackend, RedisBackend, ReplicatedBackend, ShardedBackend
+from friendlydb.cache import FriendlyCache
+from friendlydb.user import FriendlyUser, planned
+try:
+    from redis.connection import HiredisParser
+    from redis.connection import HIREDIS_AVAILABLE
+except ImportError:
+    HIREDIS_AVAILABLE = False
+
+if not HIREDIS_AVAILABLE:
+    HiredisParser = None
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+def format_change(entry_id, fields):
+    # A change feed entry => an event.
+    return {
+        'id': entry_id,
+        'type': fields['type'],
+        'username': fields['username'],
+        'other_username': fields.get('other_username') or None,
+        'time': int(float(fields['time'])),
+    }
+
+
+def format_changes(entries, checkpoint):
+    # Change feed entries => ``(events, checkpoint)``.
+    events = [format_change(entry_id, fields) for entry_id, fields in entries]
+
+    if events:
+        checkpoint = events[-1]['id']
+
+    return events, checkpoint
+
+
+def plan_counts_many(fdb, pipe, usernames):
+    # Queues the counts of each username. Finishes as ``username => counts``.
+    plans = [(username, planned(pipe, fdb[username]._counts)) for username in usernames]
+    return lambda results: dict((username, finish(results)) for username, finish in plans)
+
+
+def plan_get_many(fdb, pipe, usernames, fields, limit, with_dates):
+    # Queues each of the ``fields`` of each username. Finishes as
+    # ``username => {field: value}``.
+    for field in fields:
+        if field not in ('following', 'followers', 'counts'):
+            raise ValueError("'{0}' isn't a field that can be fetched.".format(field))
+
+    users = [fdb[username] for username in OrderedDict.fromkeys(usernames)]
+    plans = []
+
+    for user in users:
+        for field in fields:
+            if field == 'counts':
+                finish = planned(pipe, user._counts)
+            else:
+                finish = planned(pipe, user._list, field, limit=limit, with_dates=with_dates)
+
+            plans.append((user.username, field, finish))
+
+    def finish(results):
+        found = dict((user.username, {}) for user in users)
+
+        for username, field, finish_field in plans:
+            found[username][field] = finish_field(results)
+
+        return found
+
+    return finish
 
 
 class FriendlyDB(object):
     """
     The database of following/followers.
+
+    Passing ``cache_size`` turns on an in-process LRU cache of
+    following/followers reads (see ``FriendlyCache``). Also passing
+    ``cache_channel`` keeps the caches of every process using that channel
+    in sync via Redis pub/sub.
+
+    Everything is stored in Redis, unless another ``backend`` (like a
+    ``friendlydb.backends.MemoryBackend``) is provided. With
+    ``intern_ids=True``, usernames are stored as integer ids (see
+    ``InternedBackend``).
+
+    To spread the data across several Redis servers, pass ``nodes``, a list
+    of ``{'host': ..., 'port': ..., 'db': ...}`` dicts. Users are placed on a
+    node by consistent hashing (see ``ShardedBackend``).
+
+    To spread reads across read replicas, pass ``replicas`` (a list of the
+    same sort of dicts) or add a ``'replicas'`` list to each node. Writes go
+    to the primary. ``read_your_writes=<seconds>`` sends reads of users
+    changed by this process to the primary for that long (see
+    ``ReplicatedBackend``).
+
+    Each Redis server gets its own connection pool, shared by every
+    ``FriendlyUser`` it hands out. ``max_connections`` caps the pool size;
+    with ``pool_timeout``, callers wait up to that many seconds for a free
+    connection rather than erroring. ``unix_socket_path``,
+    ``socket_keepalive`` & ``socket_timeout`` configure the connections &
+    the ``hiredis`` reply parser is used when it's installed.
+    ``pool_stats()`` reports how much of each pool is in use.
+
+    ``observer(commands, seconds, results)`` is called after every
+    round-trip to a Redis server (or the ``backend``), with the
+    ``(operation, args)`` sent & the replies (see ``ObservedBackend``).
+    ``friendlydb.tracing.Tracer`` uses it to trace blocks of code.
+
+    With ``change_feed_length``, every follow, unfollow & deleted user is
+    also recorded as an event in a Redis stream (Redis 5+), in the same
+    round-trip as the write, keeping roughly that many of the most recent
+    events. ``read_changes`` & ``consume_changes`` read them back from a
+    checkpoint.
     """
-    def __init__(self, host='localhost', port=6379, db=0, user_klass=None, separator=None):
+    def __init__(self, host='localhost', port=6379, db=0, user_klass=None, separator=None,
+                 cache_size=None, cache_ttl=60, cache_channel=None, backend=None,
+                 intern_ids=False, nodes=None, replicas=None, read_your_writes=None,
+                 max_connections=None, pool_timeout=None, unix_socket_path=None,
+                 socket_keepalive=False, socket_timeout=None, observer=None, change_feed_length=None):
         self.host = host
         self.port = port
         self.db = db
         self.user_klass = user_klass
         self.separator = separator
+        self.cache = None
+        self.backend = backend
+        self.intern_ids = intern_ids
+        self.nodes = nodes
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.unix_socket_path = unix_socket_path
+        self.socket_keepalive = socket_keepalive
+        self.socket_timeout = socket_timeout
+        self.observer = observer
+        self.change_feed_length = change_feed_length
         self.conn = None
         self.is_setup = False
 
         if self.user_klass is None:
             self.user_klass = FriendlyUser
 
+        if cache_size:
+            self.cache = FriendlyCache(size=cache_size, ttl=cache_ttl, channel=cache_channel)
+
+        if self.backend is not None:
+            self.backend = self.observe(self.backend)
+
         self.setup()
 
     # Setup methods, to make sure the kit is sane.
 
+    def connection_pool(self, host='localhost', port=6379, db=0, unix_socket_path=None):
+        kwargs = {
+            'db': db,
+            'socket_timeout': self.socket_timeout,
+        }
+
+        if HiredisParser is not None:
+            kwargs['parser_class'] = HiredisParser
+
+        if unix_socket_path:
+            kwargs['connection_class'] = redis.UnixDomainSocketConnection
+            kwargs['path'] = unix_socket_path
+        else:
+            kwargs['host'] = host
+            kwargs['port'] = port
+            kwargs['socket_keepalive'] = self.socket_keepalive
+
+        if self.pool_timeout is not None:
+            return redis.BlockingConnectionPool(max_connections=self.max_connections or 50, timeout=self.pool_timeout, **kwargs)
+
+        return redis.ConnectionPool(max_connections=self.max_connections, **kwargs)
+
+    def connect(self, host='localhost', port=6379, db=0, unix_socket_path=None):
+        return redis.StrictRedis(connection_pool=self.connection_pool(host, port, db, unix_socket_path))
+
+    def observe(self, backend):
+        if self.observer is None:
+            return backend
+
+        return ObservedBackend(backend, self.observer)
+
+    def node_backend(self, node, replicas=None):
+        # A backend for a ``{'host': ..., 'port': ..., 'db': ...}`` node (&
+        # its replicas, if any).
+        backend = self.observe(RedisBackend(self.connect(
+            node.get('host', 'localhost'),
+            node.get('port', 6379),
+            node.get('db', 0),
+            node.get('unix_socket_path')
+        )))
+        replicas = node.get('replicas', replicas)
+
+        if not replicas:
+            return backend
+
+        return ReplicatedBackend(
+            backend,
+            [self.node_backend(replica) for replica in replicas],
+            separator=self.separator or SEPARATOR,
+            read_your_writes=self.read_your_writes
+        )
+
     def setup(self):
-        self.conn = redis.StrictRedis(host=self.host, port=self.port, db=self.db)
+        if self.backend is None and self.nodes:
+            backends = []
+            names = []
+
+            for node in self.nodes:
+                backends.append(self.node_backend(node))
+                names.append('{0}:{1}/{2}'.format(node.get('host', 'localhost'), node.get('port', 6379), node.get('db', 0)))
+
+            self.backend = ShardedBackend(backends, separator=self.separator or SEPARATOR, names=names)
+        elif self.backend is None:
+            node = {'host': self.host, 'port': self.port, 'db': self.db, 'unix_socket_path': self.unix_socket_path}
+            self.backend = self.node_backend(node, replicas=self.replicas)
+            self.conn = getattr(self.backend, 'primary', self.backend).conn
+
+        if self.intern_ids and not isinstance(self.backend, InternedBackend):
+            self.backend = InternedBackend(self.backend, separator=self.separator or SEPARATOR)
+
+        if self.cache is not None:
+            self.cache.listen(self.backend)
+
         self.is_setup = True
 
     # End-user methods!
 
+    def pool_stats(self):
+        """
+        Returns a list of connection pool stats (``address``, ``db``,
+        ``max_connections``, ``created``, ``in_use`` & ``idle``), one per
+        Redis server.
+        """
+        return self.backend.pool_stats()
+
     def clear(self):
-        self.conn.flushdb()
+        self.backend.flush()
+
+        if self.cache is not None:
+            self.cache.clear()
+
         self.setup()
         return True
 
     def __getitem__(self, username):
-        return self.user_klass(username, conn=self.conn, separator=self.separator)
+        return self.user_klass(username, conn=self.conn, separator=self.separator, cache=self.cache, backend=self.backend,
+                               change_feed_length=self.change_feed_length)
 
-    def delete_user(self, username):
+    def generate_key(self, username, key_type):
+        return self[username].generate_key(username, key_type)
+
+    def delete_user(self, username, background=False, batch_size=1000, callback=None):
+        """
+        Deletes a user & all of their relationships.
+
+        With ``background=True``, the user is tombstoned (which is atomic &
+        immediate) & the rest of the graph is cleaned up by a background
+        thread, so this returns right away.
+        """
         user = self[username]
-        return user.delete()
+
+        if not background:
+            return user.delete(batch_size=batch_size, callback=callback)
+
+        user.tombstone()
+        thread = threading.Thread(target=user.reap, kwargs={
+            'batch_size': batch_size,
+            'callback': callback,
+        })
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def tombstones(self):
+        """
+        Returns the usernames that have been deleted but not yet reaped.
+        """
+        return self.backend.set_members(self.generate_key('', 'tombstones'))
+
+    def reap_tombstones(self, batch_size=1000):
+        """
+        Finishes cleaning up after any deleted users, such as ones whose
+        background reaping was cut short by a restart.
+
+        Returns how many users were reaped.
+        """
+        reaped = 0
+
+        for username in self.tombstones():
+            self[username].reap(batch_size=batch_size)
+            reaped += 1
+
+        return reaped
+
+    # The change feed.
+
+    def read_changes(self, checkpoint=None, count=1000):
+        """
+        Returns up to ``count`` of the events recorded after ``checkpoint``
+        (or from the oldest one kept), oldest first.
+
+        Each event is a dict of ``id``, ``type`` (``follow``, ``unfollow`` or
+        ``delete``, meaning all of the user's edges are gone), ``username``,
+        ``other_username`` (``None`` for ``delete``) & ``time``.
+
+        Returns a tuple of ``(events, checkpoint)``. Pass the checkpoint back
+        in to get the next batch.
+        """
+        entries = self.backend.stream_read(self.generate_key('', 'changes'), after=checkpoint, count=count)
+        return format_changes(entries, checkpoint)
+
+    def iter_change_batches(self, checkpoint=None, batch_size=1000):
+        """
+        Walks the events after ``checkpoint`` until caught up, yielding
+        ``(events, checkpoint)`` for up to ``batch_size`` at a time.
+        """
+        while True:
+            events, checkpoint = self.read_changes(checkpoint, count=batch_size)
+
+            if events:
+                yield events, checkpoint
+
+            if len(events) < batch_size:
+                return
+
+    def change_checkpoint(self, consumer):
+        """
+        Returns the checkpoint last saved for ``consumer`` (or ``None``).
+        """
+        return self.backend.hash_get(self.generate_key('', 'change_checkpoints'), [consumer])[0]
+
+    def save_change_checkpoint(self, consumer, checkpoint):
+        self.backend.hash_set(self.generate_key('', 'change_checkpoints'), consumer, checkpoint)
+        return True
+
+    def consume_changes(self, consumer, callback, batch_size=1000):
+        """
+        Calls ``callback`` with each batch of events since ``consumer``'s
+        saved checkpoint, saving the checkpoint after each one. An error
+        from ``callback`` stops things before that batch's checkpoint is
+        saved, so every event is handled at least once.
+
+        Events older than the last ``change_feed_length`` are trimmed, so a
+        consumer that falls further behind than that misses some (& should
+        re-read the lists).
+
+        Returns how many events were handled.
+        """
+        handled = 0
+
+        for events, checkpoint in self.iter_change_batches(self.change_checkpoint(consumer), batch_size=batch_size):
+            callback(events)
+            self.save_change_checkpoint(consumer, checkpoint)
+            handled += len(events)
+
+        return handled
+
+    def counts_many(self, usernames):
+        """
+        Fetches the following/followers/friends counts for all of the given
+        usernames in a single round-trip.
+
+        Returns a dictionary of ``username => counts``.
+        """
+        pipe = self.backend.pipeline()
+        finish = plan_counts_many(self, pipe, usernames)
+        return finish(pipe.execute())
+
+    def get_many(self, usernames, fields=('following', 'followers', 'counts'), limit=50, with_dates=False):
+        """
+        Fetches the given ``fields`` (any of ``following``, ``followers`` &
+        ``counts``) for all of the given usernames in a single round-trip.
+
+        Lists are the most recent ``limit`` users (``None`` for everything).
+
+        Returns a dictionary of ``username => {field: value}``.
+        """
+        pipe = self.backend.pipeline()
+        finish = plan_get_many(self, pipe, usernames, fields, limit, with_dates)
+        return finish(pipe.execute())
+
+    # Bulk loading.
+
+    def _chunk_edges(self, edges, chunk_size):
+        chunk = []
+
+        for edge in edges:
+            chunk.append(edge)
+
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def _load_chunk(self, chunk):
+        loaded = 0
+        skipped = 0
+        touched_keys = set()
+        # A bulk load doesn't need each chunk to be atomic, so skip the
+        # MULTI/EXEC overhead.
+        pipe = self.backend.pipeline(transaction=False)
+        time_score = None
+
+        for edge in chunk:
+            follower, followee = edge[0], edge[1]
+
+            if follower == followee:
+                skipped += 1
+                continue
+
+            if len(edge) > 2:
+                edge_score = edge[2]
+            else:
+                if time_score is None:
+                    time_score = self[follower].current_time_score()
+
+                edge_score = time_score
+
+            touched_keys.update(self[follower]._follow(pipe, followee, edge_score))
+            loaded += 1
+
+        if self.cache is not None:
+            self.cache.publish(pipe, touched_keys)
+
+        pipe.execute()
+
+        if self.cache is not None:
+            self.cache.invalidate(touched_keys)
+
+        return loaded, skipped
+
+    def bulk_load(self, edges, chunk_size=10000, workers=1, callback=None):
+        """
+        Streams ``(follower, followee[, timestamp])`` edges into the DB in
+        pipelined chunks of ``chunk_size`` edges.
+
+        ``edges`` can be any iterable (including a generator). At most
+        ``workers * 3`` chunks are held in memory at once, no matter how many
+        edges there are. With ``workers > 1``, chunks are written by that many
+        threads in parallel.
+
+        If provided, ``callback`` is called with the stats so far after each
+        chunk is written.
+
+        Returns a dictionary of ``edges``, ``skipped``, ``seconds`` & ``rate``
+        (edges per second).
+        """
+        stats = {
+            'edges': 0,
+            'skipped': 0,
+            'seconds': 0.0,
+            'rate': 0.0,
+        }
+        lock = threading.Lock()
+        start = time.time()
+
+        def finished(loaded, skipped):
+            with lock:
+                stats['edges'] += loaded
+                stats['skipped'] += skipped
+                stats['seconds'] = time.time() - start
+
+                if stats['seconds'] > 0:
+                    stats['rate'] = stats['edges'] / stats['seconds']
+
+                if callback is not None:
+                    callback(dict(stats))
+
+        if workers <= 1:
+            for chunk in self._chunk_edges(edges, chunk_size):
+                finished(*self._load_chunk(chunk))
+
+            return stats
+
+        queue = Queue(maxsize=workers * 2)
+        errors = []
+
+        def work():
+            while True:
+                chunk = queue.get()
+
+                if chunk is None:
+                    return
+
+                try:
+                    finished(*self._load_chunk(chunk))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for chunk in self._chunk_edges(edges, chunk_size):
+                queue.put(chunk)
+        finally:
+            for thread in threads:
+                queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return stats
@@ -0,0 +1,243 @@
+import bisect
+import threading
+import time
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed ``buckets`` (upper bounds), the same way
+    Prometheus histograms do. Quantiles are estimated from the buckets (&
+    kept within the smallest & largest values seen).
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last count is for anything above the highest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        # ``(upper bound, count <= it)`` pairs, ending with ``'+Inf'``.
+        total = 0
+        results = []
+
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            results.append((bound, total))
+
+        return results
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        return min(max(self._estimate(q), self.min), self.max)
+
+    def _estimate(self, q):
+        rank = q * self.count
+        total = 0
+        lower = 0
+
+        for offset, count in enumerate(self.counts):
+            if total + count >= rank and count:
+                if offset == len(self.buckets):
+                    # Past the last bucket, the best guess is its bound.
+                    return self.buckets[-1]
+
+                upper = self.buckets[offset]
+                return lower + (upper - lower) * (rank - total) / float(count)
+
+            total += count
+
+            if offset < len(self.buckets):
+                lower = self.buckets[offset]
+
+        return self.buckets[-1]
+
+    def summary(self):
+        mean = None
+
+        if self.count:
+            mean = self.sum / float(self.count)
+
+        return {
+            'count': self.count,
+            'mean': mean,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.redis_commands = 0
+        self.redis_round_trips = 0
+        self.redis_seconds = 0
+
+
+class RouteStats(object):
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+    count_buckets = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram(self.latency_buckets)
+        self.response_bytes = Histogram(self.size_buckets)
+        self.redis_commands = Histogram(self.count_buckets)
+        self.redis_round_trips = Histogram(self.count_buckets)
+        self.redis_seconds = 0
+
+
+class Metrics(object):
+    """
+    Per-route request metrics for the HTTP server: status counts, latency,
+    response size & the Redis commands/round-trips/time each request needed.
+
+    The server calls ``start_request()`` & ``finish_request(...)`` around
+    each request. Pass ``observe_redis`` as a ``FriendlyDB``'s ``observer``
+    to attribute Redis round-trips to the request running in the current
+    thread (or greenlet, under gevent). Pass a different ``local`` (like
+    ``friendlydb.aio.TaskLocal()``) to track requests some other way.
+
+    Everything is plain counters & fixed buckets, so it's cheap enough to
+    leave on.
+    """
+    def __init__(self, local=None):
+        self.lock = threading.Lock()
+        self.local = local
+        self.routes = {}
+        self.in_flight = 0
+        self.started = time.time()
+
+        if self.local is None:
+            self.local = threading.local()
+
+    def start_request(self):
+        with self.lock:
+            self.in_flight += 1
+
+        self.local.request = RequestStats()
+
+    def observe_redis(self, commands, seconds, results=None):
+        request = getattr(self.local, 'request', None)
+
+        if request is not None:
+            request.redis_commands += len(commands)
+            request.redis_round_trips += 1
+            request.redis_seconds += seconds
+
+    def finish_request(self, route, status, seconds, response_bytes):
+        request = getattr(self.local, 'request', None) or RequestStats()
+        self.local.request = None
+
+        with self.lock:
+            self.in_flight -= 1
+            stats = self.routes.get(route)
+
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency.observe(seconds)
+            stats.response_bytes.observe(response_bytes)
+            stats.redis_commands.observe(request.redis_commands)
+            stats.redis_round_trips.observe(request.redis_round_trips)
+            stats.redis_seconds += request.redis_seconds
+
+    def as_dict(self, pool_stats=None):
+        routes = {}
+
+        with self.lock:
+            for route, stats in self.routes.items():
+                routes[route] = {
+                    'statuses': dict((str(status), count) for status, count in stats.statuses.items()),
+                    'latency_seconds': stats.latency.summary(),
+                    'response_bytes': stats.response_bytes.summary(),
+                    'redis_commands': stats.redis_commands.summary(),
+                    'redis_round_trips': stats.redis_round_trips.summary(),
+                    'redis_seconds': stats.redis_seconds,
+                }
+
+            results = {
+                'uptime_seconds': time.time() - self.started,
+                'in_flight': self.in_flight,
+                'routes': routes,
+            }
+
+        if pool_stats is not None:
+            results['pools'] = pool_stats
+
+        return results
+
+    def render_prometheus(self, pool_stats=None):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        def histograms(name, help_text, attr):
+            family(name, 'histogram', help_text)
+
+            for route, stats in routes:
+                histogram = getattr(stats, attr)
+
+                for bound, count in histogram.cumulative():
+                    lines.append('{0}_bucket{{route="{1}",le="{2}"}} {3}'.format(name, route, bound, count))
+
+                lines.append('{0}_sum{{route="{1}"}} {2}'.format(name, route, histogram.sum))
+                lines.append('{0}_count{{route="{1}"}} {2}'.format(name, route, histogram.count))
+
+        with self.lock:
+            routes = sorted((escape_label(route), stats) for route, stats in self.routes.items())
+
+            family('friendlydb_requests_total', 'counter', 'Requests handled, by route & status.')
+
+            for route, stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append('friendlydb_requests_total{{route="{0}",status="{1}"}} {2}'.format(route, status, count))
+
+            histograms('friendlydb_request_duration_seconds', 'Request latency.', 'latency')
+            histograms('friendlydb_response_bytes', 'Response body size.', 'response_bytes')
+            histograms('friendlydb_request_redis_commands', 'Redis commands sent per request.', 'redis_commands')
+            histograms('friendlydb_request_redis_round_trips', 'Redis round-trips per request.', 'redis_round_trips')
+            family('friendlydb_redis_seconds_total', 'counter', 'Time spent waiting on Redis.')
+
+            for route, stats in routes:
+                lines.append('friendlydb_redis_seconds_total{{route="{0}"}} {1}'.format(route, stats.redis_seconds))
+
+            family('friendlydb_requests_in_flight', 'gauge', 'Requests currently being handled.')
+            lines.append('friendlydb_requests_in_flight {0}'.format(self.in_flight))
+
+        if pool_stats:
+            family('friendlydb_redis_connections', 'gauge', 'Redis connections, by server & state.')
+
+            for pool in pool_stats:
+                for state in ('in_use', 'idle'):
+                    lines.append('friendlydb_redis_connections{{address="{0}",db="{1}",state="{2}"}} {3}'.format(
+                        escape_label(pool['address']), pool['db'], state, pool[state]
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
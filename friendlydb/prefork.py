@@ -0,0 +1,223 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import time
+
+
+# Shared with the server, so worker lifecycle & request logs end up together.
+log = logging.getLogger('friendlydb.server')
+
+
+class Worker(object):
+    def __init__(self, pid, heartbeat_fd, generation):
+        self.pid = pid
+        self.heartbeat_fd = heartbeat_fd
+        self.generation = generation
+        self.last_seen = time.time()
+        self.booted = False
+        self.stopping_since = None
+
+
+class Arbiter(object):
+    """
+    Pre-forks ``workers`` processes, each running ``run_worker(notify)``, &
+    keeps them running.
+
+    Workers must call ``notify()`` at least once a second (from their event
+    loop, so a wedged loop shows up); ones that are silent for ``timeout``
+    seconds are killed. Dead workers are replaced.
+
+    The master process handles these signals:
+
+    * ``HUP`` - graceful restart: starts a fresh set of workers, then sends
+      the old ones ``TERM``.
+    * ``TERM``/``INT`` - graceful shutdown: sends the workers ``TERM`` &
+      waits up to ``graceful_timeout`` seconds before killing them.
+
+    Workers should stop accepting connections on ``TERM`` & exit once their
+    in-flight requests are done.
+    """
+    def __init__(self, run_worker, workers=2, timeout=30, graceful_timeout=30):
+        self.run_worker = run_worker
+        self.worker_count = workers
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.generation = 0
+        self.signals = []
+        self.stopping = False
+        # Don't fork-bomb when workers die on startup.
+        self.spawn_delay = 0
+        self.next_spawn = 0
+
+    def log(self, message, level=logging.INFO):
+        log.log(level, message)
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.queue_signal)
+
+        self.log('Starting {0} workers.'.format(self.worker_count))
+
+        while True:
+            self.reap()
+            self.handle_signals()
+
+            if self.stopping:
+                if not self.workers:
+                    break
+            else:
+                self.spawn_missing()
+
+            self.kill_unresponsive()
+            self.wait(1.0)
+
+        self.log('All workers stopped.')
+
+    def queue_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def handle_signals(self):
+        while self.signals:
+            signum = self.signals.pop(0)
+
+            if signum == signal.SIGHUP and not self.stopping:
+                self.log('Restarting workers.')
+                self.generation += 1
+                self.next_spawn = 0
+                self.spawn_missing()
+                self.stop_workers(lambda worker: worker.generation < self.generation)
+            elif signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                self.log('Shutting down.')
+                self.stopping = True
+                self.stop_workers(lambda worker: True)
+
+    def spawn_missing(self):
+        current = [worker for worker in self.workers.values() if worker.generation == self.generation]
+
+        for i in range(self.worker_count - len(current)):
+            if time.time() < self.next_spawn:
+                return
+
+            self.spawn()
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid:
+            os.close(write_fd)
+            self.workers[pid] = Worker(pid, read_fd, self.generation)
+            return pid
+
+        # In the worker.
+        status = 0
+
+        try:
+            os.close(read_fd)
+
+            for worker in self.workers.values():
+                os.close(worker.heartbeat_fd)
+
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+
+            flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+            fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+            def notify():
+                try:
+                    os.write(write_fd, b'.')
+                except (IOError, OSError) as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+            self.run_worker(notify)
+        except Exception:
+            log.exception('Worker {0} crashed.'.format(os.getpid()))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop_workers(self, match):
+        now = time.time()
+
+        for worker in list(self.workers.values()):
+            if match(worker) and worker.stopping_since is None:
+                worker.stopping_since = now
+                self.signal(worker, signal.SIGTERM)
+
+    def signal(self, worker, signum):
+        try:
+            os.kill(worker.pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+
+                raise
+
+            if not pid:
+                break
+
+            worker = self.workers.pop(pid, None)
+
+            if worker is None:
+                continue
+
+            os.close(worker.heartbeat_fd)
+
+            if worker.stopping_since is not None:
+                continue
+
+            self.log('Worker {0} died unexpectedly (status {1}); replacing it.'.format(pid, status), logging.WARNING)
+
+            if not worker.booted:
+                # Back off (up to 30 seconds) while workers die on startup.
+                self.spawn_delay = min(max(self.spawn_delay * 2, 0.5), 30)
+                self.next_spawn = time.time() + self.spawn_delay
+
+    def kill_unresponsive(self):
+        now = time.time()
+
+        for worker in self.workers.values():
+            if worker.stopping_since is not None:
+                if now - worker.stopping_since > self.graceful_timeout:
+                    self.signal(worker, signal.SIGKILL)
+            elif now - worker.last_seen > self.timeout:
+                self.log('Worker {0} stopped responding; killing it.'.format(worker.pid), logging.WARNING)
+                worker.stopping_since = now
+                self.signal(worker, signal.SIGKILL)
+
+    def wait(self, seconds):
+        fds = [worker.heartbeat_fd for worker in self.workers.values()]
+
+        try:
+            ready = select.select(fds, [], [], seconds)[0]
+        except (IOError, OSError, select.error):
+            # Interrupted by a signal.
+            return
+
+        now = time.time()
+
+        for worker in self.workers.values():
+            if worker.heartbeat_fd in ready:
+                try:
+                    data = os.read(worker.heartbeat_fd, 4096)
+                except (IOError, OSError):
+                    continue
+
+                if data:
+                    worker.last_seen = now
+                    worker.booted = True
+                    self.spawn_delay = 0
@@ -4,31 +4,89 @@ from __future__ import print_function
 from gevent import monkey
 monkey.patch_all()
 
+import gevent
 from gevent import pywsgi
-import re
+from gevent.pool import Pool
+import cProfile
+import itertools
+import logging
+import os
+import random
+import signal
+import socket
+import time
 from friendlydb import get_version
+from friendlydb.backends import CrossShardError
 from friendlydb.db import FriendlyDB
+from friendlydb.metrics import Metrics
+from friendlydb.prefork import Arbiter
+from friendlydb.tracing import Tracer
+from friendlydb.web import (BadRequest, StreamedList, build_router, dump_json, finish_batch, get_int, get_list,
+                            is_streamed, parse_batch, parse_nodes, plan_batch, stream_json)
 try:
-    import simplejson as json
+    from urlparse import parse_qs
 except ImportError:
-    import json
+    from urllib.parse import parse_qs
 
 
 fdb = None
-
-
-class NotAllowed(Exception):
-    pass
+friends_cache_ttl = None
+# How many users to read (& send) at a time when streaming a big list.
+stream_batch_size = 1000
+# The most operations a single ``/_batch/`` request can run.
+batch_max_operations = 1000
+# Request metrics, served at ``/_stats/``.
+metrics = Metrics()
+# Requests slower than this many seconds get logged, with their Redis calls.
+slow_request_threshold = None
+tracer = Tracer()
+# Where per-request cProfile dumps go (``None`` turns profiling off).
+profile_dir = None
+# The fraction of requests to profile, on top of any sent with an
+# ``X-FriendlyDB-Profile: 1`` header.
+profile_rate = 0
+profiling = False
+log = logging.getLogger('friendlydb.server')
 
 
 def setup(options):
     # Feel gross about this but just sucking it up for now.
     global fdb
+    global friends_cache_ttl
+    global slow_request_threshold
+    global profile_dir
+    global profile_rate
+    nodes = None
+    replicas = None
+
+    if options.redis_nodes:
+        nodes = parse_nodes(options.redis_nodes)
+
+    if options.redis_replicas:
+        replicas = parse_nodes(options.redis_replicas)
+
     fdb = FriendlyDB(
         host=options.redis_host,
         port=options.redis_port,
-        db=options.redis_db
+        db=options.redis_db,
+        cache_size=options.cache_size,
+        cache_ttl=options.cache_ttl,
+        cache_channel=options.cache_channel,
+        nodes=nodes,
+        replicas=replicas,
+        read_your_writes=options.read_your_writes,
+        max_connections=options.max_connections,
+        pool_timeout=options.pool_timeout,
+        unix_socket_path=options.redis_socket,
+        socket_keepalive=options.socket_keepalive,
+        socket_timeout=options.socket_timeout,
+        observer=observe_redis,
+        change_feed_length=options.change_feed_length
     )
+    friends_cache_ttl = options.friends_cache_ttl
+    slow_request_threshold = options.slow_request_threshold
+    profile_dir = options.profile_dir
+    profile_rate = options.profile_rate
 
 
 # The HTTPs.
@@ -38,7 +96,13 @@ def _make_response(env, start_response, status, body=None):
     if body is None:
         body = {'message': 'ok'}
 
-    return [json.dumps(body)]
+    if is_streamed(body):
+        return stream_json(body)
+
+    return [dump_json(body)]
+
+def bad_request(env, start_response, body=None):
+    return _make_response(env, start_response, '400 BAD REQUEST', body)
 
 def not_found(env, start_response):
     return _make_response(env, start_response, '404 NOT FOUND', {'error': 'Not found.'})
@@ -55,51 +119,166 @@ def created(env, start_response, body=None):
 def accepted(env, start_response, body=None):
     return _make_response(env, start_response, '202 ACCEPTED', body)
 
-def _check_method(method, request_method):
-    if method.upper() != request_method:
-        raise NotAllowed()
+def not_implemented(env, start_response, body=None):
+    return _make_response(env, start_response, '501 NOT IMPLEMENTED', body)
+
+def text(env, start_response, body):
+    # For Prometheus.
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [body.encode('utf-8')]
+
+def _read_body(env):
+    try:
+        length = int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+
+    if length <= 0:
+        return ''
+
+    body = env['wsgi.input'].read(length)
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    return body
+
+def _list_or_stream(batches):
+    # Lists that fit in a single batch are sent as-is. Anything bigger gets
+    # streamed.
+    first = next(batches, [])
+    second = next(batches, None)
+
+    if second is None:
+        return first
+
+    return StreamedList(itertools.chain([first, second], batches))
 
 
 # The application itself.
-def index(request_method):
-    _check_method('GET', request_method)
+def index(request_method, query):
     return ok, {'version': get_version()}
 
-def user_detail(request_method, username):
-    _check_method('GET', request_method)
+def user_detail(request_method, query, username):
+    user = fdb[username]
+    return ok, {
+        'username': username,
+        'following': _list_or_stream(user.iter_following_batches(batch_size=stream_batch_size)),
+        'followers': _list_or_stream(user.iter_follower_batches(batch_size=stream_batch_size)),
+    }
+
+batch_methods = {
+    'following': 'iter_following_batches',
+    'followers': 'iter_follower_batches',
+}
+
+def _list_relations(user, key_type, query):
+    limit = get_int(query, 'limit', minimum=1)
+    offset = get_int(query, 'offset', 0)
+    since = get_int(query, 'since')
+    until = get_int(query, 'until')
+    cursor = query.get('cursor', [None])[0]
+    body = {'username': user.username}
+
+    if cursor is not None and offset:
+        raise BadRequest("The 'cursor' & 'offset' parameters can't be combined.")
+
+    if cursor is not None or (limit is not None and not offset):
+        if limit is None:
+            limit = 50
+
+        try:
+            body[key_type], body['cursor'] = getattr(user, key_type + '_page')(limit=limit, cursor=cursor, since=since, until=until)
+        except ValueError as e:
+            raise BadRequest(str(e))
+    elif limit is None and not offset:
+        # The whole list, which could be huge.
+        batches = getattr(user, batch_methods[key_type])(batch_size=stream_batch_size, since=since, until=until)
+        body[key_type] = _list_or_stream(batches)
+    else:
+        body[key_type] = getattr(user, key_type)(offset=offset, limit=limit, since=since, until=until)
+
+    return body
+
+def user_following(request_method, query, username):
+    user = fdb[username]
+    return ok, _list_relations(user, 'following', query)
+
+def user_followers(request_method, query, username):
+    user = fdb[username]
+    return ok, _list_relations(user, 'followers', query)
+
+def user_counts(request_method, query, username):
     user = fdb[username]
     return ok, {
         'username': username,
-        'following': user.following(),
-        'followers': user.followers(),
+        'counts': user.counts(),
+    }
+
+def counts_many(request_method, query):
+    return ok, {
+        'counts': fdb.counts_many(get_list(query, 'usernames')),
+    }
+
+def get_many(request_method, query):
+    fields = ('following', 'followers', 'counts')
+
+    if query.get('fields'):
+        fields = get_list(query, 'fields')
+
+    try:
+        users = fdb.get_many(get_list(query, 'usernames'), fields=fields, limit=get_int(query, 'limit', 50, minimum=1))
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+    return ok, {
+        'users': users,
     }
 
-def user_following(request_method, username):
-    _check_method('GET', request_method)
+def user_friends(request_method, query, username):
     user = fdb[username]
     return ok, {
         'username': username,
-        'following': user.following(),
+        'friends': user.friends(
+            limit=get_int(query, 'limit', minimum=1),
+            offset=get_int(query, 'offset', 0),
+            cache_ttl=friends_cache_ttl
+        ),
     }
 
-def user_followers(request_method, username):
-    _check_method('GET', request_method)
+def user_suggestions(request_method, query, username):
     user = fdb[username]
+
+    try:
+        suggestions = user.suggestions(limit=get_int(query, 'limit', 10, minimum=1))
+    except CrossShardError:
+        # The followed users' lists are spread across the Redis servers.
+        return not_implemented, {'error': "Suggestions aren't supported when sharded (with --redis_nodes)."}
+
     return ok, {
         'username': username,
-        'followers': user.followers(),
+        'suggestions': suggestions,
     }
 
-def user_friends(request_method, username):
-    _check_method('GET', request_method)
+def mutual_followers(request_method, query, username, other_username):
     user = fdb[username]
+
+    try:
+        followers = user.mutual_followers(
+            other_username,
+            limit=get_int(query, 'limit', minimum=1),
+            offset=get_int(query, 'offset', 0)
+        )
+    except CrossShardError:
+        return not_implemented, {'error': "Mutual followers aren't supported when sharded (with --redis_nodes)."}
+
     return ok, {
         'username': username,
-        'friends': list(user.friends()),
+        'other_username': other_username,
+        'mutual_followers': followers,
     }
 
-def follow(request_method, username, other_username):
-    _check_method('POST', request_method)
+def follow(request_method, query, username, other_username):
     user = fdb[username]
     return created, {
         'username': username,
@@ -107,8 +286,7 @@ def follow(request_method, username, other_username):
         'followed': user.follow(other_username),
     }
 
-def unfollow(request_method, username, other_username):
-    _check_method('POST', request_method)
+def unfollow(request_method, query, username, other_username):
     user = fdb[username]
     return created, {
         'username': username,
@@ -116,8 +294,7 @@ def unfollow(request_method, username, other_username):
         'unfollowed': user.unfollow(other_username),
     }
 
-def is_following(request_method, username, other_username):
-    _check_method('GET', request_method)
+def is_following(request_method, query, username, other_username):
     user = fdb[username]
     return created, {
         'username': username,
@@ -125,8 +302,7 @@ def is_following(request_method, username, other_username):
         'is_following': user.is_following(other_username),
     }
 
-def is_followed_by(request_method, username, other_username):
-    _check_method('GET', request_method)
+def is_followed_by(request_method, query, username, other_username):
     user = fdb[username]
     return created, {
         'username': username,
@@ -134,42 +310,253 @@ def is_followed_by(request_method, username, other_username):
         'is_followed_by': user.is_followed_by(other_username),
     }
 
+def is_following_many(request_method, query, username):
+    user = fdb[username]
+    return ok, {
+        'username': username,
+        'is_following': user.is_following_many(get_list(query, 'usernames')),
+    }
+
+def is_followed_by_many(request_method, query, username):
+    user = fdb[username]
+    return ok, {
+        'username': username,
+        'is_followed_by': user.is_followed_by_many(get_list(query, 'usernames')),
+    }
+
+def batch(request_method, query, body=None):
+    # Everything goes out in a single pipeline (see ``friendlydb.web``).
+    ops = parse_batch(body, batch_max_operations)
+    pipe = fdb.backend.pipeline()
+    touched_keys, pending = plan_batch(fdb, pipe, ops)
+    results = []
+
+    if len(pipe):
+        if fdb.cache is not None:
+            fdb.cache.publish(pipe, touched_keys)
+
+        results = pipe.execute()
+
+        if fdb.cache is not None:
+            fdb.cache.invalidate(touched_keys)
+
+    return ok, {
+        'results': finish_batch(pending, results),
+    }
+
+# Read the request body for ``batch``.
+batch.reads_body = True
+
+def stats(request_method, query):
+    pool_stats = None
+
+    if fdb is not None:
+        pool_stats = fdb.pool_stats()
+
+    if query.get('format', [''])[0] == 'json':
+        return ok, metrics.as_dict(pool_stats)
+
+    return text, metrics.render_prometheus(pool_stats)
+
+router = build_router(globals())
+
+
+def observe_redis(commands, seconds, results):
+    metrics.observe_redis(commands, seconds, results)
+    tracer.observe(commands, seconds, results)
+
+def _start_profile(env):
+    # Profiles one request at a time, when asked for with the header or
+    # sampled.
+    global profiling
+
+    if profile_dir is None or profiling:
+        return None
+
+    if env.get('HTTP_X_FRIENDLYDB_PROFILE') != '1' and random.random() >= profile_rate:
+        return None
+
+    profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _finish_request(request, response_bytes):
+    global profiling
+    seconds = time.time() - request['started']
+    # ``status`` is the status line, once the response has started.
+    code = 500
+
+    if request['status']:
+        code = int(request['status'].split(' ', 1)[0])
+
+    metrics.finish_request(request['route'], code, seconds, response_bytes)
+    trace = None
+
+    if request['traced']:
+        trace = tracer.stop()
+
+    if request['profiler'] is not None:
+        request['profiler'].disable()
+        profiling = False
+        filename = '{0}-{1}-{2}.prof'.format(int(request['started'] * 1000), request['route'], os.getpid())
+        request['profiler'].dump_stats(os.path.join(profile_dir, filename))
+        log.info('Profiled %s %s to %s.', request['method'], request['path'], os.path.join(profile_dir, filename))
+
+    if trace is not None and seconds >= slow_request_threshold:
+        lines = ['Slow request: {0} {1} ({2}, username {3}) took {4:.3f}s with status {5}, {6} Redis commands in {7} round-trips ({8:.3f}s):'.format(
+            request['method'],
+            request['path'],
+            request['route'],
+            request['username'],
+            seconds,
+            code,
+            trace.command_count(),
+            len(trace.round_trips),
+            trace.redis_seconds()
+        )]
+        lines.extend('    ' + line for line in trace.format())
+        log.warning('\n'.join(lines))
+
+def _measure_stream(chunks, request):
+    response_bytes = 0
+
+    try:
+        for chunk in chunks:
+            response_bytes += len(chunk)
+            yield chunk
+    finally:
+        _finish_request(request, response_bytes)
 
 def application(env, start_response):
-    paths = (
-        ('^/$', index),
-        ('^/(?P<username>[\w\d._-]+)/?$', user_detail),
-        ('^/(?P<username>[\w\d._-]+)/following/?$', user_following),
-        ('^/(?P<username>[\w\d._-]+)/followers/?$', user_followers),
-        ('^/(?P<username>[\w\d._-]+)/friends/?$', user_friends),
-        ('^/(?P<username>[\w\d._-]+)/follow/(?P<other_username>[\w\d._-]+)/?$', follow),
-        ('^/(?P<username>[\w\d._-]+)/unfollow/(?P<other_username>[\w\d._-]+)/?$', unfollow),
-        ('^/(?P<username>[\w\d._-]+)/is_following/(?P<other_username>[\w\d._-]+)/?$', is_following),
-        ('^/(?P<username>[\w\d._-]+)/is_followed_by/(?P<other_username>[\w\d._-]+)/?$', is_followed_by),
-    )
+    request = {
+        'started': time.time(),
+        'method': env.get('REQUEST_METHOD', 'GET').upper(),
+        'path': env.get('PATH_INFO', '/'),
+        # Filled in by ``dispatch``.
+        'route': None,
+        'username': None,
+        'status': None,
+        'traced': slow_request_threshold is not None,
+        'profiler': _start_profile(env),
+    }
+    metrics.start_request()
+
+    if request['traced']:
+        tracer.start()
 
-    request_path = env.get('PATH_INFO', '/')
-    request_method = env.get('REQUEST_METHOD', 'GET').upper()
+    def measured_start_response(status, headers, exc_info=None):
+        request['status'] = status
+        return start_response(status, headers, exc_info)
 
-    for path_re, handler in paths:
-        if re.match(path_re, request_path):
-            url_match = re.search(path_re, request_path)
-            url_params = {}
+    try:
+        response = dispatch(env, measured_start_response, request)
+    except Exception:
+        request['status'] = None
+        _finish_request(request, 0)
+        raise
 
-            if hasattr(url_match, 'groupdict'):
-                url_params = url_match.groupdict()
+    if isinstance(response, list):
+        _finish_request(request, sum(len(chunk) for chunk in response))
+        return response
 
-            try:
-                resp_func, body = handler(request_method, **url_params)
-            except NotAllowed:
-                return not_allowed(env, start_response)
-            except TypeError:
-                return not_found(env, start_response)
+    return _measure_stream(response, request)
 
-            return resp_func(env, start_response, body)
+def dispatch(env, start_response, request):
+    handlers, url_params = router.match(request['path'])
 
-    # Nothing matched. 404'd!
-    return not_found(env, start_response)
+    if handlers is None:
+        request['route'] = 'not_found'
+        return not_found(env, start_response)
+
+    request_method = request['method']
+    handler = handlers.get(request_method)
+
+    if handler is None:
+        request['route'] = 'not_allowed'
+        return not_allowed(env, start_response)
+
+    request['route'] = handler.__name__
+    request['username'] = url_params.get('username')
+
+    query = parse_qs(env.get('QUERY_STRING', ''))
+
+    if getattr(handler, 'reads_body', False):
+        url_params['body'] = _read_body(env)
+
+    try:
+        resp_func, body = handler(request_method, query, **url_params)
+    except BadRequest as e:
+        return bad_request(env, start_response, {'error': str(e)})
+
+    return resp_func(env, start_response, body)
+
+
+# Serving.
+class Handler(pywsgi.WSGIHandler):
+    def handle(self):
+        # ``pywsgi`` writes the headers & the body separately, so with
+        # Nagle's algorithm on, each response on a keep-alive connection
+        # waits out the client's delayed ACK (~40ms).
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return pywsgi.WSGIHandler.handle(self)
+
+def make_listener(host, port, reuse_port=False):
+    family, socktype, proto, canonname, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    listener = socket.socket(family, socktype, proto)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuse_port:
+        # Each worker gets its own socket & the kernel spreads connections
+        # across them.
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    listener.bind(address)
+    listener.listen(1024)
+    return listener
+
+def serve(listener, graceful_timeout=30, notify=None):
+    # (``stop`` only waits for requests handled through a pool.)
+    server = pywsgi.WSGIServer(listener, application, spawn=Pool(), handler_class=Handler)
+    server.stop_timeout = graceful_timeout
+    # ``TERM`` stops accepting connections & lets in-flight requests finish.
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGTERM, server.stop)
+
+    if notify is not None:
+        def heartbeat():
+            while True:
+                notify()
+                gevent.sleep(1)
+
+        gevent.spawn(heartbeat)
+
+    server.serve_forever()
+
+def serve_workers(options):
+    # Only the listening socket is shared. Each worker sets up its own Redis
+    # connections after the fork.
+    listener = None
+
+    if not options.reuse_port:
+        listener = make_listener(options.host, options.port)
+
+    def run_worker(notify):
+        worker_listener = listener
+
+        if worker_listener is None:
+            worker_listener = make_listener(options.host, options.port, reuse_port=True)
+
+        setup(options)
+        serve(worker_listener, options.graceful_timeout, notify)
+
+    arbiter = Arbiter(
+        run_worker,
+        workers=options.workers,
+        timeout=options.worker_timeout,
+        graceful_timeout=options.graceful_timeout
+    )
+    arbiter.run()
 
 
 if __name__ == '__main__':
@@ -179,19 +566,41 @@ if __name__ == '__main__':
     parser.add_option("--redis_host", dest="redis_host", default='localhost', help="The hostname Redis is running on.")
     parser.add_option("--redis_port", dest="redis_port", type="int", default=6379, help="The port Redis is running on.")
     parser.add_option("--redis_db", dest="redis_db", type="int", default=0, help="The db within Redis to use.")
+    parser.add_option("--redis_nodes", dest="redis_nodes", default=None, help="Shard the data across several Redis servers, as 'host:port/db,host:port/db,...'. Overrides the other --redis_* options.")
+    parser.add_option("--redis_replicas", dest="redis_replicas", default=None, help="Read replicas of the Redis server, as 'host:port/db,host:port/db,...'.")
+    parser.add_option("--read_your_writes", dest="read_your_writes", type="float", default=None, help="Seconds to read a changed user from the primary rather than a replica. Default: no pinning")
+    parser.add_option("--redis_socket", dest="redis_socket", default=None, help="Connect to Redis over this unix socket, rather than TCP.")
+    parser.add_option("--max_connections", dest="max_connections", type="int", default=None, help="The most connections to open to each Redis server. Default: unlimited (50 with --pool_timeout)")
+    parser.add_option("--pool_timeout", dest="pool_timeout", type="float", default=None, help="Seconds a request waits for a free Redis connection before erroring. Default: don't wait")
+    parser.add_option("--socket_keepalive", dest="socket_keepalive", action="store_true", default=False, help="Turn on TCP keepalive for the Redis connections.")
+    parser.add_option("--socket_timeout", dest="socket_timeout", type="float", default=None, help="Seconds to wait on a Redis reply. Default: forever")
+    parser.add_option("--friends_cache_ttl", dest="friends_cache_ttl", type="int", default=None, help="Seconds to cache each user's friends for. Default: no caching")
+    parser.add_option("--cache_size", dest="cache_size", type="int", default=None, help="How many users' lists to cache in-process. Default: no caching")
+    parser.add_option("--cache_ttl", dest="cache_ttl", type="int", default=60, help="Seconds to cache each list for. Default: 60")
+    parser.add_option("--change_feed_length", dest="change_feed_length", type="int", default=None, help="Record follows/unfollows/deletes in a change feed (a Redis stream) of about this many events. Default: off")
+    parser.add_option("--cache_channel", dest="cache_channel", default=None, help="A Redis pub/sub channel to share cache invalidations over, when running several servers.")
     parser.add_option("-H", "--host", dest="host", default='127.0.0.1', help="Choose the host IP/domain name to run the service on. Default: '127.0.0.1'")
     parser.add_option("-p", "--port", dest="port", type="int", default=8008, help="Choose the port to run the service on. Default: 8008")
+    parser.add_option("--slow_request_threshold", dest="slow_request_threshold", type="float", default=None, help="Log requests taking longer than this many seconds, with the Redis commands they ran. Default: off")
+    parser.add_option("--profile_dir", dest="profile_dir", default=None, help="Allow profiling requests (sent with an 'X-FriendlyDB-Profile: 1' header or sampled), writing cProfile dumps here.")
+    parser.add_option("--profile_rate", dest="profile_rate", type="float", default=0, help="The fraction of requests to profile (with --profile_dir). Default: 0")
+    parser.add_option("--workers", dest="workers", type="int", default=1, help="Pre-fork this many worker processes (HUP restarts them gracefully). Default: 1")
+    parser.add_option("--worker_timeout", dest="worker_timeout", type="int", default=30, help="Seconds a worker can go unresponsive before it's killed & replaced. Default: 30")
+    parser.add_option("--graceful_timeout", dest="graceful_timeout", type="int", default=30, help="Seconds stopping workers get to finish their requests. Default: 30")
+    parser.add_option("--reuse_port", dest="reuse_port", action="store_true", default=False, help="Give each worker its own listening socket (SO_REUSEPORT), rather than sharing one.")
     (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
 
-    # Set up the DB.
-    setup(options)
-
-    # Start handling requests.
     print("Welcome to FriendlyDB (v{0})!".format(get_version()))
     print("Serving on http://{0}:{1}...".format(options.host, options.port))
-    server = pywsgi.WSGIServer((options.host, options.port), application)
 
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("Shutting down. Have a nice day!")
+    if options.workers > 1:
+        serve_workers(options)
+    else:
+        # Set up the DB.
+        setup(options)
+
+        try:
+            serve(make_listener(options.host, options.port), options.graceful_timeout)
+        except KeyboardInterrupt:
+            print("Shutting down. Have a nice day!")
@@ -0,0 +1,107 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+def reply_size(result):
+    # How many items a Redis reply held.
+    if result is None:
+        return 0
+
+    if isinstance(result, (list, tuple, dict, set)):
+        return len(result)
+
+    return 1
+
+
+def format_command(name, args, max_length=80):
+    arguments = ', '.join(repr(arg) for arg in args)
+
+    if len(arguments) > max_length:
+        arguments = arguments[:max_length - 3] + '...'
+
+    return '{0}({1})'.format(name, arguments)
+
+
+class Trace(object):
+    """
+    The Redis round-trips made during a request (or any other block of code).
+
+    ``round_trips`` is a list of ``(commands, seconds, reply sizes)``, where
+    ``commands`` is a list of ``(operation, args)``. The reply sizes are
+    ``None`` if the round-trip failed.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.round_trips = []
+
+    def record(self, commands, seconds, results):
+        sizes = None
+
+        if results is not None:
+            sizes = [reply_size(result) for result in results]
+
+        self.round_trips.append((commands, seconds, sizes))
+
+    def redis_seconds(self):
+        return sum(seconds for commands, seconds, sizes in self.round_trips)
+
+    def command_count(self):
+        return sum(len(commands) for commands, seconds, sizes in self.round_trips)
+
+    def format(self):
+        """
+        One line per round-trip, like
+        ``1.20ms  range('daniel::following') -> 50``.
+        """
+        lines = []
+
+        for commands, seconds, sizes in self.round_trips:
+            if sizes is None:
+                sizes = ['error'] * len(commands)
+
+            described = ', '.join('{0} -> {1}'.format(format_command(name, args), size) for (name, args), size in zip(commands, sizes))
+            lines.append('{0:8.2f}ms  {1}'.format(seconds * 1000, described))
+
+        return lines
+
+
+class Tracer(object):
+    """
+    Collects a ``Trace`` of the Redis round-trips made by the current
+    thread (or greenlet, under gevent).
+
+    Pass ``observe`` as a ``FriendlyDB``'s ``observer``, then::
+
+        with tracer.trace() as trace:
+            fdb['daniel'].friends()
+
+        print('\\n'.join(trace.format()))
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self):
+        trace = Trace()
+        self.local.trace = trace
+        return trace
+
+    def stop(self):
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        return trace
+
+    @contextmanager
+    def trace(self):
+        trace = self.start()
+
+        try:
+            yield trace
+        finally:
+            self.stop()
+
+    def observe(self, commands, seconds, results):
+        trace = getattr(self.local, 'trace', None)
+
+        if trace is not None:
+            trace.record(commands, seconds, results)
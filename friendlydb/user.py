@@ -1,23 +1,63 @@
 import datetime
 import redis
+import threading
 import time
 from friendlydb import SEPARATOR
+from friendlydb.backends import RedisBackend
+
+
+# Shared by every ``FriendlyUser`` created without a connection, so they
+# don't each open their own.
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def default_backend():
+    global _default_backend
+
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = RedisBackend(redis.StrictRedis(host='localhost', port=6379, db=0))
+
+        return _default_backend
+
+
+def planned(pipe, planner, *args, **kwargs):
+    """
+    Calls ``planner`` to queue its commands onto ``pipe``.
+
+    ``planner`` returns a function that builds its answer from the results
+    of just the commands it queued. This returns a function that does the
+    same from the results of the whole pipeline, so several plans can share
+    one round-trip without knowing how many commands each queues.
+    """
+    start = len(pipe)
+    finish = planner(pipe, *args, **kwargs)
+    end = len(pipe)
+    return lambda results: finish(results[start:end])
 
 
 class FriendlyUser(object):
-    def __init__(self, username, conn=None, separator=None):
+    def __init__(self, username, conn=None, separator=None, cache=None, backend=None, change_feed_length=None):
         self.username = username
         self.conn = conn
         self.separator = separator
+        self.cache = cache
+        self.backend = backend
+        self.change_feed_length = change_feed_length
 
         if self.separator is None:
             self.separator = SEPARATOR
 
+        if self.backend is None and self.conn is not None:
+            self.backend = RedisBackend(self.conn)
+
         self.is_setup = False
 
     def setup(self):
-        if self.conn is None:
-            self.conn = redis.StrictRedis(host='localhost', port=6379, db=0)
+        if self.backend is None:
+            self.backend = default_backend()
+            self.conn = self.backend.conn
 
         self.is_setup = True
 
@@ -33,97 +73,573 @@ class FriendlyUser(object):
         return self.separator.join([username, key_type])
 
     def convert_time_to_datetime(self, the_time):
-        return datetime.datetime.fromtimestamp(the_time.time())
+        return datetime.datetime.fromtimestamp(the_time)
 
     def current_time_score(self):
         return int(time.time())
 
     # End-user methods!
 
-    def following(self, with_dates=False):
-        following = []
+    def encode_cursor(self, score, skip):
+        return '{0!r}:{1}'.format(float(score), skip)
 
-        for follow_info in self.conn.zrevrange(self.generate_key(self.username, 'following'), 0, -1, withscores=True):
-            if not with_dates:
-                following.append(follow_info[0])
-            else:
-                following.append({
-                    'username': follow_info[0],
-                    'followed_on': self.convert_time_to_datetime(follow_info[1]),
-                })
+    def decode_cursor(self, cursor):
+        try:
+            score, skip = cursor.rsplit(':', 1)
+            return float(score), int(skip)
+        except (AttributeError, ValueError):
+            raise ValueError("Invalid cursor '{0}'.".format(cursor))
+
+    def _fetch(self, key_type, offset=0, limit=None, since=None, until=None):
+        key = self.generate_key(self.username, key_type)
+        return self.backend.range(key, offset=offset, limit=limit, min_score=since, max_score=until)
+
+    def _cached_fetch(self, key_type, offset=0, limit=None, since=None, until=None):
+        if self.cache is None:
+            return self._fetch(key_type, offset=offset, limit=limit, since=since, until=until)
+
+        key = self.generate_key(self.username, key_type)
+        variant = (offset, limit, since, until)
+        follow_infos = self.cache.get(key, variant)
+
+        if follow_infos is None:
+            follow_infos = self._fetch(key_type, offset=offset, limit=limit, since=since, until=until)
+            self.cache.set(key, variant, follow_infos)
+
+        return follow_infos
 
-        return following
+    def _execute(self, pipe, touched_keys):
+        # Writes go through here, so any cached reads of the keys they touch
+        # get thrown out (everywhere, if there's an invalidation channel).
+        if self.cache is None:
+            return pipe.execute()
 
-    def followers(self, with_dates=False):
-        followers = []
+        self.cache.publish(pipe, touched_keys)
+        results = pipe.execute()
+        self.cache.invalidate(touched_keys)
+        return results
 
-        for follow_info in self.conn.zrevrange(self.generate_key(self.username, 'followers'), 0, -1, withscores=True):
+    def _format(self, follow_infos, with_dates=False):
+        results = []
+
+        for follow_info in follow_infos:
             if not with_dates:
-                followers.append(follow_info[0])
+                results.append(follow_info[0])
             else:
-                followers.append({
+                results.append({
                     'username': follow_info[0],
                     'followed_on': self.convert_time_to_datetime(follow_info[1]),
                 })
 
-        return followers
+        return results
+
+    def _list(self, pipe, key_type, offset=0, limit=None, since=None, until=None, with_dates=False):
+        key = self.generate_key(self.username, key_type)
+        pipe.range(key, offset=offset, limit=limit, min_score=since, max_score=until)
+        return lambda results: self._format(results[0], with_dates=with_dates)
+
+    def _page_start(self, cursor, until):
+        # Where a page starts, as ``(offset, until)``.
+        if cursor is None:
+            return 0, until
+
+        # The cursor is the score of the last item seen & how many items with
+        # exactly that score have been seen, so the next page picks up in the
+        # right spot even when lots of follows share a second.
+        until, offset = self.decode_cursor(cursor)
+        return offset, until
+
+    def _page(self, key_type, limit=50, cursor=None, since=None, until=None):
+        offset, until = self._page_start(cursor, until)
+        follow_infos = self._fetch(key_type, offset=offset, limit=limit, since=since, until=until)
+        return follow_infos, self._next_cursor(follow_infos, limit, offset, until)
+
+    def _next_cursor(self, follow_infos, limit, offset, until):
+        if not follow_infos or len(follow_infos) < limit:
+            return None
+
+        last_score = follow_infos[-1][1]
+        skip = 0
+
+        for follow_info in reversed(follow_infos):
+            if follow_info[1] != last_score:
+                break
+
+            skip += 1
+
+        if skip == len(follow_infos) and last_score == until:
+            skip += offset
+
+        return self.encode_cursor(last_score, skip)
+
+    def following(self, with_dates=False, offset=0, limit=None, since=None, until=None):
+        """
+        Returns who the user is following, most recent first.
+
+        ``offset``/``limit`` page through the results & ``since``/``until``
+        (inclusive timestamps) restrict them to a window of time.
+        """
+        follow_infos = self._cached_fetch('following', offset=offset, limit=limit, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates)
+
+    def followers(self, with_dates=False, offset=0, limit=None, since=None, until=None):
+        """
+        Returns who is following the user, most recent first.
+
+        Takes the same options as ``following``.
+        """
+        follow_infos = self._cached_fetch('followers', offset=offset, limit=limit, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates)
+
+    def following_page(self, limit=50, cursor=None, with_dates=False, since=None, until=None):
+        """
+        Returns a page of who the user is following, most recent first.
+
+        Returns a tuple of ``(results, cursor)``. Pass the cursor back in to
+        get the next page. It will be ``None`` once there are no more pages.
+        """
+        follow_infos, next_cursor = self._page('following', limit=limit, cursor=cursor, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates), next_cursor
+
+    def followers_page(self, limit=50, cursor=None, with_dates=False, since=None, until=None):
+        """
+        Returns a page of who is following the user, most recent first.
+
+        Works just like ``following_page``.
+        """
+        follow_infos, next_cursor = self._page('followers', limit=limit, cursor=cursor, since=since, until=until)
+        return self._format(follow_infos, with_dates=with_dates), next_cursor
+
+    def _iter_batches(self, key_type, batch_size=1000, with_dates=False, since=None, until=None):
+        cursor = None
+
+        while True:
+            follow_infos, cursor = self._page(key_type, limit=batch_size, cursor=cursor, since=since, until=until)
+
+            if follow_infos:
+                yield self._format(follow_infos, with_dates=with_dates)
+
+            if cursor is None:
+                return
+
+    def iter_following_batches(self, batch_size=1000, with_dates=False, since=None, until=None):
+        """
+        Walks who the user is following, most recent first, yielding lists
+        of up to ``batch_size`` at a time.
+
+        Only one batch is held in memory at once, no matter how many users
+        there are. Each batch is independent, so they can be handed off to
+        workers (say, a ``gevent.pool.Pool``) as they arrive.
+        """
+        return self._iter_batches('following', batch_size=batch_size, with_dates=with_dates, since=since, until=until)
+
+    def iter_follower_batches(self, batch_size=1000, with_dates=False, since=None, until=None):
+        """
+        Walks who is following the user, most recent first, yielding lists
+        of up to ``batch_size`` at a time.
+
+        Works just like ``iter_following_batches``.
+        """
+        return self._iter_batches('followers', batch_size=batch_size, with_dates=with_dates, since=since, until=until)
+
+    def iter_following(self, batch_size=1000, with_dates=False, since=None, until=None):
+        """
+        Iterates over who the user is following, most recent first, fetching
+        ``batch_size`` at a time behind the scenes.
+        """
+        for batch in self.iter_following_batches(batch_size=batch_size, with_dates=with_dates, since=since, until=until):
+            for following in batch:
+                yield following
+
+    def iter_followers(self, batch_size=1000, with_dates=False, since=None, until=None):
+        """
+        Iterates over who is following the user, most recent first, fetching
+        ``batch_size`` at a time behind the scenes.
+        """
+        for batch in self.iter_follower_batches(batch_size=batch_size, with_dates=with_dates, since=since, until=until):
+            for follower in batch:
+                yield follower
+
+    def _friend_count(self, pipe):
+        # Counted without storing the intersection, so it's a read (which a
+        # replica can answer).
+        pipe.intersect_card([
+            self.generate_key(self.username, 'following'),
+            self.generate_key(self.username, 'followers'),
+        ])
+        return lambda results: results[0]
+
+    def _counts(self, pipe):
+        # Queues the counts. Like all the ``_*`` planners, returns a function
+        # that turns the results of the commands queued here into the answer
+        # (see ``planned``).
+        pipe.card(self.generate_key(self.username, 'following'))
+        pipe.card(self.generate_key(self.username, 'followers'))
+        friend_count = self._friend_count(pipe)
+
+        def finish(results):
+            return {
+                'following': results[0],
+                'followers': results[1],
+                'friends': friend_count(results[2:]),
+            }
+
+        return finish
+
+    def following_count(self):
+        return self.backend.card(self.generate_key(self.username, 'following'))
+
+    def follower_count(self):
+        return self.backend.card(self.generate_key(self.username, 'followers'))
+
+    def friend_count(self):
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._friend_count)
+        return finish(pipe.execute())
+
+    def counts(self):
+        """
+        Returns how many users the user is following, is followed by & is
+        friends with, in a single round-trip.
+        """
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._counts)
+        return finish(pipe.execute())
+
+    def _record_change(self, pipe, change_type, other_username, time_score):
+        # Appends an event to the change feed (if it's on), in the same
+        # pipeline as the write itself.
+        if not self.change_feed_length:
+            return
+
+        pipe.stream_add(self.generate_key('', 'changes'), {
+            'type': change_type,
+            'username': self.username,
+            'other_username': other_username or '',
+            'time': time_score,
+        }, max_length=self.change_feed_length)
+
+    def _follow(self, pipe, username, time_score):
+        # Add to our following & make sure the change is reflected in their
+        # followers. Returns the keys touched.
+        following_key = self.generate_key(self.username, 'following')
+        followers_key = self.generate_key(username, 'followers')
+        pipe.add(following_key, username, time_score)
+        pipe.add(followers_key, self.username, time_score)
+        self._record_change(pipe, 'follow', username, time_score)
+        return [following_key, followers_key]
+
+    def _unfollow(self, pipe, username):
+        # Remove from our following & make sure the change is reflected in
+        # their followers. Returns the keys touched.
+        following_key = self.generate_key(self.username, 'following')
+        followers_key = self.generate_key(username, 'followers')
+        pipe.remove(following_key, username)
+        pipe.remove(followers_key, self.username)
+        self._record_change(pipe, 'unfollow', username, self.current_time_score())
+        return [following_key, followers_key]
 
     def follow(self, username):
         if self.username == username:
             return False
 
-        # Add to our following.
-        key = self.generate_key(self.username,'following')
-        time_score = self.current_time_score()
-        self.conn.zadd(key, time_score, username)
-
-        # Make sure the change is reflected in their followers.
-        key = self.generate_key(username,'followers')
-        time_score = self.current_time_score()
-        self.conn.zadd(key, time_score, self.username)
-
+        # Both sides of the edge go out in a single MULTI/EXEC, so there's one
+        # round-trip & no half-written edges.
+        pipe = self.backend.pipeline()
+        touched_keys = self._follow(pipe, username, self.current_time_score())
+        self._execute(pipe, touched_keys)
         return True
 
     def unfollow(self, username):
         if self.username == username:
             return False
 
-        # Remove from our following.
-        key = self.generate_key(self.username,'following')
-        self.conn.zrem(key, username)
+        pipe = self.backend.pipeline()
+        touched_keys = self._unfollow(pipe, username)
+        self._execute(pipe, touched_keys)
+        return True
 
-        # Make sure the change is reflected in their followers.
-        key = self.generate_key(username,'followers')
-        self.conn.zrem(key, self.username)
+    def _many(self, pipe, usernames, plan):
+        # Queues ``plan(pipe, username)`` for each username (but the user's
+        # own). Returns the ``username => bool`` results & the keys touched.
+        results = {}
+        touched_keys = set()
 
-        return True
+        for username in usernames:
+            if self.username == username:
+                results[username] = False
+                continue
 
-    def is_following(self, username):
-        following = self.following()
-        return username in following
+            touched_keys.update(plan(pipe, username))
+            results[username] = True
 
-    def is_followed_by(self, username):
-        followers = self.followers()
-        return username in followers
+        return results, touched_keys
+
+    def follow_many(self, usernames):
+        """
+        Follows all of the given usernames in a single round-trip.
+
+        Returns a dictionary of ``username => bool``, ``False`` meaning the
+        username was skipped (like trying to follow yourself).
+        """
+        time_score = self.current_time_score()
+        pipe = self.backend.pipeline()
+        results, touched_keys = self._many(pipe, usernames, lambda pipe, username: self._follow(pipe, username, time_score))
+        self._execute(pipe, touched_keys)
+        return results
 
-    def friends(self):
-        following = set(self.following())
-        followers = set(self.followers())
-        return following.intersection(followers)
+    def unfollow_many(self, usernames):
+        """
+        Unfollows all of the given usernames in a single round-trip.
 
-    def delete(self):
-        following = self.following()
-        followers = self.followers()
+        Returns a dictionary of ``username => bool``, like ``follow_many``.
+        """
+        pipe = self.backend.pipeline()
+        results, touched_keys = self._many(pipe, usernames, self._unfollow)
+        self._execute(pipe, touched_keys)
+        return results
 
-        for follow in following:
-            self.unfollow(follow)
+    def _has_members(self, pipe, key_type, usernames):
+        # One score lookup per username. Finishes as ``username => bool``.
+        usernames = list(usernames)
+        key = self.generate_key(self.username, key_type)
 
-        for follower in followers:
-            other = self.__class__(follower, conn=self.conn, separator=self.separator)
-            other.unfollow(self.username)
+        for username in usernames:
+            pipe.score(key, username)
 
-        # Finally, remove the keys.
-        self.conn.delete(self.generate_key(self.username, 'following'))
-        self.conn.delete(self.generate_key(self.username, 'followers'))
+        return lambda results: dict((username, score is not None) for username, score in zip(usernames, results))
+
+    def is_following(self, username):
+        key = self.generate_key(self.username, 'following')
+        return self.backend.score(key, username) is not None
+
+    def is_followed_by(self, username):
+        key = self.generate_key(self.username, 'followers')
+        return self.backend.score(key, username) is not None
+
+    def is_following_many(self, usernames):
+        """
+        Checks if the user is following each of the given usernames in a
+        single round-trip.
+
+        Returns a dictionary of ``username => bool``.
+        """
+        pipe = self.backend.pipeline(transaction=False)
+        finish = planned(pipe, self._has_members, 'following', usernames)
+        return finish(pipe.execute())
+
+    def is_followed_by_many(self, usernames):
+        """
+        Checks if the user is followed by each of the given usernames in a
+        single round-trip.
+
+        Returns a dictionary of ``username => bool``.
+        """
+        pipe = self.backend.pipeline(transaction=False)
+        finish = planned(pipe, self._has_members, 'followers', usernames)
+        return finish(pipe.execute())
+
+    def _friends(self, pipe, limit=None, offset=0):
+        # A friendship is as recent as the newer of the two follows.
+        pipe.intersect_range([
+            self.generate_key(self.username, 'following'),
+            self.generate_key(self.username, 'followers'),
+        ], offset=offset, limit=limit, aggregate='max')
+        return lambda results: self._format(results[0])
+
+    def _cached_friends(self, pipe, limit=None, offset=0):
+        friends_key = self.generate_key(self.username, 'friends')
+        pipe.exists(friends_key)
+        pipe.range(friends_key, offset=offset, limit=limit)
+
+        def finish(results):
+            # ``None`` if there's nothing cached.
+            if not results[0]:
+                return None
+
+            return self._format(results[1])
+
+        return finish
+
+    def _cache_friends(self, pipe, limit=None, offset=0, cache_ttl=None):
+        friends_key = self.generate_key(self.username, 'friends')
+        pipe.intersect(friends_key, [
+            self.generate_key(self.username, 'following'),
+            self.generate_key(self.username, 'followers'),
+        ], aggregate='max')
+        pipe.range(friends_key, offset=offset, limit=limit)
+        pipe.expire(friends_key, cache_ttl)
+        return lambda results: self._format(results[1])
+
+    def friends(self, limit=None, offset=0, cache_ttl=None):
+        """
+        Returns the users who both follow & are followed by the user, most
+        recent mutual follow first.
+
+        The intersection is computed by the backend (inside Redis, by
+        default) without storing it, so it can be answered by a read
+        replica. If ``cache_ttl`` is given, the result is kept around for
+        that many seconds & reused by subsequent calls (so it may be up to
+        ``cache_ttl`` seconds stale). Storing it is a write, so a cache miss
+        goes to the primary.
+        """
+        if cache_ttl:
+            pipe = self.backend.pipeline()
+            finish = planned(pipe, self._cached_friends, limit=limit, offset=offset)
+            friends = finish(pipe.execute())
+
+            if friends is not None:
+                return friends
+
+            pipe = self.backend.pipeline()
+            finish = planned(pipe, self._cache_friends, limit=limit, offset=offset, cache_ttl=cache_ttl)
+            return finish(pipe.execute())
+
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._friends, limit=limit, offset=offset)
+        return finish(pipe.execute())
+
+    def _suggestions(self, pipe, following, limit, max_fanout):
+        # Counts who the followed users follow (minus anyone already followed
+        # & the user themselves), then reads off the most common.
+        suggestions_key = self.generate_key(self.username, 'suggestions')
+        keys = [self.generate_key(username, 'following') for username, score in following]
+        pipe.tally(suggestions_key, keys, limit=max_fanout, exclude=self.generate_key(self.username, 'following'))
+        pipe.remove(suggestions_key, self.username)
+        pipe.range(suggestions_key, limit=limit)
+        pipe.delete(suggestions_key)
+
+    def _format_suggestions(self, results):
+        return [{'username': username, 'mutual_count': int(count)} for username, count in results[2]]
+
+    def suggestions(self, limit=10, max_following=200, max_fanout=200):
+        """
+        Suggests users to follow ("people you may know"), ranked by how many
+        of the users this user follows follow them.
+
+        Returns a list of ``{'username': ..., 'mutual_count': ...}``. Only the
+        ``max_following`` most recent follows & the ``max_fanout`` most recent
+        follows of each of them are counted, so following big accounts can't
+        make it unbounded. The counting happens in the backend (a Lua script,
+        in Redis), in two round-trips. The followed users' lists need to be
+        in one place, so it won't work with a ``ShardedBackend``.
+        """
+        following = self._fetch('following', limit=max_following)
+
+        if not following:
+            return []
+
+        pipe = self.backend.pipeline()
+        self._suggestions(pipe, following, limit, max_fanout)
+        return self._format_suggestions(pipe.execute())
+
+    def _mutual_followers(self, pipe, username, limit=None, offset=0):
+        # Like ``friends``, a connection is as recent as the newer follow.
+        pipe.intersect_range([
+            self.generate_key(self.username, 'following'),
+            self.generate_key(username, 'followers'),
+        ], offset=offset, limit=limit, aggregate='max')
+        return lambda results: self._format(results[0])
+
+    def mutual_followers(self, username, limit=None, offset=0):
+        """
+        Returns the users this user follows who also follow ``username``
+        ("followed by X & Y, who you know"), most recent first.
+
+        The intersection is computed by the backend in a single read (so,
+        like ``suggestions``, not across shards).
+        """
+        pipe = self.backend.pipeline()
+        finish = planned(pipe, self._mutual_followers, username, limit=limit, offset=offset)
+        return finish(pipe.execute())
+
+    def _tombstone(self, pipe):
+        # Parks the user's edges in tombstone keys. Returns the keys touched.
+        touched_keys = []
+
+        for key_type in ('following', 'followers'):
+            key = self.generate_key(self.username, key_type)
+            tombstone_key = self.generate_key(self.username, 'deleted_' + key_type)
+            # Merge rather than rename, in case an earlier tombstone for the
+            # same username hasn't been reaped yet.
+            pipe.union(tombstone_key, [tombstone_key, key], aggregate='max')
+            pipe.delete(key)
+            touched_keys.append(key)
+
+        pipe.delete(self.generate_key(self.username, 'friends'))
+        pipe.set_add(self.generate_key('', 'tombstones'), self.username)
+        # Consumers of the change feed drop all of the user's edges on this.
+        self._record_change(pipe, 'delete', None, self.current_time_score())
+        return touched_keys
+
+    def tombstone(self):
+        """
+        Atomically detaches the user's following/followers, so the user is
+        immediately gone from their own point of view.
+
+        The edges are parked in tombstone keys until ``reap`` cleans up the
+        other side of each one.
+        """
+        pipe = self.backend.pipeline()
+        self._execute(pipe, self._tombstone(pipe))
+        return True
 
+    def _reap(self, pipe, other_key_type, usernames, recreated):
+        # Removes the user from the other side of each tombstoned edge, but
+        # leaves alone any that were re-created since the user was
+        # tombstoned. Returns the keys touched.
+        touched_keys = []
+
+        for username in usernames:
+            if not recreated[username]:
+                other_key = self.generate_key(username, other_key_type)
+                pipe.remove(other_key, self.username)
+                touched_keys.append(other_key)
+
+        return touched_keys
+
+    def _finish_reap(self, pipe):
+        pipe.delete(self.generate_key(self.username, 'deleted_following'))
+        pipe.delete(self.generate_key(self.username, 'deleted_followers'))
+        pipe.set_remove(self.generate_key('', 'tombstones'), self.username)
+
+    def reap(self, batch_size=1000, callback=None):
+        """
+        Removes the other side of each of the user's tombstoned edges, a
+        pipelined batch at a time.
+
+        If provided, ``callback`` is called with the progress so far after
+        each batch. Returns how many edges were removed from each list.
+        """
+        stats = {
+            'following': 0,
+            'followers': 0,
+        }
+
+        for key_type, other_key_type in (('following', 'followers'), ('followers', 'following')):
+            for batch in self._iter_batches('deleted_' + key_type, batch_size=batch_size):
+                pipe = self.backend.pipeline(transaction=False)
+                finish = planned(pipe, self._has_members, key_type, batch)
+                recreated = finish(pipe.execute())
+                pipe = self.backend.pipeline()
+                self._execute(pipe, self._reap(pipe, other_key_type, batch, recreated))
+                stats[key_type] += len(batch)
+
+                if callback is not None:
+                    callback(dict(stats))
+
+        pipe = self.backend.pipeline()
+        self._finish_reap(pipe)
+        pipe.execute()
+        return stats
+
+    def delete(self, batch_size=1000, callback=None):
+        """
+        Deletes the user & all of their relationships.
+
+        Works in batches of ``batch_size`` edges, calling ``callback`` (if
+        provided) with the progress after each.
+        """
+        self.tombstone()
+        self.reap(batch_size=batch_size, callback=callback)
         return True
@@ -0,0 +1,451 @@
+"""
+The parts of the HTTP API shared by the gevent (``server.py``) & asyncio
+(``aio_server.py``) servers.
+"""
+import re
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class BadRequest(Exception):
+    pass
+
+
+class StreamedList(object):
+    # A list in a response body that gets sent a batch at a time, rather than
+    # being loaded (& encoded) all at once.
+    def __init__(self, batches):
+        self.batches = batches
+
+
+def parse_nodes(nodes):
+    # ``host:port/db,host:port/db,...`` => ``FriendlyDB(nodes=...)``.
+    parsed = []
+
+    for node in nodes.split(','):
+        address, _, db = node.strip().partition('/')
+        host, _, port = address.partition(':')
+        parsed.append({
+            'host': host or 'localhost',
+            'port': int(port or 6379),
+            'db': int(db or 0),
+        })
+
+    return parsed
+
+
+# Responses.
+def dump_json(body):
+    # A response body, as UTF-8 bytes (which WSGI & sockets want).
+    return json.dumps(body).encode('utf-8')
+
+def is_streamed(body):
+    # Whether any of the body gets sent a batch at a time.
+    for value in body.values():
+        if isinstance(value, StreamedList):
+            return True
+
+    return False
+
+def json_parts(body):
+    # The pieces of ``dump_json(body)``, as UTF-8 chunks, but with any
+    # ``StreamedList`` left in place of its items for the server to expand
+    # (with ``dump_batch``), in whichever way it iterates the batches.
+    yield b'{'
+
+    for offset, (key, value) in enumerate(body.items()):
+        if offset:
+            yield b', '
+
+        if not isinstance(value, StreamedList):
+            yield '{0}: {1}'.format(json.dumps(key), json.dumps(value)).encode('utf-8')
+            continue
+
+        yield '{0}: ['.format(json.dumps(key)).encode('utf-8')
+        yield value
+        yield b']'
+
+    yield b'}'
+
+def dump_batch(batch, started):
+    # A non-empty batch of a ``StreamedList``'s items, without the brackets
+    # (& after a comma, if some items were already sent).
+    data = json.dumps(batch)[1:-1]
+
+    if started:
+        data = ', ' + data
+
+    return data.encode('utf-8')
+
+def stream_json(body):
+    # The same JSON as ``dump_json(body)``, as a generator of UTF-8 chunks
+    # (which the server sends with chunked transfer encoding).
+    for part in json_parts(body):
+        if not isinstance(part, StreamedList):
+            yield part
+            continue
+
+        started = False
+
+        for batch in part.batches:
+            if batch:
+                yield dump_batch(batch, started)
+                started = True
+
+
+# Request parsing.
+def get_list(query, name):
+    # Accepts both ``?name=a,b`` & ``?name=a&name=b``.
+    values = []
+
+    for value in query.get(name, []):
+        values.extend([bit for bit in value.split(',') if bit])
+
+    if not values:
+        raise BadRequest("The '{0}' parameter is required.".format(name))
+
+    return values
+
+def get_str(op, name):
+    value = op.get(name)
+
+    if not isinstance(value, string_types) or not value:
+        raise BadRequest("The '{0}' parameter is required.".format(name))
+
+    return value
+
+def get_username(op, name):
+    value = get_str(op, name)
+
+    if value in reserved_usernames:
+        raise BadRequest("The '{0}' parameter can't be '{1}', which the API uses itself.".format(name, value))
+
+    return value
+
+def get_int(query, name, default=None, minimum=0):
+    values = query.get(name)
+
+    if not values:
+        return default
+
+    try:
+        value = int(values[0])
+    except (TypeError, ValueError):
+        # (Batch operations can hold any JSON value, like ``null``.)
+        raise BadRequest("The '{0}' parameter must be an integer.".format(name))
+
+    if value < minimum:
+        if minimum == 0:
+            raise BadRequest("The '{0}' parameter can't be negative.".format(name))
+
+        raise BadRequest("The '{0}' parameter must be at least {1}.".format(name, minimum))
+
+    return value
+
+
+# Batches.
+#
+# Each operation queues its commands onto the shared pipeline & hands back
+# the keys it changes, plus a function that turns its slice of the pipeline's
+# results into the same body the matching endpoint would return.
+def _batch_edge(fdb, pipe, op, method, result_name):
+    username = get_username(op, 'username')
+    other_username = get_username(op, 'other_username')
+    body = {
+        'username': username,
+        'other_username': other_username,
+    }
+
+    if username == other_username:
+        body[result_name] = False
+        return [], lambda results: body
+
+    user = fdb[username]
+
+    if method == 'follow':
+        touched_keys = user._follow(pipe, other_username, user.current_time_score())
+    else:
+        touched_keys = user._unfollow(pipe, other_username)
+
+    def finish(results):
+        body[result_name] = True
+        return body
+
+    return touched_keys, finish
+
+def _batch_follow(fdb, pipe, op):
+    return _batch_edge(fdb, pipe, op, 'follow', 'followed')
+
+def _batch_unfollow(fdb, pipe, op):
+    return _batch_edge(fdb, pipe, op, 'unfollow', 'unfollowed')
+
+def _batch_membership(fdb, pipe, op, key_type, result_name):
+    username = get_username(op, 'username')
+    other_username = get_username(op, 'other_username')
+    user = fdb[username]
+    pipe.score(user.generate_key(username, key_type), other_username)
+
+    def finish(results):
+        return {
+            'username': username,
+            'other_username': other_username,
+            result_name: results[0] is not None,
+        }
+
+    return [], finish
+
+def _batch_is_following(fdb, pipe, op):
+    return _batch_membership(fdb, pipe, op, 'following', 'is_following')
+
+def _batch_is_followed_by(fdb, pipe, op):
+    return _batch_membership(fdb, pipe, op, 'followers', 'is_followed_by')
+
+def _batch_counts(fdb, pipe, op):
+    username = get_username(op, 'username')
+    counts = fdb[username]._counts(pipe)
+
+    def finish(results):
+        return {
+            'username': username,
+            'counts': counts(results),
+        }
+
+    return [], finish
+
+def _batch_list(fdb, pipe, op, key_type):
+    username = get_username(op, 'username')
+    query = dict([(key, [value]) for key, value in op.items()])
+    # Lists are always paged in a batch.
+    users = fdb[username]._list(
+        pipe,
+        key_type,
+        offset=get_int(query, 'offset', 0),
+        limit=get_int(query, 'limit', 50, minimum=1),
+        since=get_int(query, 'since'),
+        until=get_int(query, 'until')
+    )
+
+    def finish(results):
+        return {
+            'username': username,
+            key_type: users(results),
+        }
+
+    return [], finish
+
+def _batch_following(fdb, pipe, op):
+    return _batch_list(fdb, pipe, op, 'following')
+
+def _batch_followers(fdb, pipe, op):
+    return _batch_list(fdb, pipe, op, 'followers')
+
+batch_operations = {
+    'follow': _batch_follow,
+    'unfollow': _batch_unfollow,
+    'is_following': _batch_is_following,
+    'is_followed_by': _batch_is_followed_by,
+    'counts': _batch_counts,
+    'following': _batch_following,
+    'followers': _batch_followers,
+}
+
+def parse_batch(body, max_operations):
+    try:
+        ops = json.loads(body or 'null')
+    except ValueError:
+        raise BadRequest("The request body must be JSON.")
+
+    if not isinstance(ops, list):
+        raise BadRequest("The request body must be a list of operations.")
+
+    if len(ops) > max_operations:
+        raise BadRequest("A batch can't have more than {0} operations.".format(max_operations))
+
+    return ops
+
+def plan_batch(fdb, pipe, ops):
+    """
+    Queues the operations onto ``pipe``.
+
+    Returns the keys they'll change & what ``finish_batch`` needs to build
+    the results once the pipeline has run.
+    """
+    # ``(offset into the pipeline's results, command count, finish)`` or
+    # ``(None, None, error)`` for each operation.
+    pending = []
+    touched_keys = set()
+
+    for op in ops:
+        try:
+            if not isinstance(op, dict) or op.get('op') not in batch_operations:
+                raise BadRequest("Each operation needs an 'op' of {0}.".format(', '.join(sorted(batch_operations))))
+
+            start = len(pipe)
+            op_touched_keys, finish = batch_operations[op['op']](fdb, pipe, op)
+        except BadRequest as e:
+            pending.append((None, None, str(e)))
+            continue
+
+        touched_keys.update(op_touched_keys)
+        pending.append((start, len(pipe) - start, finish))
+
+    return touched_keys, pending
+
+def finish_batch(pending, results):
+    responses = []
+
+    for start, count, finish in pending:
+        if start is None:
+            responses.append({'error': finish})
+        else:
+            responses.append(finish(results[start:start + count]))
+
+    return responses
+
+
+# Routing.
+class RouteNode(object):
+    def __init__(self):
+        # ``segment => RouteNode``.
+        self.children = {}
+        # ``(param name, RouteNode)`` for a ``<param>`` segment.
+        self.param = None
+        # ``HTTP method => handler``.
+        self.handlers = {}
+
+
+class Router(object):
+    """
+    Maps paths like ``/<username>/follow/<other_username>/`` & HTTP methods
+    to handlers.
+
+    The routes are kept in a tree of path segments, so matching is a single
+    walk over the request's segments (literal segments win over params).
+    Trailing slashes are optional. Params never match the ``reserved``
+    values, so (say) ``/_counts/following/`` can be a 404 rather than the
+    ``following`` of a user called ``_counts``.
+    """
+    param_re = re.compile(r'^[\w\d._-]+$')
+
+    def __init__(self, reserved=()):
+        self.root = RouteNode()
+        self.reserved = frozenset(reserved)
+
+    def _segments(self, path):
+        path = path.strip('/')
+
+        if not path:
+            return []
+
+        return path.split('/')
+
+    def add(self, method, path, handler):
+        node = self.root
+
+        for segment in self._segments(path):
+            if segment.startswith('<') and segment.endswith('>'):
+                name = segment[1:-1]
+
+                if node.param is None:
+                    node.param = (name, RouteNode())
+                elif node.param[0] != name:
+                    raise ValueError("'{0}' conflicts with the existing '<{1}>' param.".format(path, node.param[0]))
+
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+
+        node.handlers[method.upper()] = handler
+
+    def _match(self, node, segments, offset, params):
+        if offset == len(segments):
+            if node.handlers:
+                return node
+
+            return None
+
+        segment = segments[offset]
+        child = node.children.get(segment)
+
+        if child is not None:
+            found = self._match(child, segments, offset + 1, params)
+
+            if found is not None:
+                return found
+
+        if node.param is not None and segment not in self.reserved and self.param_re.match(segment):
+            name, child = node.param
+            found = self._match(child, segments, offset + 1, params)
+
+            if found is not None:
+                params[name] = segment
+                return found
+
+        return None
+
+    def match(self, path):
+        """
+        Returns ``(handlers by HTTP method, url params)``, or
+        ``(None, None)`` if nothing matches.
+        """
+        if not path.startswith('/'):
+            return None, None
+
+        segments = path[1:].split('/')
+
+        # Allow (just) one trailing slash.
+        if segments[-1] == '':
+            segments.pop()
+
+        params = {}
+        node = self._match(self.root, segments, 0, params)
+
+        if node is None:
+            return None, None
+
+        return node.handlers, params
+
+
+# Both servers serve these, by handler name.
+routes = (
+    ('GET', '/', 'index'),
+    ('GET', '/_stats/', 'stats'),
+    ('GET', '/_counts/', 'counts_many'),
+    ('POST', '/_batch/', 'batch'),
+    ('GET', '/_users/', 'get_many'),
+    ('GET', '/<username>/', 'user_detail'),
+    ('GET', '/<username>/following/', 'user_following'),
+    ('GET', '/<username>/followers/', 'user_followers'),
+    ('GET', '/<username>/friends/', 'user_friends'),
+    ('GET', '/<username>/counts/', 'user_counts'),
+    ('GET', '/<username>/suggestions/', 'user_suggestions'),
+    ('GET', '/<username>/mutual_followers/<other_username>/', 'mutual_followers'),
+    ('POST', '/<username>/follow/<other_username>/', 'follow'),
+    ('POST', '/<username>/unfollow/<other_username>/', 'unfollow'),
+    ('GET', '/<username>/is_following/<other_username>/', 'is_following'),
+    ('GET', '/<username>/is_followed_by/<other_username>/', 'is_followed_by'),
+    ('GET', '/<username>/is_following/', 'is_following_many'),
+    ('GET', '/<username>/is_followed_by/', 'is_followed_by_many'),
+)
+
+# The API's own top-level paths (like ``/_batch/``), which can't be usernames.
+reserved_usernames = frozenset([
+    path.split('/')[1] for method, path, name in routes if path != '/' and not path.startswith('/<')
+])
+
+
+def build_router(handlers):
+    # ``handlers`` maps the names in ``routes`` to functions (say, a module's
+    # ``globals()``).
+    router = Router(reserved=reserved_usernames)
+
+    for method, path, name in routes:
+        router.add(method, path, handlers[name])
+
+    return router
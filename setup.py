@@ -25,4 +25,7 @@ setup(
     install_requires=[
         'redis>=2.72',
     ],
+    extras_require={
+        'memory': ['sortedcontainers'],
+    },
 )
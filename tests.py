@@ -1,11 +1,1086 @@
+import benchmark_suite
+import datetime
+import errno
+import json
+import os
+import pstats
+import random
 import redis
-from friendlydb import SEPARATOR
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from friendlydb import SEPARATOR, prefork
+from friendlydb.backends import InternedBackend, MemoryBackend, ObservedBackend, RedisBackend, ReplicatedBackend, ShardedBackend
+from friendlydb.cache import FriendlyCache
 from friendlydb.db import FriendlyDB
+from friendlydb.metrics import Histogram, Metrics
+from friendlydb.tracing import Tracer
 from friendlydb.user import FriendlyUser
+from friendlydb.web import BadRequest, Router, finish_batch, parse_batch, parse_nodes, plan_batch
 try:
     import unittest2
 except ImportError:
     import unittest as unittest2
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import gevent
+except ImportError:
+    gevent = None
+try:
+    import asyncio
+    from friendlydb import aio_server
+    from friendlydb.aio import AsyncBackend, AsyncConnectionPool, AsyncFriendlyDB, AsyncRedisBackend, TaskLocal
+except (ImportError, SyntaxError):
+    # Python 2.
+    asyncio = None
+
+
+class FriendlyCacheTestCase(unittest2.TestCase):
+    def test_get_set(self):
+        cache = FriendlyCache(size=10)
+        self.assertEqual(cache.get('daniel::following', (0, None)), None)
+
+        cache.set('daniel::following', (0, None), ['alice'])
+        cache.set('daniel::following', (0, 1), ['alice'])
+        self.assertEqual(cache.get('daniel::following', (0, None)), ['alice'])
+        self.assertEqual(cache.get('daniel::following', (0, 1)), ['alice'])
+        self.assertEqual(cache.get('daniel::following', (0, 2)), None)
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'hits': 2,
+            'misses': 2,
+            'evictions': 0,
+            'invalidations': 0,
+        })
+
+    def test_lru(self):
+        cache = FriendlyCache(size=2)
+        cache.set('a', 1, 'a')
+        cache.set('b', 1, 'b')
+        # Touch ``a``, so ``b`` is the least recently used.
+        cache.get('a', 1)
+        cache.set('c', 1, 'c')
+
+        self.assertEqual(cache.get('a', 1), 'a')
+        self.assertEqual(cache.get('b', 1), None)
+        self.assertEqual(cache.get('c', 1), 'c')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = FriendlyCache(size=2, ttl=0.05)
+        cache.set('a', 1, 'a')
+        self.assertEqual(cache.get('a', 1), 'a')
+
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a', 1), None)
+
+    def test_invalidate(self):
+        cache = FriendlyCache()
+        cache.set('a', 1, 'a')
+        cache.set('a', 2, 'a')
+        cache.set('b', 1, 'b')
+
+        cache.invalidate(['a', 'nope'])
+        self.assertEqual(cache.get('a', 1), None)
+        self.assertEqual(cache.get('a', 2), None)
+        self.assertEqual(cache.get('b', 1), 'b')
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+class BackendTestMixin(object):
+    def test_add_remove(self):
+        self.assertEqual(self.backend.add('a', 'x', 10), 1)
+        self.assertEqual(self.backend.add('a', 'x', 20), 0)
+        self.assertEqual(self.backend.add('a', 'y', 15), 1)
+        self.assertEqual(self.backend.score('a', 'x'), 20)
+        self.assertEqual(self.backend.score('a', 'z'), None)
+        self.assertEqual(self.backend.card('a'), 2)
+
+        self.assertEqual(self.backend.remove('a', 'x'), 1)
+        self.assertEqual(self.backend.remove('a', 'x'), 0)
+        self.assertEqual(self.backend.card('a'), 1)
+        self.assertEqual(self.backend.card('nope'), 0)
+
+    def test_range(self):
+        for member, score in (('a', 1), ('b', 2), ('c', 2), ('d', 3), ('e', 4)):
+            self.backend.add('k', member, score)
+
+        self.assertEqual(self.backend.range('k'), [('e', 4), ('d', 3), ('c', 2), ('b', 2), ('a', 1)])
+        self.assertEqual(self.backend.range('k', offset=1, limit=2), [('d', 3), ('c', 2)])
+        self.assertEqual(self.backend.range('k', offset=4), [('a', 1)])
+        self.assertEqual(self.backend.range('k', offset=10), [])
+        self.assertEqual(self.backend.range('k', min_score=2), [('e', 4), ('d', 3), ('c', 2), ('b', 2)])
+        self.assertEqual(self.backend.range('k', max_score=2), [('c', 2), ('b', 2), ('a', 1)])
+        self.assertEqual(self.backend.range('k', min_score=2, max_score=3, offset=1, limit=1), [('c', 2)])
+        self.assertEqual(self.backend.range('nope'), [])
+        # ``limit=0`` is empty, not "to the end".
+        self.assertEqual(self.backend.range('k', limit=0), [])
+        self.assertEqual(self.backend.range('k', offset=2, limit=0), [])
+        self.assertEqual(self.backend.range('k', min_score=2, limit=0), [])
+
+        pipe = self.backend.pipeline()
+        pipe.range('k', limit=0)
+        pipe.range('k', limit=1)
+        self.assertEqual(pipe.execute(), [[], [('e', 4)]])
+
+    def test_intersect_union(self):
+        self.backend.add('a', 'x', 1)
+        self.backend.add('a', 'y', 5)
+        self.backend.add('b', 'y', 2)
+        self.backend.add('b', 'z', 3)
+
+        self.assertEqual(self.backend.intersect('i', ['a', 'b'], aggregate='max'), 1)
+        self.assertEqual(self.backend.range('i'), [('y', 5)])
+        self.assertEqual(self.backend.union('u', ['a', 'b']), 3)
+        self.assertEqual(self.backend.range('u'), [('y', 7), ('z', 3), ('x', 1)])
+        self.assertEqual(self.backend.intersect('i', ['a', 'nope']), 0)
+        self.assertFalse(self.backend.exists('i'))
+
+    def test_intersect_range(self):
+        for key, member, score in (('a', 'x', 1), ('a', 'y', 5), ('a', 'w', 4), ('b', 'y', 2), ('b', 'z', 3), ('b', 'w', 4)):
+            self.backend.add(key, member, score)
+
+        self.assertEqual(self.backend.intersect_range(['a', 'b']), [('w', 8), ('y', 7)])
+        self.assertEqual(self.backend.intersect_range(['a', 'b'], aggregate='max'), [('y', 5), ('w', 4)])
+        self.assertEqual(self.backend.intersect_range(['a', 'b'], offset=1, limit=1, aggregate='min'), [('y', 2)])
+        self.assertEqual(self.backend.intersect_card(['a', 'b']), 2)
+        self.assertEqual(self.backend.intersect_range(['a', 'nope']), [])
+        self.assertEqual(self.backend.intersect_card(['nope', 'a']), 0)
+
+        pipe = self.backend.pipeline()
+        pipe.intersect_range(['a', 'b'], limit=1)
+        pipe.intersect_card(['a', 'b'])
+        self.assertEqual(pipe.execute(), [[('w', 8)], 2])
+
+    def test_tally(self):
+        self.backend.add('a', 'x', 1)
+        self.backend.add('a', 'y', 2)
+        self.backend.add('b', 'y', 1)
+        self.backend.add('b', 'z', 2)
+        self.backend.add('c', 'z', 3)
+        self.backend.add('e', 'x', 1)
+
+        self.assertEqual(self.backend.tally('t', ['a', 'b', 'c']), 3)
+        self.assertEqual(self.backend.range('t'), [('z', 2), ('y', 2), ('x', 1)])
+        # Only the highest-scored member of each key.
+        self.assertEqual(self.backend.tally('t', ['a', 'b', 'c'], limit=1), 2)
+        self.assertEqual(self.backend.range('t'), [('z', 2), ('y', 1)])
+        self.assertEqual(self.backend.tally('t', ['a', 'b', 'c'], exclude='e'), 2)
+        self.assertEqual(self.backend.range('t'), [('z', 2), ('y', 2)])
+        self.assertEqual(self.backend.tally('t', ['nope']), 0)
+        self.assertFalse(self.backend.exists('t'))
+
+    def test_stream(self):
+        first = self.backend.stream_add('s', {'type': 'follow', 'username': 'daniel'})
+        second = self.backend.stream_add('s', {'type': 'unfollow', 'username': 'alice'})
+
+        self.assertEqual(self.backend.stream_read('s'), [
+            (first, {'type': 'follow', 'username': 'daniel'}),
+            (second, {'type': 'unfollow', 'username': 'alice'}),
+        ])
+        self.assertEqual(self.backend.stream_read('s', count=1), [(first, {'type': 'follow', 'username': 'daniel'})])
+        self.assertEqual(self.backend.stream_read('s', after=first), [(second, {'type': 'unfollow', 'username': 'alice'})])
+        self.assertEqual(self.backend.stream_read('s', after=second), [])
+        self.assertEqual(self.backend.stream_read('nope'), [])
+
+        # Readable from (& appendable in) a pipeline too.
+        pipe = self.backend.pipeline()
+        pipe.stream_add('s', {'type': 'delete'})
+        pipe.stream_read('s', after=second)
+        third, entries = pipe.execute()
+        self.assertEqual(entries, [(third, {'type': 'delete'})])
+
+        for i in range(300):
+            self.backend.stream_add('capped', {'i': str(i)}, max_length=10)
+
+        # Trimming can be approximate, but the newest entries are kept.
+        entries = self.backend.stream_read('capped')
+        self.assertTrue(10 <= len(entries) < 300)
+        self.assertEqual(entries[-1][1], {'i': '299'})
+
+    def test_keys(self):
+        self.backend.add('a', 'x', 1)
+        self.assertTrue(self.backend.exists('a'))
+        self.assertTrue(self.backend.expire('a', 30))
+        self.assertEqual(self.backend.delete('a'), 1)
+        self.assertFalse(self.backend.exists('a'))
+
+        self.assertEqual(self.backend.set_add('s', 'x'), 1)
+        self.assertEqual(self.backend.set_add('s', 'y'), 1)
+        self.assertEqual(self.backend.set_remove('s', 'y'), 1)
+        self.assertEqual(self.backend.set_members('s'), set(['x']))
+
+        self.backend.flush()
+        self.assertEqual(self.backend.set_members('s'), set())
+
+    def test_pipeline(self):
+        pipe = self.backend.pipeline()
+        pipe.add('a', 'x', 1)
+        pipe.add('a', 'y', 2)
+        pipe.card('a')
+        pipe.range('a', limit=1)
+        self.assertEqual(len(pipe), 4)
+        self.assertEqual(pipe.execute(), [1, 1, 2, [('y', 2)]])
+        # Executing empties the pipeline, ready for reuse.
+        self.assertEqual(len(pipe), 0)
+        self.assertRaises(AttributeError, getattr, pipe, 'not_an_operation')
+
+
+class MemoryBackendTestCase(BackendTestMixin, unittest2.TestCase):
+    def setUp(self):
+        super(MemoryBackendTestCase, self).setUp()
+        self.backend = MemoryBackend()
+
+    def test_expire(self):
+        self.backend.add('a', 'x', 1)
+        self.backend.expire('a', 0.05)
+        self.assertEqual(self.backend.card('a'), 1)
+
+        time.sleep(0.1)
+        self.assertEqual(self.backend.card('a'), 0)
+        self.assertFalse(self.backend.exists('a'))
+
+    def test_publish(self):
+        messages = []
+        self.backend.listen('channel', messages.append)
+        self.assertEqual(self.backend.publish('channel', 'hi'), 1)
+        self.assertEqual(self.backend.publish('other', 'hi'), 0)
+        self.assertEqual(messages, ['hi'])
+
+    def test_friendlydb(self):
+        fdb = FriendlyDB(backend=MemoryBackend())
+        self.assertEqual(fdb.conn, None)
+
+        fdb['daniel'].follow_many(['alice', 'bob', 'joe'])
+        fdb['alice'].follow('daniel')
+        fdb['bob'].follow('daniel')
+
+        self.assertEqual(fdb['daniel'].following(limit=2), ['joe', 'bob'])
+        self.assertEqual(fdb['daniel'].followers(), ['bob', 'alice'])
+        self.assertTrue(fdb['daniel'].is_following('joe'))
+        self.assertEqual(fdb['daniel'].friends(), ['bob', 'alice'])
+        self.assertEqual(fdb['daniel'].counts(), {'following': 3, 'followers': 2, 'friends': 2})
+
+        fdb.delete_user('daniel')
+        self.assertEqual(fdb['alice'].following(), [])
+        self.assertEqual(fdb['joe'].followers(), [])
+
+        self.assertTrue(fdb.clear())
+
+
+class InternedBackendTestCase(BackendTestMixin, unittest2.TestCase):
+    def setUp(self):
+        super(InternedBackendTestCase, self).setUp()
+        self.backend = InternedBackend(MemoryBackend(), separator=SEPARATOR)
+
+    def test_ids(self):
+        self.assertEqual(self.backend.get_ids(['daniel', 'alice']), {})
+        self.assertEqual(self.backend.get_ids(['daniel', 'alice'], create=True), {'daniel': '1', 'alice': '2'})
+        self.assertEqual(self.backend.get_ids(['alice', 'bob'], create=True), {'alice': '2', 'bob': '3'})
+        self.assertEqual(self.backend.get_names(['3', '1', '99']), {'3': 'bob', '1': 'daniel'})
+
+        # Another process (with a cold cache) sees the same ids.
+        other = InternedBackend(self.backend.backend, separator=SEPARATOR)
+        self.assertEqual(other.get_ids(['bob']), {'bob': '3'})
+        self.assertEqual(other.get_names([2]), {'2': 'alice'})
+
+    def test_lagging_replica(self):
+        # Ids are claimed (& read back) on the primary, even when a replica
+        # hasn't caught up with the id map yet.
+        primary = MemoryBackend()
+        FriendlyDB(backend=primary, intern_ids=True)['daniel'].follow('alice')
+        fdb = FriendlyDB(backend=ReplicatedBackend(primary, [MemoryBackend()], separator=SEPARATOR), intern_ids=True)
+        self.assertTrue(fdb['daniel'].follow('bob'))
+
+        fdb = FriendlyDB(backend=primary, intern_ids=True)
+        self.assertEqual(sorted(fdb['daniel'].following()), ['alice', 'bob'])
+        self.assertEqual(fdb['bob'].followers(), ['daniel'])
+        # The ids reserved for daniel but never claimed don't map to anyone.
+        names = primary.hashes['::names']
+        self.assertEqual(sorted(names.values()), ['alice', 'bob', 'daniel'])
+        self.assertEqual(sorted(primary.hashes['::ids'].values()), sorted(names))
+
+    def test_translation(self):
+        self.backend.add('daniel::following', 'alice', 10)
+        self.backend.add('alice::followers', 'daniel', 10)
+
+        self.assertEqual(self.backend.backend.range('1::following'), [('2', 10)])
+        self.assertEqual(self.backend.backend.range('2::followers'), [('1', 10)])
+        self.assertEqual(self.backend.range('daniel::following'), [('alice', 10)])
+        self.assertEqual(self.backend.score('daniel::following', 'alice'), 10)
+
+        # Unknown users can't have any data.
+        self.assertEqual(self.backend.range('joe::following'), [])
+        self.assertEqual(self.backend.score('daniel::following', 'joe'), None)
+        self.assertEqual(self.backend.remove('daniel::following', 'joe'), 0)
+        self.assertEqual(self.backend.intersect('daniel::friends', ['daniel::following', 'joe::followers']), 0)
+        self.assertEqual(self.backend.get_ids(['joe']), {})
+
+
+class ShardedBackendTestCase(BackendTestMixin, unittest2.TestCase):
+    def setUp(self):
+        super(ShardedBackendTestCase, self).setUp()
+        self.shards = [MemoryBackend(), MemoryBackend(), MemoryBackend()]
+        self.backend = ShardedBackend(self.shards, separator=SEPARATOR)
+
+    def test_intersect_union(self):
+        # Only a single user's keys can be combined.
+        self.backend.add('daniel::following', 'x', 1)
+        self.backend.add('daniel::following', 'y', 5)
+        self.backend.add('daniel::followers', 'y', 2)
+
+        self.assertEqual(self.backend.intersect('daniel::friends', ['daniel::following', 'daniel::followers'], aggregate='max'), 1)
+        self.assertEqual(self.backend.range('daniel::friends'), [('y', 5)])
+
+        usernames = ['user{0}'.format(i) for i in range(20)]
+        other = [username for username in usernames if self.backend.shard_for_key(username + '::followers') != self.backend.shard_for_key('daniel::following')][0]
+        self.assertRaises(ValueError, self.backend.intersect, 'daniel::friends', ['daniel::following', other + '::followers'])
+
+    def test_intersect_range(self):
+        self.backend.add('daniel::following', 'x', 1)
+        self.backend.add('daniel::following', 'y', 5)
+        self.backend.add('daniel::followers', 'y', 2)
+
+        self.assertEqual(self.backend.intersect_range(['daniel::following', 'daniel::followers'], aggregate='max'), [('y', 5)])
+        self.assertEqual(self.backend.intersect_card(['daniel::following', 'daniel::followers']), 1)
+
+        usernames = ['user{0}'.format(i) for i in range(20)]
+        other = [username for username in usernames if self.backend.shard_for_key(username + '::followers') != self.backend.shard_for_key('daniel::following')][0]
+        self.assertRaises(ValueError, self.backend.intersect_range, ['daniel::following', other + '::followers'])
+        self.assertRaises(ValueError, self.backend.intersect_card, ['daniel::following', other + '::followers'])
+
+    def test_tally(self):
+        self.backend.add('daniel::following', 'x', 1)
+        self.backend.add('daniel::followers', 'x', 2)
+
+        self.assertEqual(self.backend.tally('daniel::suggestions', ['daniel::following', 'daniel::followers']), 1)
+        self.assertEqual(self.backend.range('daniel::suggestions'), [('x', 2)])
+
+        usernames = ['user{0}'.format(i) for i in range(20)]
+        other = [username for username in usernames if self.backend.shard_for_key(username + '::following') != self.backend.shard_for_key('daniel::following')][0]
+        self.assertRaises(ValueError, self.backend.tally, 'daniel::suggestions', [other + '::following'])
+        self.assertRaises(ValueError, self.backend.tally, 'daniel::suggestions', ['daniel::following'], exclude=other + '::following')
+
+    def test_placement(self):
+        usernames = ['user{0}'.format(i) for i in range(100)]
+        pipe = self.backend.pipeline()
+
+        for username in usernames:
+            pipe.add(username + '::following', 'daniel', 1)
+            pipe.add(username + '::followers', 'daniel', 1)
+
+        self.assertEqual(pipe.execute(), [1] * 200)
+
+        # Every shard gets some users & each user's keys stay together.
+        for shard in self.shards:
+            keys = [username for username in usernames if shard.card(username + '::following')]
+            self.assertTrue(keys)
+
+            for username in keys:
+                self.assertEqual(shard.card(username + '::followers'), 1)
+
+        self.assertEqual(sum(shard.card(username + '::following') for shard in self.shards for username in usernames), 100)
+
+        # Placement doesn't depend on the order of the backends.
+        names = [str(offset) for offset in range(3)]
+        flipped = ShardedBackend(list(reversed(self.shards)), separator=SEPARATOR, names=list(reversed(names)))
+
+        for username in usernames:
+            self.assertEqual(flipped.card(username + '::following'), 1)
+
+    def test_friendlydb(self):
+        fdb = FriendlyDB(backend=self.backend)
+        fdb['daniel'].follow_many(['user{0}'.format(i) for i in range(20)])
+        fdb['user3'].follow('daniel')
+
+        self.assertEqual(len(fdb['daniel'].following()), 20)
+        self.assertEqual(fdb['user7'].followers(), ['daniel'])
+        self.assertEqual(fdb['daniel'].friends(), ['user3'])
+        self.assertEqual(fdb.counts_many(['daniel', 'user3'])['user3'], {'following': 1, 'followers': 1, 'friends': 1})
+
+        fdb.delete_user('daniel')
+        self.assertEqual(fdb['user7'].followers(), [])
+        self.assertEqual(fdb['user3'].following(), [])
+
+
+class UnreachableBackend(MemoryBackend):
+    connection_errors = (IOError,)
+
+    def __init__(self):
+        super(UnreachableBackend, self).__init__()
+        self.calls = 0
+
+    def range(self, *args, **kwargs):
+        self.calls += 1
+        raise IOError('Connection refused')
+
+
+class ReplicatedBackendTestCase(BackendTestMixin, unittest2.TestCase):
+    def setUp(self):
+        super(ReplicatedBackendTestCase, self).setUp()
+        # A replica that's always caught up.
+        primary = MemoryBackend()
+        self.backend = ReplicatedBackend(primary, [primary], separator=SEPARATOR)
+
+    def test_routing(self):
+        primary = MemoryBackend()
+        replicas = [MemoryBackend(), MemoryBackend()]
+        backend = ReplicatedBackend(primary, replicas, separator=SEPARATOR)
+
+        for replica in replicas:
+            replica.add('daniel::following', 'alice', 1)
+
+        backend.add('daniel::following', 'bob', 2)
+        self.assertEqual(primary.card('daniel::following'), 1)
+        self.assertEqual(replicas[0].card('daniel::following'), 1)
+
+        # Reads (& read-only pipelines) are spread across the replicas.
+        self.assertEqual(backend.range('daniel::following'), [('alice', 1)])
+        replicas[1].add('daniel::following', 'joe', 3)
+        self.assertEqual(sorted(backend.card('daniel::following') for i in range(4)), [1, 1, 2, 2])
+
+        pipe = backend.pipeline()
+        pipe.score('daniel::following', 'alice')
+        pipe.card('daniel::following')
+        self.assertEqual(pipe.execute()[0], 1)
+
+        # Anything that writes goes to the primary.
+        pipe = backend.pipeline()
+        pipe.card('daniel::following')
+        pipe.add('daniel::following', 'sarah', 4)
+        self.assertEqual(pipe.execute(), [1, 1])
+        self.assertEqual(backend.intersect('daniel::friends', ['daniel::following', 'daniel::followers']), 0)
+
+        # Intersections that aren't stored are reads, too.
+        for replica in replicas:
+            replica.add('daniel::followers', 'alice', 5)
+
+        self.assertEqual(backend.intersect_range(['daniel::following', 'daniel::followers'], aggregate='max'), [('alice', 5)])
+        pipe = backend.pipeline()
+        pipe.intersect_card(['daniel::following', 'daniel::followers'])
+        self.assertEqual(pipe.execute(), [1])
+
+    def test_friendlydb(self):
+        # Friends & counts are answered by the replicas.
+        primary = MemoryBackend()
+        replica = MemoryBackend()
+        FriendlyDB(backend=replica).bulk_load([('daniel', 'alice'), ('alice', 'daniel'), ('daniel', 'bob'), ('alice', 'bob')])
+        fdb = FriendlyDB(backend=ReplicatedBackend(primary, [replica], separator=SEPARATOR))
+
+        self.assertEqual(fdb['daniel'].friends(), ['alice'])
+        self.assertEqual(fdb['daniel'].counts(), {'following': 2, 'followers': 1, 'friends': 1})
+        self.assertEqual(fdb['daniel'].mutual_followers('bob'), ['alice'])
+        self.assertEqual(fdb.counts_many(['alice'])['alice'], {'following': 2, 'followers': 1, 'friends': 1})
+
+    def test_read_your_writes(self):
+        primary = MemoryBackend()
+        replica = MemoryBackend()
+        backend = ReplicatedBackend(primary, [replica], separator=SEPARATOR, read_your_writes=0.1)
+
+        backend.add('daniel::following', 'alice', 1)
+        pipe = backend.pipeline()
+        pipe.add('alice::followers', 'daniel', 1)
+        pipe.execute()
+
+        self.assertEqual(backend.range('daniel::following'), [('alice', 1)])
+        self.assertEqual(backend.score('alice::followers', 'daniel'), 1)
+        self.assertEqual(backend.range('bob::following'), [])
+        self.assertEqual(backend.stats()['pinned'], 2)
+
+        time.sleep(0.15)
+        self.assertEqual(backend.range('daniel::following'), [])
+
+        # Old pins get cleaned up as new writes come in.
+        backend.add('bob::following', 'alice', 1)
+        self.assertEqual(backend.stats()['pinned'], 1)
+
+    def test_failover(self):
+        primary = MemoryBackend()
+        broken = UnreachableBackend()
+        replica = MemoryBackend()
+        backend = ReplicatedBackend(primary, [broken, replica], separator=SEPARATOR, retry_interval=0.1)
+        primary.add('daniel::following', 'alice', 1)
+
+        # The broken replica is skipped, then left alone for a while.
+        for i in range(4):
+            self.assertEqual(backend.range('daniel::following'), [])
+
+        self.assertEqual(broken.calls, 1)
+        self.assertEqual(backend.stats()['down'], 1)
+
+        time.sleep(0.15)
+        backend.range('daniel::following')
+        backend.range('daniel::following')
+        self.assertEqual(broken.calls, 2)
+
+        # With no replica up, reads go to the primary.
+        backend = ReplicatedBackend(primary, [broken], separator=SEPARATOR)
+        self.assertEqual(backend.range('daniel::following'), [('alice', 1)])
+        self.assertEqual(backend.range('daniel::following'), [('alice', 1)])
+        self.assertEqual(broken.calls, 3)
+
+
+class ObservedBackendTestCase(BackendTestMixin, unittest2.TestCase):
+    def setUp(self):
+        super(ObservedBackendTestCase, self).setUp()
+        self.round_trips = []
+        self.backend = ObservedBackend(MemoryBackend(), lambda commands, seconds, results: self.round_trips.append(commands))
+
+    def test_observer(self):
+        self.backend.add('daniel::following', 'alice', 1)
+        pipe = self.backend.pipeline()
+        pipe.card('daniel::following')
+        pipe.range('daniel::following', limit=10)
+        self.assertEqual(pipe.execute(), [1, [('alice', 1)]])
+
+        self.assertEqual(self.round_trips, [
+            [('add', ('daniel::following', 'alice', 1))],
+            [('card', ('daniel::following',)), ('range', ('daniel::following',))],
+        ])
+
+    def test_friendlydb(self):
+        fdb = FriendlyDB(backend=MemoryBackend(), observer=lambda commands, seconds, results: self.round_trips.append(commands))
+        fdb['daniel'].follow('alice')
+        fdb['daniel'].following()
+        self.assertEqual(len(self.round_trips), 2)
+
+
+class TracerTestCase(unittest2.TestCase):
+    def test_trace(self):
+        tracer = Tracer()
+        fdb = FriendlyDB(backend=MemoryBackend(), observer=tracer.observe)
+        fdb['daniel'].follow('alice')
+
+        with tracer.trace() as trace:
+            fdb['alice'].follow('daniel')
+            fdb['daniel'].friends()
+
+        # Round-trips outside of ``trace`` aren't recorded.
+        fdb['daniel'].following()
+
+        self.assertEqual(len(trace.round_trips), 2)
+        self.assertEqual(trace.command_count(), 3)
+        commands, seconds, sizes = trace.round_trips[1]
+        self.assertEqual([name for name, args in commands], ['intersect_range'])
+        self.assertEqual(sizes, [1])
+
+        lines = trace.format()
+        followed_at = trace.round_trips[0][0][0][1][2]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("add('alice::following', 'daniel', {0!r}) -> 1, add('daniel::followers', 'alice', {0!r}) -> 1".format(followed_at)))
+        self.assertTrue(lines[1].endswith("intersect_range(['daniel::following', 'daniel::followers']) -> 1"))
+
+
+class MetricsTestCase(unittest2.TestCase):
+    def test_histogram(self):
+        histogram = Histogram((1, 10, 100))
+        self.assertEqual(histogram.quantile(0.5), None)
+
+        for value in (2, 4, 6, 8, 50, 500):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.cumulative(), [(1, 0), (10, 4), (100, 5), ('+Inf', 6)])
+        self.assertEqual(histogram.quantile(0.5), 7.75)
+        self.assertAlmostEqual(histogram.quantile(0.8), 82)
+        self.assertEqual(histogram.quantile(0.99), 100)
+        self.assertEqual(histogram.quantile(0), 2)
+
+    def test_requests(self):
+        metrics = Metrics()
+        metrics.start_request()
+        metrics.observe_redis([('add', ()), ('add', ())], 0.002)
+        metrics.observe_redis([('range', ())], 0.001)
+        self.assertEqual(metrics.in_flight, 1)
+        metrics.finish_request('follow', 201, 0.005, 80)
+        # Round-trips outside of a request aren't counted.
+        metrics.observe_redis([('range', ())], 0.001)
+        metrics.start_request()
+        metrics.finish_request('follow', 400, 0.001, 20)
+
+        stats = metrics.as_dict()
+        self.assertEqual(stats['in_flight'], 0)
+        follow = stats['routes']['follow']
+        self.assertEqual(follow['statuses'], {'201': 1, '400': 1})
+        self.assertEqual(follow['latency_seconds']['count'], 2)
+        self.assertEqual(follow['redis_commands']['mean'], 1.5)
+        self.assertAlmostEqual(follow['redis_round_trips']['p99'], 1.98)
+        self.assertAlmostEqual(follow['redis_seconds'], 0.003)
+
+        text = metrics.render_prometheus([{'address': 'localhost:6379', 'db': 0, 'in_use': 1, 'idle': 2}])
+        self.assertTrue('friendlydb_requests_total{route="follow",status="201"} 1\n' in text)
+        self.assertTrue('friendlydb_request_redis_commands_bucket{route="follow",le="3"} 2\n' in text)
+        self.assertTrue('friendlydb_request_duration_seconds_count{route="follow"} 2\n' in text)
+        self.assertTrue('friendlydb_requests_in_flight 0\n' in text)
+        self.assertTrue('friendlydb_redis_connections{address="localhost:6379",db="0",state="idle"} 2\n' in text)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeOS(object):
+    # What ``Arbiter`` needs of ``os``, with exits & signals faked.
+    WNOHANG = os.WNOHANG
+
+    def __init__(self):
+        # ``(pid, status)`` for ``waitpid`` to hand back.
+        self.exited = []
+        self.killed = []
+
+    def waitpid(self, pid, options):
+        if self.exited:
+            return self.exited.pop(0)
+
+        return 0, 0
+
+    def kill(self, pid, signum):
+        self.killed.append((pid, signum))
+
+    def getpid(self):
+        return 1
+
+    def close(self, fd):
+        os.close(fd)
+
+    def read(self, fd, size):
+        return os.read(fd, size)
+
+
+class FakeArbiter(prefork.Arbiter):
+    # "Forks" workers with made up pids, each with a real heartbeat pipe.
+    def __init__(self, *args, **kwargs):
+        super(FakeArbiter, self).__init__(None, *args, **kwargs)
+        self.last_pid = 100
+        self.notify_fds = {}
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        self.last_pid += 1
+        self.workers[self.last_pid] = prefork.Worker(self.last_pid, read_fd, self.generation)
+        self.notify_fds[self.last_pid] = write_fd
+        return self.last_pid
+
+    def notify(self, pid):
+        os.write(self.notify_fds[pid], b'.')
+
+
+class ArbiterTestCase(unittest2.TestCase):
+    def setUp(self):
+        super(ArbiterTestCase, self).setUp()
+        self.old_os, self.old_time = prefork.os, prefork.time
+        prefork.os = self.os = FakeOS()
+        prefork.time = self.clock = FakeClock()
+        self.arbiter = FakeArbiter(workers=2, timeout=30, graceful_timeout=10)
+
+    def tearDown(self):
+        prefork.os, prefork.time = self.old_os, self.old_time
+
+        for worker in self.arbiter.workers.values():
+            os.close(worker.heartbeat_fd)
+
+        for fd in self.arbiter.notify_fds.values():
+            os.close(fd)
+
+        super(ArbiterTestCase, self).tearDown()
+
+    def boot(self):
+        # Every worker checks in.
+        for pid in self.arbiter.workers:
+            self.arbiter.notify(pid)
+
+        self.arbiter.wait(0)
+
+    def die(self, pid, status=256):
+        self.os.exited.append((pid, status))
+        self.arbiter.reap()
+
+    def test_reap(self):
+        self.arbiter.spawn_missing()
+        self.assertEqual(sorted(self.arbiter.workers), [101, 102])
+        self.boot()
+        self.assertTrue(self.arbiter.workers[101].booted)
+
+        # A worker that had booted is replaced right away.
+        with self.assertLogs('friendlydb.server', 'WARNING') as logs:
+            self.die(101)
+
+        self.assertEqual(sorted(self.arbiter.workers), [102])
+        self.assertEqual(logs.output, ['WARNING:friendlydb.server:Worker 101 died unexpectedly (status 256); replacing it.'])
+        self.assertEqual(self.arbiter.spawn_delay, 0)
+        self.arbiter.spawn_missing()
+        self.assertEqual(sorted(self.arbiter.workers), [102, 103])
+
+        # Unknown children & running out of them are fine.
+        self.die(999)
+        self.assertEqual(sorted(self.arbiter.workers), [102, 103])
+
+        def no_children(pid, options):
+            raise OSError(errno.ECHILD, 'No child processes')
+
+        self.os.waitpid = no_children
+        self.arbiter.reap()
+        self.assertEqual(sorted(self.arbiter.workers), [102, 103])
+
+    def test_backoff(self):
+        # Workers that die before checking in are replaced ever more slowly.
+        self.arbiter.spawn_missing()
+        delays = []
+
+        for i in range(9):
+            pid = min(self.arbiter.workers)
+            self.die(pid)
+            delays.append(self.arbiter.spawn_delay)
+            self.assertEqual(self.arbiter.next_spawn, self.clock.now + self.arbiter.spawn_delay)
+
+            # Nothing's started until the delay is up.
+            self.arbiter.spawn_missing()
+            self.assertEqual(len(self.arbiter.workers), 1)
+            self.clock.now += self.arbiter.spawn_delay
+            self.arbiter.spawn_missing()
+            self.assertEqual(len(self.arbiter.workers), 2)
+
+        self.assertEqual(delays, [0.5, 1, 2, 4, 8, 16, 30, 30, 30])
+
+        # A heartbeat resets it.
+        self.boot()
+        self.assertEqual(self.arbiter.spawn_delay, 0)
+        self.die(min(self.arbiter.workers))
+        self.arbiter.spawn_missing()
+        self.assertEqual(len(self.arbiter.workers), 2)
+
+    def test_kill_unresponsive(self):
+        self.arbiter.spawn_missing()
+        self.boot()
+        self.clock.now += 20
+        self.arbiter.notify(102)
+        self.arbiter.wait(0)
+
+        # 101 has been silent for 31 seconds, 102 for 11.
+        self.clock.now += 11
+
+        with self.assertLogs('friendlydb.server', 'WARNING') as logs:
+            self.arbiter.kill_unresponsive()
+
+        self.assertEqual(self.os.killed, [(101, signal.SIGKILL)])
+        self.assertEqual(self.arbiter.workers[101].stopping_since, self.clock.now)
+        self.assertEqual(logs.output, ['WARNING:friendlydb.server:Worker 101 stopped responding; killing it.'])
+
+        # Once it's gone, it's replaced without any backoff.
+        self.die(101)
+        self.assertEqual(self.arbiter.spawn_delay, 0)
+        self.arbiter.spawn_missing()
+        self.assertEqual(sorted(self.arbiter.workers), [102, 103])
+
+    def test_graceful_stop(self):
+        self.arbiter.spawn_missing()
+        self.boot()
+
+        # ``HUP`` starts new workers, then asks the old ones to stop.
+        self.arbiter.queue_signal(signal.SIGHUP, None)
+        self.arbiter.handle_signals()
+        self.assertEqual(sorted(self.arbiter.workers), [101, 102, 103, 104])
+        self.assertEqual(sorted(self.os.killed), [(101, signal.SIGTERM), (102, signal.SIGTERM)])
+
+        # Old workers get ``graceful_timeout`` seconds before being killed &
+        # aren't replaced when they exit.
+        self.clock.now += 5
+        self.arbiter.kill_unresponsive()
+        self.assertEqual(len(self.os.killed), 2)
+        self.clock.now += 6
+        self.arbiter.kill_unresponsive()
+        self.assertEqual(sorted(self.os.killed[2:]), [(101, signal.SIGKILL), (102, signal.SIGKILL)])
+        self.die(101)
+        self.die(102)
+        self.arbiter.spawn_missing()
+        self.assertEqual(sorted(self.arbiter.workers), [103, 104])
+
+        # ``TERM`` stops everything.
+        self.arbiter.queue_signal(signal.SIGTERM, None)
+        self.arbiter.handle_signals()
+        self.assertTrue(self.arbiter.stopping)
+        self.assertEqual(sorted(self.os.killed[4:]), [(103, signal.SIGTERM), (104, signal.SIGTERM)])
+
+
+class FixedRandom(object):
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+class BenchmarkSuiteTestCase(unittest2.TestCase):
+    def test_zipf_sampler(self):
+        # Weights of 1, 1/2 & 1/3.
+        sampler = benchmark_suite.ZipfSampler(3, 1)
+        self.assertAlmostEqual(sampler.total, 1 + 1 / 2.0 + 1 / 3.0)
+        self.assertEqual([sampler.sample(FixedRandom(value)) for value in (0, 0.5, 0.7, 0.99)], [0, 0, 1, 2])
+
+        # Lower ranks come up more often & everything is in range.
+        sampler = benchmark_suite.ZipfSampler(100, 1.1)
+        rand = random.Random(42)
+        counts = [0] * 100
+
+        for i in range(10000):
+            counts[sampler.sample(rand)] += 1
+
+        self.assertEqual(sum(counts), 10000)
+        self.assertTrue(counts[0] > counts[1] > counts[10] > counts[90])
+
+        # An exponent of 0 is uniform.
+        sampler = benchmark_suite.ZipfSampler(4, 0)
+        self.assertEqual([sampler.sample(FixedRandom(value)) for value in (0.1, 0.3, 0.6, 0.9)], [0, 1, 2, 3])
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(benchmark_suite.percentile(ordered, 0.5), 51)
+        self.assertEqual(benchmark_suite.percentile(ordered, 0.95), 96)
+        self.assertEqual(benchmark_suite.percentile(ordered, 0.99), 100)
+        self.assertEqual(benchmark_suite.percentile(ordered, 1), 100)
+        self.assertEqual(benchmark_suite.percentile([7], 0.99), 7)
+        self.assertEqual(benchmark_suite.percentile([], 0.5), None)
+
+    def test_summarize(self):
+        self.assertEqual(benchmark_suite.summarize([0.004, 0.001, 0.003, 0.002], 2), {
+            'ops': 4,
+            'throughput': 2.0,
+            'mean_ms': 2.5,
+            'p50_ms': 3.0,
+            'p95_ms': 4.0,
+            'p99_ms': 4.0,
+            'max_ms': 4.0,
+        })
+        self.assertEqual(benchmark_suite.summarize([], 0), {
+            'ops': 0,
+            'throughput': None,
+            'mean_ms': None,
+            'p50_ms': None,
+            'p95_ms': None,
+            'p99_ms': None,
+            'max_ms': None,
+        })
+
+    def compare(self, results, baseline, tolerance=0.1):
+        old_stdout, sys.stdout = sys.stdout, StringIO()
+
+        try:
+            regressions = benchmark_suite.compare(results, baseline, tolerance)
+            return regressions, sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+
+    def test_compare(self):
+        meta = {'backend': 'memory', 'via': 'library', 'users': 1000, 'zipf': 1.1, 'clients': 4, 'ops': 1000}
+        baseline = {
+            'meta': meta,
+            'scenarios': {
+                'steady': {'throughput': 1000, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+                'slower': {'throughput': 1000, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+                'noisy': {'throughput': 1000, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+                'unmeasured': {'throughput': 0, 'p50_ms': None, 'p95_ms': 2.0, 'p99_ms': 3.0},
+            },
+        }
+        results = {
+            'meta': meta,
+            'scenarios': {
+                # Within the tolerance (& faster is fine).
+                'steady': {'throughput': 950, 'p50_ms': 0.5, 'p95_ms': 2.1, 'p99_ms': 3.0},
+                'slower': {'throughput': 800, 'p50_ms': 1.0, 'p95_ms': 2.5, 'p99_ms': 3.0},
+                # p99 is too noisy to fail on.
+                'noisy': {'throughput': 1000, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 30.0},
+                'unmeasured': {'throughput': 10, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+                'new': {'throughput': 1000, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 3.0},
+            },
+        }
+
+        regressions, output = self.compare(results, baseline)
+        self.assertEqual(sorted(regressions), [('slower', 'p95_ms', 2.0, 2.5), ('slower', 'throughput', 1000, 800)])
+        self.assertTrue('  new: no baseline\n' in output)
+        self.assertTrue('p99_ms 3.0 -> 30.0 (+900.0%) REGRESSED' in output)
+        self.assertTrue('  unmeasured: p95_ms 2.0 -> 2.0 (+0.0%), p99_ms 3.0 -> 3.0 (+0.0%)\n' in output)
+        self.assertFalse('Warning' in output)
+
+        # A looser tolerance lets it through, but a different setup is
+        # pointed out.
+        baseline['meta'] = dict(meta, clients=8)
+        regressions, output = self.compare(results, baseline, tolerance=0.3)
+        self.assertEqual(regressions, [])
+        self.assertTrue('  Warning: the baseline used a different clients (8 vs. 4).\n' in output)
+
+
+class RouterTestCase(unittest2.TestCase):
+    def setUp(self):
+        super(RouterTestCase, self).setUp()
+        self.router = Router(reserved=['_counts'])
+        self.router.add('GET', '/', 'index')
+        self.router.add('GET', '/_counts/', 'counts_many')
+        self.router.add('GET', '/<username>/', 'user_detail')
+        self.router.add('GET', '/<username>/following/', 'user_following')
+        self.router.add('POST', '/<username>/follow/<other_username>/', 'follow')
+        self.router.add('GET', '/<username>/is_following/<other_username>/', 'is_following')
+
+    def test_params(self):
+        self.assertEqual(self.router.match('/'), ({'GET': 'index'}, {}))
+        self.assertEqual(self.router.match('/daniel/'), ({'GET': 'user_detail'}, {'username': 'daniel'}))
+        self.assertEqual(self.router.match('/daniel/follow/alice.b-c_d/'), ({'POST': 'follow'}, {'username': 'daniel', 'other_username': 'alice.b-c_d'}))
+        self.assertEqual(self.router.match('/daniel/is_following/alice/')[1], {'username': 'daniel', 'other_username': 'alice'})
+
+    def test_literals_win(self):
+        self.assertEqual(self.router.match('/_counts/'), ({'GET': 'counts_many'}, {}))
+        self.router.add('GET', '/daniel/', 'daniel_detail')
+        self.assertEqual(self.router.match('/daniel/'), ({'GET': 'daniel_detail'}, {}))
+        # Falls back to the param when the literal doesn't lead anywhere.
+        # ``following`` is a literal after ``<username>``, not another user.
+        self.assertEqual(self.router.match('/daniel/following/'), ({'GET': 'user_following'}, {'username': 'daniel'}))
+
+    def test_trailing_slashes(self):
+        self.assertEqual(self.router.match('/daniel'), self.router.match('/daniel/'))
+        self.assertEqual(self.router.match('/daniel/follow/alice'), self.router.match('/daniel/follow/alice/'))
+        self.assertEqual(self.router.match('/daniel//'), (None, None))
+        self.assertEqual(self.router.match('//daniel/'), (None, None))
+        self.assertEqual(self.router.match('daniel/'), (None, None))
+
+    def test_not_found_vs_not_allowed(self):
+        # Unknown paths don't match at all (a 404)...
+        self.assertEqual(self.router.match('/daniel/nope/'), (None, None))
+        self.assertEqual(self.router.match('/daniel/follow/'), (None, None))
+        self.assertEqual(self.router.match('/daniel/follow/alice/extra/'), (None, None))
+        self.assertEqual(self.router.match('/dan%20iel/'), (None, None))
+        # Reserved names are never taken for a param...
+        self.assertEqual(self.router.match('/_counts/following/'), (None, None))
+        self.assertEqual(self.router.match('/daniel/follow/_counts/'), (None, None))
+        # ...but other names starting with ``_`` are.
+        self.assertEqual(self.router.match('/_daniel/'), ({'GET': 'user_detail'}, {'username': '_daniel'}))
+        self.assertEqual(self.router.match('/daniel/follow/_alice/')[1], {'username': 'daniel', 'other_username': '_alice'})
+        # ...while known paths hand back their handlers, leaving the HTTP
+        # method to be checked (a 405 if it's not there).
+        handlers, params = self.router.match('/daniel/follow/alice/')
+        self.assertFalse('GET' in handlers)
+
+    def test_conflicting_params(self):
+        self.assertRaises(ValueError, self.router.add, 'GET', '/<user>/friends/', 'user_friends')
+
+
+class BatchTestCase(unittest2.TestCase):
+    def setUp(self):
+        super(BatchTestCase, self).setUp()
+        self.fdb = FriendlyDB(backend=MemoryBackend())
+
+    def run_batch(self, ops, max_operations=10):
+        # What the servers do with a ``/_batch/`` body.
+        pipe = self.fdb.backend.pipeline()
+        touched_keys, pending = plan_batch(self.fdb, pipe, parse_batch(json.dumps(ops), max_operations))
+        results = []
+
+        if len(pipe):
+            results = pipe.execute()
+
+        return touched_keys, finish_batch(pending, results)
+
+    def test_mixed(self):
+        self.fdb['alice'].follow('daniel')
+        touched_keys, results = self.run_batch([
+            {'op': 'follow', 'username': 'daniel', 'other_username': 'alice'},
+            {'op': 'follow', 'username': 'daniel', 'other_username': 'bob'},
+            {'op': 'is_following', 'username': 'daniel', 'other_username': 'alice'},
+            {'op': 'is_followed_by', 'username': 'daniel', 'other_username': 'bob'},
+            {'op': 'counts', 'username': 'daniel'},
+            {'op': 'following', 'username': 'daniel', 'limit': 1},
+            {'op': 'unfollow', 'username': 'daniel', 'other_username': 'bob'},
+            {'op': 'followers', 'username': 'bob'},
+        ])
+
+        # In the order they were asked for, each seeing the ones before it.
+        self.assertEqual(results, [
+            {'username': 'daniel', 'other_username': 'alice', 'followed': True},
+            {'username': 'daniel', 'other_username': 'bob', 'followed': True},
+            {'username': 'daniel', 'other_username': 'alice', 'is_following': True},
+            {'username': 'daniel', 'other_username': 'bob', 'is_followed_by': False},
+            {'username': 'daniel', 'counts': {'following': 2, 'followers': 1, 'friends': 1}},
+            {'username': 'daniel', 'following': ['bob']},
+            {'username': 'daniel', 'other_username': 'bob', 'unfollowed': True},
+            {'username': 'bob', 'followers': []},
+        ])
+        self.assertEqual(touched_keys, set(['daniel::following', 'alice::followers', 'bob::followers']))
+        self.assertEqual(self.fdb['daniel'].following(), ['alice'])
+
+    def test_errors(self):
+        # Bad operations get an error of their own, without failing the rest.
+        touched_keys, results = self.run_batch([
+            {'op': 'follow', 'username': 'daniel', 'other_username': 'alice'},
+            {'op': 'delete_everything'},
+            {'op': 'follow', 'username': 'daniel'},
+            'follow',
+            {'op': 'follow', 'username': 'daniel', 'other_username': 'daniel'},
+            {'op': 'following', 'username': 'daniel', 'limit': -1},
+            {'op': 'is_following', 'username': 'daniel', 'other_username': 'alice'},
+            {'op': 'follow', 'username': 'daniel', 'other_username': '_batch'},
+            {'op': 'following', 'username': 'daniel', 'limit': 0},
+            {'op': 'follow', 'username': '_daniel', 'other_username': '_alice'},
+        ])
+
+        self.assertEqual(results[0]['followed'], True)
+        self.assertTrue('error' in results[1] and 'op' in results[1]['error'])
+        self.assertEqual(results[2], {'error': "The 'other_username' parameter is required."})
+        self.assertTrue('error' in results[3])
+        self.assertEqual(results[4]['followed'], False)
+        self.assertEqual(results[5], {'error': "The 'limit' parameter must be at least 1."})
+        self.assertEqual(results[6]['is_following'], True)
+        # The API's own paths (like ``/_batch/``) can't be usernames.
+        self.assertEqual(results[7], {'error': "The 'other_username' parameter can't be '_batch', which the API uses itself."})
+        self.assertEqual(results[8], {'error': "The 'limit' parameter must be at least 1."})
+        self.assertEqual(results[9]['followed'], True)
+
+        # Nothing to run at all is fine, too.
+        self.assertEqual(self.run_batch([{'op': 'nope'}])[1], [{'error': results[1]['error']}])
+        self.assertEqual(self.run_batch([])[1], [])
+
+    def test_malformed_values(self):
+        # Values that aren't numbers fail just their own operation.
+        touched_keys, results = self.run_batch([
+            {'op': 'following', 'username': 'daniel', 'limit': None},
+            {'op': 'followers', 'username': 'daniel', 'offset': [1]},
+            {'op': 'following', 'username': 'daniel', 'since': {'a': 1}},
+            {'op': 'following', 'username': 'daniel', 'until': 'soon'},
+            {'op': 'following', 'username': ['daniel']},
+            {'op': 'follow', 'username': 'daniel', 'other_username': 'alice'},
+        ])
+
+        self.assertEqual(results[:5], [
+            {'error': "The 'limit' parameter must be an integer."},
+            {'error': "The 'offset' parameter must be an integer."},
+            {'error': "The 'since' parameter must be an integer."},
+            {'error': "The 'until' parameter must be an integer."},
+            {'error': "The 'username' parameter is required."},
+        ])
+        self.assertEqual(results[5]['followed'], True)
+
+    def test_malformed(self):
+        self.assertRaises(BadRequest, parse_batch, 'not json', 10)
+        self.assertRaises(BadRequest, parse_batch, '{"op": "follow"}', 10)
+        self.assertRaises(BadRequest, parse_batch, '', 10)
+        self.assertEqual(parse_batch('[]', 10), [])
+
+    def test_max_operations(self):
+        ops = [{'op': 'counts', 'username': 'daniel'}] * 3
+        self.assertEqual(len(self.run_batch(ops, max_operations=3)[1]), 3)
+        self.assertRaises(BadRequest, self.run_batch, ops, max_operations=2)
 
 
 class FriendlyTestCase(unittest2.TestCase):
@@ -23,6 +1098,12 @@ class FriendlyTestCase(unittest2.TestCase):
         super(FriendlyTestCase, self).tearDown()
 
 
+class RedisBackendTestCase(BackendTestMixin, FriendlyTestCase):
+    def setUp(self):
+        super(RedisBackendTestCase, self).setUp()
+        self.backend = RedisBackend(self.conn)
+
+
 class FriendlyUserTestCase(FriendlyTestCase):
     def setUp(self):
         super(FriendlyUserTestCase, self).setUp()
@@ -46,6 +1127,13 @@ class FriendlyUserTestCase(FriendlyTestCase):
         fuser.setup()
         self.assertTrue(fuser.is_setup)
 
+        # Users without a connection share a default one.
+        fuser_1 = FriendlyUser('daniel')
+        fuser_2 = FriendlyUser('alice')
+        fuser_1.setup()
+        fuser_2.setup()
+        self.assertTrue(fuser_1.conn is fuser_2.conn)
+
     def test_follow(self):
         self.assertTrue(self.daniel.follow('alice'))
         self.assertTrue(self.daniel.follow('bob'))
@@ -82,6 +1170,102 @@ class FriendlyUserTestCase(FriendlyTestCase):
         joe_followers = self.joe.followers()
         self.assertEqual(joe_followers, [])
 
+    def test_follow_many(self):
+        self.assertEqual(self.daniel.follow_many(['alice', 'bob', 'daniel']), {
+            'alice': True,
+            'bob': True,
+            'daniel': False,
+        })
+
+        self.assertEqual(sorted(self.daniel.following()), ['alice', 'bob'])
+        self.assertEqual(self.alice.followers(), ['daniel'])
+        self.assertEqual(self.bob.followers(), ['daniel'])
+        self.assertEqual(self.daniel.followers(), [])
+
+    def test_unfollow_many(self):
+        self.daniel.follow_many(['alice', 'bob', 'joe'])
+
+        self.assertEqual(self.daniel.unfollow_many(['alice', 'joe', 'daniel']), {
+            'alice': True,
+            'joe': True,
+            'daniel': False,
+        })
+
+        self.assertEqual(self.daniel.following(), ['bob'])
+        self.assertEqual(self.alice.followers(), [])
+        self.assertEqual(self.bob.followers(), ['daniel'])
+        self.assertEqual(self.joe.followers(), [])
+
+    def test_following_pagination(self):
+        for username, time_score in (('alice', 100), ('bob', 200), ('joe', 300), ('sarah', 400)):
+            self.daniel.current_time_score = lambda: time_score
+            self.daniel.follow(username)
+
+        self.assertEqual(self.daniel.following(limit=2), ['sarah', 'joe'])
+        self.assertEqual(self.daniel.following(offset=2, limit=5), ['bob', 'alice'])
+        self.assertEqual(self.daniel.following(since=200), ['sarah', 'joe', 'bob'])
+        self.assertEqual(self.daniel.following(until=200), ['bob', 'alice'])
+        self.assertEqual(self.daniel.following(since=200, until=300), ['joe', 'bob'])
+        self.assertEqual(self.daniel.following(since=100, limit=1, offset=1), ['joe'])
+        self.assertEqual(self.bob.followers(since=200), ['daniel'])
+        self.assertEqual(self.bob.followers(since=201), [])
+
+        following = self.daniel.following(with_dates=True, limit=1)
+        self.assertEqual(following[0]['username'], 'sarah')
+        self.assertEqual(following[0]['followed_on'], datetime.datetime.fromtimestamp(400))
+
+    def test_following_page(self):
+        # Lots of follows landing in the same second shouldn't trip up the
+        # cursor.
+        for username, time_score in (('alice', 100), ('bob', 200), ('joe', 200), ('sarah', 200), ('jane', 300)):
+            self.daniel.current_time_score = lambda: time_score
+            self.daniel.follow(username)
+            self.alice.follow(username)
+
+        seen = []
+        results, cursor = self.daniel.following_page(limit=2)
+        seen.extend(results)
+
+        while cursor is not None:
+            results, cursor = self.daniel.following_page(limit=2, cursor=cursor)
+            seen.extend(results)
+
+        self.assertEqual(seen, ['jane', 'sarah', 'joe', 'bob', 'alice'])
+
+        results, cursor = self.alice.followers_page(limit=10)
+        self.assertEqual(results, ['daniel'])
+        self.assertEqual(cursor, None)
+
+        results, cursor = self.daniel.following_page(limit=2, until=200)
+        self.assertEqual(results, ['sarah', 'joe'])
+        results, cursor = self.daniel.following_page(limit=2, cursor=cursor, since=150)
+        self.assertEqual(results, ['bob'])
+        self.assertEqual(cursor, None)
+
+        self.assertRaises(ValueError, self.daniel.following_page, cursor='nope')
+
+        self.assertEqual(self.daniel.following(limit=0), [])
+        self.assertEqual(self.daniel.following_page(limit=0), ([], None))
+
+    def test_iter_followers(self):
+        usernames = ['user{0}'.format(i) for i in range(25)]
+        self.daniel.follow_many(usernames)
+
+        for username in usernames:
+            FriendlyUser(username, conn=self.conn).follow('daniel')
+
+        batches = list(self.daniel.iter_follower_batches(batch_size=10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(sorted(sum(batches, [])), sorted(usernames))
+
+        self.assertEqual(list(self.daniel.iter_followers(batch_size=7)), self.daniel.followers())
+        self.assertEqual(list(self.daniel.iter_following(batch_size=25)), self.daniel.following())
+        self.assertEqual(list(self.joe.iter_following()), [])
+
+        following = list(self.daniel.iter_following(batch_size=10, with_dates=True))
+        self.assertEqual(len(following), 25)
+        self.assertTrue(isinstance(following[0]['followed_on'], datetime.datetime))
+
     def test_followed(self):
         self.assertTrue(self.daniel.follow('alice'))
         self.assertTrue(self.daniel.follow('bob'))
@@ -123,6 +1307,34 @@ class FriendlyUserTestCase(FriendlyTestCase):
         self.assertFalse(self.bob.is_followed_by('joe'))
         self.assertFalse(self.joe.is_followed_by('bob'))
 
+    def test_is_following_many(self):
+        self.daniel.follow_many(['alice', 'bob'])
+        self.alice.follow('daniel')
+
+        self.assertEqual(self.daniel.is_following_many(['alice', 'bob', 'joe']), {
+            'alice': True,
+            'bob': True,
+            'joe': False,
+        })
+        self.assertEqual(self.alice.is_following_many(['daniel', 'bob']), {
+            'daniel': True,
+            'bob': False,
+        })
+        self.assertEqual(self.joe.is_following_many([]), {})
+
+    def test_is_followed_by_many(self):
+        self.daniel.follow_many(['alice', 'bob'])
+        self.joe.follow('alice')
+
+        self.assertEqual(self.alice.is_followed_by_many(['daniel', 'joe', 'bob']), {
+            'daniel': True,
+            'joe': True,
+            'bob': False,
+        })
+        self.assertEqual(self.daniel.is_followed_by_many(['alice']), {
+            'alice': False,
+        })
+
     def test_delete(self):
         self.assertTrue(self.daniel.follow('alice'))
         self.assertTrue(self.daniel.follow('bob'))
@@ -147,6 +1359,50 @@ class FriendlyUserTestCase(FriendlyTestCase):
         alice_following = self.alice.following()
         self.assertEqual(alice_following, ['bob'])
 
+    def test_delete_progress(self):
+        usernames = ['user{0}'.format(i) for i in range(5)]
+        self.daniel.follow_many(usernames)
+        self.alice.follow('daniel')
+        progress = []
+
+        self.assertTrue(self.daniel.delete(batch_size=2, callback=progress.append))
+        self.assertEqual(progress, [
+            {'following': 2, 'followers': 0},
+            {'following': 4, 'followers': 0},
+            {'following': 5, 'followers': 0},
+            {'following': 5, 'followers': 1},
+        ])
+
+        for username in usernames:
+            self.assertEqual(FriendlyUser(username, conn=self.conn).followers(), [])
+
+        self.assertEqual(self.alice.following(), [])
+        self.assertEqual(self.conn.keys('daniel::*'), [])
+        self.assertFalse(self.conn.smembers('::tombstones'))
+
+    def test_tombstone(self):
+        self.daniel.follow_many(['alice', 'bob'])
+        self.alice.follow('daniel')
+
+        self.assertTrue(self.daniel.tombstone())
+        self.assertEqual(self.daniel.following(), [])
+        self.assertEqual(self.daniel.followers(), [])
+        self.assertEqual(self.conn.smembers('::tombstones'), set(['daniel']))
+
+        # The other sides stick around until reaped.
+        self.assertEqual(self.alice.followers(), ['daniel'])
+        self.assertEqual(self.alice.following(), ['daniel'])
+
+        # Edges re-created in the meantime are left alone.
+        self.daniel.follow('bob')
+
+        self.assertEqual(self.daniel.reap(), {'following': 2, 'followers': 1})
+        self.assertEqual(self.alice.followers(), [])
+        self.assertEqual(self.alice.following(), [])
+        self.assertEqual(self.bob.followers(), ['daniel'])
+        self.assertEqual(self.daniel.following(), ['bob'])
+        self.assertFalse(self.conn.smembers('::tombstones'))
+
     def test_friends(self):
         self.assertTrue(self.daniel.follow('alice'))
         self.assertTrue(self.daniel.follow('bob'))
@@ -156,9 +1412,106 @@ class FriendlyUserTestCase(FriendlyTestCase):
         self.assertTrue(self.bob.follow('daniel'))
 
         mutual_1 = self.daniel.friends()
-        self.assertEqual(mutual_1, set(['bob', 'alice']))
+        self.assertEqual(mutual_1, ['bob', 'alice'])
         mutual_2 = self.alice.friends()
-        self.assertEqual(mutual_2, set(['daniel']))
+        self.assertEqual(mutual_2, ['daniel'])
+
+        # The temporary key shouldn't stick around.
+        self.assertFalse(self.conn.exists('daniel::friends'))
+
+    def test_friends_pagination(self):
+        for username, time_score in (('alice', 100), ('bob', 200), ('joe', 300)):
+            self.daniel.current_time_score = lambda: time_score
+            self.daniel.follow(username)
+
+        # Friendships get the newer timestamp of the two follows.
+        self.joe.current_time_score = lambda: 50
+        self.joe.follow('daniel')
+        self.alice.current_time_score = lambda: 400
+        self.alice.follow('daniel')
+        self.bob.current_time_score = lambda: 250
+        self.bob.follow('daniel')
+
+        self.assertEqual(self.daniel.friends(), ['alice', 'joe', 'bob'])
+        self.assertEqual(self.daniel.friends(limit=2), ['alice', 'joe'])
+        self.assertEqual(self.daniel.friends(limit=2, offset=2), ['bob'])
+        self.assertEqual(self.daniel.friends(offset=1), ['joe', 'bob'])
+
+    def test_friends_cache(self):
+        self.daniel.follow_many(['alice', 'bob'])
+        self.alice.follow('daniel')
+
+        self.assertEqual(self.daniel.friends(cache_ttl=30), ['alice'])
+        self.assertTrue(self.conn.ttl('daniel::friends') > 0)
+
+        # Served from the cached result until it expires.
+        self.bob.follow('daniel')
+        self.assertEqual(self.daniel.friends(cache_ttl=30), ['alice'])
+        self.assertEqual(self.daniel.friends(), ['bob', 'alice'])
+
+    def test_suggestions(self):
+        sarah = FriendlyUser('sarah', conn=self.conn)
+        self.assertEqual(self.daniel.suggestions(), [])
+
+        self.daniel.follow_many(['alice', 'bob'])
+        self.alice.follow_many(['daniel', 'joe', 'sarah'])
+        self.bob.follow_many(['daniel', 'alice', 'joe'])
+        sarah.follow('joe')
+
+        # Ranked by how many of daniel's follows follow them, leaving out
+        # daniel & who he already follows.
+        self.assertEqual(self.daniel.suggestions(), [
+            {'username': 'joe', 'mutual_count': 2},
+            {'username': 'sarah', 'mutual_count': 1},
+        ])
+        self.assertEqual(self.daniel.suggestions(limit=1), [{'username': 'joe', 'mutual_count': 2}])
+        self.assertEqual(self.alice.suggestions(), [{'username': 'bob', 'mutual_count': 1}])
+        self.assertFalse(self.conn.exists('daniel::suggestions'))
+
+        # Only the most recent follows (newest, then reverse-alphabetical) are
+        # counted.
+        self.assertEqual(self.daniel.suggestions(max_fanout=1), [
+            {'username': 'sarah', 'mutual_count': 1},
+            {'username': 'joe', 'mutual_count': 1},
+        ])
+        self.assertEqual(self.daniel.suggestions(max_following=1), [{'username': 'joe', 'mutual_count': 1}])
+
+    def test_mutual_followers(self):
+        self.daniel.follow_many(['alice', 'bob', 'joe'])
+        self.alice.current_time_score = lambda: 100
+        self.alice.follow('sarah')
+        self.bob.current_time_score = lambda: 200
+        self.bob.follow('sarah')
+        self.joe.follow('daniel')
+
+        self.assertEqual(self.daniel.mutual_followers('sarah'), ['bob', 'alice'])
+        self.assertEqual(self.daniel.mutual_followers('sarah', limit=1, offset=1), ['alice'])
+        self.assertEqual(self.daniel.mutual_followers('nobody'), [])
+        self.assertEqual(self.alice.mutual_followers('sarah'), [])
+        self.assertFalse(self.conn.exists('daniel::mutual_followers'))
+
+    def test_counts(self):
+        self.daniel.follow_many(['alice', 'bob', 'joe'])
+        self.alice.follow_many(['daniel', 'bob'])
+        self.bob.follow('daniel')
+
+        self.assertEqual(self.daniel.following_count(), 3)
+        self.assertEqual(self.daniel.follower_count(), 2)
+        self.assertEqual(self.daniel.friend_count(), 2)
+        self.assertEqual(self.joe.friend_count(), 0)
+        self.assertEqual(self.bob.counts(), {
+            'following': 1,
+            'followers': 2,
+            'friends': 1,
+        })
+        self.assertEqual(self.joe.counts(), {
+            'following': 0,
+            'followers': 1,
+            'friends': 0,
+        })
+
+        # No scratch keys left behind.
+        self.assertFalse(self.conn.keys('*friend_count'))
 
 
 class FriendlyDBTestCase(FriendlyTestCase):
@@ -205,3 +1558,883 @@ class FriendlyDBTestCase(FriendlyTestCase):
         fdb.delete_user('alice')
 
         self.assertEqual(daniel.following(), [])
+
+    def test_change_feed(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, change_feed_length=1000)
+        self.assertEqual(fdb.read_changes(), ([], None))
+
+        fdb['daniel'].follow('alice')
+        fdb['daniel'].follow_many(['bob', 'joe'])
+        fdb['daniel'].unfollow('bob')
+        fdb.delete_user('joe')
+
+        events, checkpoint = fdb.read_changes()
+        self.assertEqual([(event['type'], event['username'], event['other_username']) for event in events], [
+            ('follow', 'daniel', 'alice'),
+            ('follow', 'daniel', 'bob'),
+            ('follow', 'daniel', 'joe'),
+            ('unfollow', 'daniel', 'bob'),
+            ('delete', 'joe', None),
+        ])
+        self.assertEqual(checkpoint, events[-1]['id'])
+        self.assertTrue(abs(events[0]['time'] - time.time()) < 60)
+
+        # Incrementally, from a checkpoint.
+        first, checkpoint = fdb.read_changes(count=2)
+        self.assertEqual(first, events[:2])
+        self.assertEqual(fdb.read_changes(checkpoint), (events[2:], events[-1]['id']))
+        self.assertEqual([batch for batch, batch_checkpoint in fdb.iter_change_batches(batch_size=2)], [events[:2], events[2:4], events[4:]])
+
+        # Writes without the feed on aren't recorded.
+        FriendlyDB(host=self.host, port=self.port, db=self.db)['alice'].follow('daniel')
+        self.assertEqual(fdb.read_changes(events[-1]['id']), ([], events[-1]['id']))
+
+    def test_consume_changes(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, change_feed_length=1000)
+        fdb['daniel'].follow_many(['alice', 'bob', 'joe'])
+        seen = []
+
+        self.assertEqual(fdb.consume_changes('search', seen.append, batch_size=2), 3)
+        self.assertEqual([len(batch) for batch in seen], [2, 1])
+        self.assertEqual(fdb.change_checkpoint('search'), seen[-1][-1]['id'])
+        self.assertEqual(fdb.change_checkpoint('recommendations'), None)
+
+        # Picks up where it left off.
+        fdb['alice'].follow('daniel')
+        self.assertEqual(fdb.consume_changes('search', seen.append), 1)
+        self.assertEqual(seen[-1][0]['username'], 'alice')
+        self.assertEqual(fdb.consume_changes('search', seen.append), 0)
+
+        # A failed batch is handed over again next time.
+        fdb['bob'].follow('daniel')
+
+        def fail(events):
+            raise RuntimeError('Down for maintenance.')
+
+        self.assertRaises(RuntimeError, fdb.consume_changes, 'search', fail)
+        self.assertEqual(fdb.consume_changes('search', seen.append), 1)
+        self.assertEqual(fdb.consume_changes('recommendations', seen.append), 5)
+
+    def test_delete_user_background(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['alice'].follow('daniel')
+
+        self.assertTrue(fdb.delete_user('daniel', background=True))
+        self.assertEqual(fdb['daniel'].following(), [])
+
+        for i in range(100):
+            if not fdb.tombstones():
+                break
+
+            time.sleep(0.05)
+
+        self.assertEqual(fdb.tombstones(), set())
+        self.assertEqual(fdb['alice'].followers(), [])
+        self.assertEqual(fdb['alice'].following(), [])
+        self.assertEqual(fdb['bob'].followers(), [])
+
+    def test_reap_tombstones(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['joe'].follow('alice')
+        fdb['daniel'].tombstone()
+        fdb['joe'].tombstone()
+
+        self.assertEqual(fdb.tombstones(), set(['daniel', 'joe']))
+        self.assertEqual(fdb.reap_tombstones(), 2)
+        self.assertEqual(fdb.tombstones(), set())
+        self.assertEqual(fdb['alice'].followers(), [])
+        self.assertEqual(fdb['bob'].followers(), [])
+
+    def test_cache(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, cache_size=10)
+        daniel = fdb['daniel']
+        daniel.follow('alice')
+
+        self.assertEqual(daniel.following(), ['alice'])
+        self.assertEqual(daniel.following(), ['alice'])
+        self.assertEqual(fdb.cache.stats()['hits'], 1)
+
+        # Writes behind the cache's back aren't seen...
+        self.conn.zrem('daniel::following', 'alice')
+        self.assertEqual(daniel.following(), ['alice'])
+
+        # ...but writes through FriendlyDB invalidate.
+        fdb['daniel'].follow('bob')
+        self.assertEqual(daniel.following(), ['bob'])
+        fdb['joe'].follow('bob')
+        self.assertEqual(fdb['bob'].followers(), ['joe', 'daniel'])
+        fdb.bulk_load([('alice', 'bob', 1)])
+        self.assertEqual(fdb['bob'].followers(), ['joe', 'daniel', 'alice'])
+        fdb.delete_user('joe')
+        self.assertEqual(fdb['bob'].followers(), ['daniel', 'alice'])
+
+    def test_cache_channel(self):
+        fdb_1 = FriendlyDB(host=self.host, port=self.port, db=self.db, cache_size=10, cache_channel='friendly')
+        fdb_2 = FriendlyDB(host=self.host, port=self.port, db=self.db, cache_size=10, cache_channel='friendly')
+        fdb_1['daniel'].follow('alice')
+        self.assertEqual(fdb_2['daniel'].following(), ['alice'])
+
+        fdb_1['daniel'].unfollow('alice')
+
+        for i in range(100):
+            if not fdb_2.cache.stats()['invalidations']:
+                time.sleep(0.01)
+
+        self.assertEqual(fdb_2['daniel'].following(), [])
+
+    def test_intern_ids(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, intern_ids=True)
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['alice'].follow('daniel')
+
+        self.assertEqual(self.conn.hget('::ids', 'daniel'), '1')
+        self.assertEqual(sorted(self.conn.zrange('1::following', 0, -1)), ['2', '3'])
+
+        self.assertEqual(fdb['daniel'].following(), ['bob', 'alice'])
+        self.assertEqual(fdb['daniel'].friends(), ['alice'])
+        self.assertTrue(fdb['alice'].is_followed_by('daniel'))
+        self.assertEqual(fdb['joe'].followers(), [])
+
+        fdb.delete_user('daniel')
+        self.assertEqual(fdb['alice'].following(), [])
+        self.assertEqual(fdb['bob'].followers(), [])
+
+    def test_nodes(self):
+        other = redis.StrictRedis(host=self.host, port=self.port, db=self.db + 1)
+        other.flushdb()
+        self.addCleanup(other.flushdb)
+
+        fdb = FriendlyDB(nodes=[
+            {'host': self.host, 'port': self.port, 'db': self.db},
+            {'host': self.host, 'port': self.port, 'db': self.db + 1},
+        ])
+        usernames = ['user{0}'.format(i) for i in range(20)]
+        fdb['daniel'].follow_many(usernames)
+
+        self.assertTrue(self.conn.dbsize())
+        self.assertTrue(other.dbsize())
+        self.assertEqual(sorted(fdb['daniel'].following()), sorted(usernames))
+        self.assertEqual(fdb['user5'].followers(), ['daniel'])
+
+    def test_replicas(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, replicas=[
+            {'host': self.host, 'port': self.port, 'db': self.db},
+        ], read_your_writes=5)
+        self.assertTrue(isinstance(fdb.backend, ReplicatedBackend))
+
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['alice'].follow('daniel')
+        self.assertEqual(fdb['daniel'].following(), ['bob', 'alice'])
+        self.assertEqual(fdb['daniel'].friends(), ['alice'])
+        self.assertTrue(fdb['bob'].is_followed_by('daniel'))
+
+    def test_connection_pool(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, max_connections=5, socket_keepalive=True)
+        fdb['daniel'].follow('alice')
+        fdb['alice'].following()
+
+        stats = fdb.pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['address'], 'localhost:6379')
+        self.assertEqual(stats[0]['max_connections'], 5)
+        self.assertEqual(stats[0]['created'], 1)
+        self.assertEqual(stats[0]['in_use'], 0)
+
+        # Users share the pool & ``clear`` doesn't replace it.
+        conn = fdb.conn
+        self.assertTrue(fdb['bob'].backend is fdb.backend)
+        fdb.clear()
+        self.assertTrue(fdb.conn is conn)
+
+        # A blocking pool waits for a free connection, then gives up.
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, max_connections=1, pool_timeout=0.1)
+        self.assertEqual(fdb['daniel'].following(), [])
+        self.assertEqual(fdb.pool_stats()[0]['idle'], 1)
+
+        connection = fdb.conn.connection_pool.get_connection('ZRANGE')
+        self.assertEqual(fdb.pool_stats()[0]['in_use'], 1)
+        self.assertRaises(redis.ConnectionError, fdb['daniel'].following)
+        fdb.conn.connection_pool.release(connection)
+        self.assertEqual(fdb['daniel'].following(), [])
+
+    def test_counts_many(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['alice'].follow('daniel')
+
+        self.assertEqual(fdb.counts_many(['daniel', 'alice', 'joe']), {
+            'daniel': {'following': 2, 'followers': 1, 'friends': 1},
+            'alice': {'following': 1, 'followers': 1, 'friends': 1},
+            'joe': {'following': 0, 'followers': 0, 'friends': 0},
+        })
+        self.assertEqual(fdb.counts_many([]), {})
+
+    def test_get_many(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        fdb.bulk_load([('daniel', 'alice', 1), ('daniel', 'bob', 2), ('alice', 'daniel', 3)])
+
+        self.assertEqual(fdb.get_many(['daniel', 'joe', 'daniel']), {
+            'daniel': {
+                'following': ['bob', 'alice'],
+                'followers': ['alice'],
+                'counts': {'following': 2, 'followers': 1, 'friends': 1},
+            },
+            'joe': {
+                'following': [],
+                'followers': [],
+                'counts': {'following': 0, 'followers': 0, 'friends': 0},
+            },
+        })
+        self.assertEqual(fdb.get_many(['daniel', 'bob'], fields=['followers'], limit=1), {
+            'daniel': {'followers': ['alice']},
+            'bob': {'followers': ['daniel']},
+        })
+
+        following = fdb.get_many(['daniel'], fields=['following'], limit=None, with_dates=True)['daniel']['following']
+        self.assertEqual([info['username'] for info in following], ['bob', 'alice'])
+        self.assertEqual(following[0]['followed_on'], datetime.datetime.fromtimestamp(2))
+
+        self.assertEqual(fdb.get_many([]), {})
+        self.assertRaises(ValueError, fdb.get_many, ['daniel'], fields=['password'])
+
+    def test_batched_counts(self):
+        # ``counts_many`` & ``get_many`` don't depend on how many commands
+        # ``_counts`` queues.
+        class ExtraCommandUser(FriendlyUser):
+            def _counts(self, pipe):
+                pipe.exists(self.generate_key(self.username, 'following'))
+                finish = super(ExtraCommandUser, self)._counts(pipe)
+                return lambda results: finish(results[1:])
+
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db, user_klass=ExtraCommandUser)
+        fdb['daniel'].follow_many(['alice', 'bob'])
+        fdb['alice'].follow('daniel')
+
+        self.assertEqual(fdb['daniel'].counts(), {'following': 2, 'followers': 1, 'friends': 1})
+        self.assertEqual(fdb.counts_many(['daniel', 'bob'])['bob'], {'following': 0, 'followers': 1, 'friends': 0})
+        self.assertEqual(fdb.get_many(['alice', 'daniel'], fields=['counts', 'followers'])['daniel'], {
+            'counts': {'following': 2, 'followers': 1, 'friends': 1},
+            'followers': ['alice'],
+        })
+
+    def test_bulk_load(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        progress = []
+
+        def edges():
+            yield ('daniel', 'alice')
+            yield ('daniel', 'bob', 1000)
+            yield ('alice', 'daniel')
+            yield ('bob', 'bob')
+            yield ('bob', 'daniel')
+
+        stats = fdb.bulk_load(edges(), chunk_size=2, callback=progress.append)
+        self.assertEqual(stats['edges'], 4)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(progress[-1]['edges'], 4)
+
+        self.assertEqual(fdb['daniel'].following(), ['alice', 'bob'])
+        self.assertEqual(sorted(fdb['daniel'].followers()), ['alice', 'bob'])
+        self.assertEqual(fdb['bob'].followers(), ['daniel'])
+        self.assertEqual(self.conn.zscore('bob::followers', 'daniel'), 1000)
+
+    def test_bulk_load_workers(self):
+        fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        edges = (('user{0}'.format(i), 'daniel') for i in range(100))
+
+        stats = fdb.bulk_load(edges, chunk_size=7, workers=3)
+        self.assertEqual(stats['edges'], 100)
+        self.assertEqual(len(fdb['daniel'].followers()), 100)
+
+
+def free_port():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+@unittest2.skipIf(gevent is None, "gevent isn't installed.")
+class ServerTestCase(FriendlyTestCase):
+    # Runs the gevent server in its own process (it monkey-patches
+    # everything on import) & talks to it over HTTP.
+    def setUp(self):
+        super(ServerTestCase, self).setUp()
+        self.fdb = FriendlyDB(host=self.host, port=self.port, db=self.db)
+        self.temp_dir = tempfile.mkdtemp()
+        self.start_server()
+
+    def tearDown(self):
+        self.stop_server()
+        shutil.rmtree(self.temp_dir)
+        super(ServerTestCase, self).tearDown()
+
+    def start_server(self, *options):
+        self.server_port = free_port()
+        # The server's log ends up here.
+        self.server_log = tempfile.TemporaryFile(mode='w+', dir=self.temp_dir)
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'friendlydb.server', '-p', str(self.server_port), '--redis_host', self.host, '--redis_port', str(self.port), '--redis_db', str(self.db)] + list(options),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=self.server_log,
+            stderr=self.server_log
+        )
+
+        for i in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.server_port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+    def stop_server(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server_log.seek(0)
+        log = self.server_log.read()
+        self.server_log.close()
+        return log
+
+    def request(self, method, path, body=None, headers=None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server_port, timeout=10)
+
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            return response.status, response.getheader('Transfer-Encoding'), response.read().decode('utf-8')
+        finally:
+            conn.close()
+
+    def test_responses(self):
+        status, encoding, body = self.request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertTrue('version' in json.loads(body))
+
+        status, encoding, body = self.request('POST', '/daniel/follow/alice/')
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)['followed'], True)
+
+        status, encoding, body = self.request('GET', '/daniel/nope/')
+        self.assertEqual(status, 404)
+
+        status, encoding, body = self.request('GET', '/daniel/follow/alice/')
+        self.assertEqual(status, 405)
+
+        status, encoding, body = self.request('GET', '/_daniel/')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['username'], '_daniel')
+
+        status, encoding, body = self.request('GET', '/_batch/following/')
+        self.assertEqual(status, 404)
+
+        ops = [{'op': 'follow', 'username': 'daniel', 'other_username': 'bob'}, {'op': 'counts', 'username': 'daniel'}]
+        status, encoding, body = self.request('POST', '/_batch/', json.dumps(ops))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['results'][1]['counts']['following'], 2)
+
+        status, encoding, body = self.request('POST', '/_batch/', 'nope')
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body), {'error': 'The request body must be JSON.'})
+
+        status, encoding, body = self.request('POST', '/_batch/', json.dumps(ops * 501))
+        self.assertEqual(status, 400)
+
+        status, encoding, body = self.request('GET', '/_stats/')
+        self.assertEqual(status, 200)
+        self.assertTrue('friendlydb_requests_total' in body)
+
+    def test_streamed_list(self):
+        # More followers than fit in a single batch get streamed.
+        self.fdb.bulk_load(('user{0}'.format(i), 'daniel') for i in range(2500))
+        status, encoding, body = self.request('GET', '/daniel/followers/')
+        self.assertEqual(status, 200)
+        self.assertEqual(encoding, 'chunked')
+        followers = json.loads(body)['followers']
+        self.assertEqual(len(followers), 2500)
+        self.assertEqual(sorted(followers), sorted(self.fdb['daniel'].followers()))
+
+        status, encoding, body = self.request('GET', '/daniel/')
+        self.assertEqual(len(json.loads(body)['followers']), 2500)
+
+    def test_sharded(self):
+        nodes = '{0}:{1}/{2},{0}:{1}/{3}'.format(self.host, self.port, self.db, self.db + 1)
+        other_conn = redis.StrictRedis(host=self.host, port=self.port, db=self.db + 1)
+        other_conn.flushdb()
+        self.addCleanup(other_conn.flushdb)
+        backend = FriendlyDB(nodes=parse_nodes(nodes)).backend
+        usernames = ['user{0}'.format(i) for i in range(20)]
+        near = [username for username in usernames if backend.shard_for_key(username) == backend.shard_for_key('daniel')][0]
+        far = [username for username in usernames if backend.shard_for_key(username) != backend.shard_for_key('daniel')][0]
+
+        self.stop_server()
+        self.start_server('--redis_nodes', nodes)
+        self.request('POST', '/daniel/follow/{0}/'.format(near))
+        self.request('POST', '/daniel/follow/{0}/'.format(far))
+        self.request('POST', '/{0}/follow/daniel/'.format(far))
+        self.request('POST', '/{0}/follow/{1}/'.format(far, near))
+
+        # A user's own lists live together, so ``friends`` works...
+        status, encoding, body = self.request('GET', '/daniel/friends/')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['friends'], [far])
+
+        # ...but combining several users' lists only works on a single shard.
+        status, encoding, body = self.request('GET', '/daniel/mutual_followers/{0}/'.format(near))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['mutual_followers'], [far])
+
+        status, encoding, body = self.request('GET', '/daniel/mutual_followers/{0}/'.format(far))
+        self.assertEqual(status, 501)
+        self.assertEqual(json.loads(body), {'error': "Mutual followers aren't supported when sharded (with --redis_nodes)."})
+
+        status, encoding, body = self.request('GET', '/daniel/suggestions/')
+        self.assertEqual(status, 501)
+        self.assertEqual(json.loads(body), {'error': "Suggestions aren't supported when sharded (with --redis_nodes)."})
+
+    def test_slow_requests(self):
+        # Nothing's traced without a threshold...
+        self.request('POST', '/daniel/follow/alice/')
+        self.assertFalse('Slow request' in self.stop_server())
+
+        # ...& with one, slower requests get logged with their Redis calls.
+        self.start_server('--slow_request_threshold=0')
+        self.request('POST', '/daniel/follow/bob/')
+        self.request('GET', '/daniel/')
+        log = self.stop_server()
+        self.assertTrue('Slow request: POST /daniel/follow/bob/ (follow, username daniel) took ' in log)
+        self.assertTrue('with status 201, 2 Redis commands in 1 round-trips' in log)
+        self.assertTrue("add('daniel::following', 'bob', " in log)
+        self.assertTrue('Slow request: GET /daniel/ (user_detail, username daniel) took ' in log)
+        self.assertTrue('with status 200, 2 Redis commands in 2 round-trips' in log)
+        self.assertTrue("range('daniel::followers') -> 0" in log)
+
+        self.start_server('--slow_request_threshold=60')
+        self.request('GET', '/daniel/')
+        self.assertFalse('Slow request' in self.stop_server())
+
+        self.start_server()
+
+    def test_profiling(self):
+        def profiles():
+            return sorted(name for name in os.listdir(self.temp_dir) if name.endswith('.prof'))
+
+        # The header does nothing without a ``--profile_dir``.
+        self.request('GET', '/', headers={'X-FriendlyDB-Profile': '1'})
+        self.stop_server()
+        self.assertEqual(profiles(), [])
+
+        # With one, only requests sent with the header get profiled...
+        self.start_server('--profile_dir', self.temp_dir)
+        self.request('GET', '/daniel/')
+        self.request('GET', '/daniel/', headers={'X-FriendlyDB-Profile': '0'})
+        self.assertEqual(profiles(), [])
+
+        self.request('GET', '/daniel/', headers={'X-FriendlyDB-Profile': '1'})
+        log = self.stop_server()
+        self.assertEqual(len(profiles()), 1)
+        self.assertTrue(profiles()[0].endswith('-user_detail-{0}.prof'.format(self.server.pid)))
+        self.assertTrue('Profiled GET /daniel/ to {0}.'.format(os.path.join(self.temp_dir, profiles()[0])) in log)
+        # (They're regular cProfile dumps.)
+        stats = pstats.Stats(os.path.join(self.temp_dir, profiles()[0]))
+        self.assertTrue(stats.total_calls > 0)
+
+        # ...unless they're sampled with ``--profile_rate``.
+        self.start_server('--profile_dir', self.temp_dir, '--profile_rate=1')
+        self.request('GET', '/')
+        self.request('POST', '/daniel/follow/alice/')
+        self.stop_server()
+        self.assertEqual(len(profiles()), 3)
+        self.assertEqual(len([name for name in profiles() if '-follow-' in name]), 1)
+
+        self.start_server()
+
+    def test_benchmark_client(self):
+        # ``benchmark_suite.py --http`` drives the server with this.
+        client = benchmark_suite.HttpClient('http://127.0.0.1:{0}'.format(self.server_port))
+        client.follow('daniel', 'alice')
+        client.follow('bob', 'daniel')
+        client.is_following('daniel', 'alice')
+        client.counts('daniel')
+        client.friends('daniel')
+        client.following('daniel')
+        self.assertEqual(client.followers_page('daniel'), None)
+        client.unfollow('daniel', 'alice')
+        self.assertEqual(self.fdb['daniel'].following(), [])
+        self.assertEqual(client.request('GET', '/daniel/counts/')['counts'], {'following': 0, 'followers': 1, 'friends': 0})
+        self.assertRaises(RuntimeError, client.request, 'GET', '/daniel/nope/')
+
+
+class BlockingPipeline(object):
+    def __init__(self, pipe, loop):
+        self.pipe = pipe
+        self.loop = loop
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __getattr__(self, name):
+        queue = getattr(self.pipe, name)
+
+        def wrapped(*args, **kwargs):
+            queue(*args, **kwargs)
+            return self
+
+        return wrapped
+
+    def execute(self):
+        return self.loop.run_until_complete(self.pipe.execute())
+
+
+class BlockingBackend(object):
+    # Runs an async backend's operations to completion, so the async backends
+    # can go through ``BackendTestMixin``.
+    def __init__(self, backend, loop):
+        self.backend = backend
+        self.loop = loop
+
+    def pipeline(self, transaction=True):
+        return BlockingPipeline(self.backend.pipeline(transaction=transaction), self.loop)
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def run(*args, **kwargs):
+            return self.loop.run_until_complete(method(*args, **kwargs))
+
+        return run
+
+
+@unittest2.skipIf(asyncio is None, "asyncio isn't available.")
+class AsyncRedisBackendTestCase(BackendTestMixin, FriendlyTestCase):
+    def setUp(self):
+        super(AsyncRedisBackendTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.async_backend = AsyncRedisBackend(AsyncConnectionPool(host=self.host, port=self.port, db=self.db))
+        self.backend = BlockingBackend(self.async_backend, self.loop)
+
+    def tearDown(self):
+        self.async_backend.close()
+        self.loop.close()
+        super(AsyncRedisBackendTestCase, self).tearDown()
+
+    def test_errors(self):
+        self.conn.set('text', 'hi')
+        self.assertRaises(Exception, self.backend.card, 'text')
+
+        pipe = self.backend.pipeline()
+        pipe.add('a', 'x', 1)
+        pipe.card('text')
+        self.assertRaises(Exception, pipe.execute)
+
+        # The connection is still usable.
+        self.assertEqual(self.backend.card('a'), 1)
+
+    def test_observer(self):
+        round_trips = []
+        backend = BlockingBackend(AsyncRedisBackend(self.async_backend.pool, observer=lambda *args: round_trips.append(args)), self.loop)
+        pipe = backend.pipeline()
+        pipe.add('a', 'x', 1)
+        pipe.card('a')
+        self.assertEqual(pipe.execute(), [1, 1])
+        self.assertEqual(backend.score('a', 'x'), 1.0)
+
+        self.assertEqual([(commands, results) for commands, seconds, results in round_trips], [
+            ([('add', ('a', 'x', 1)), ('card', ('a',))], [1, 1]),
+            ([('score', ('a', 'x'))], [1.0]),
+        ])
+
+
+@unittest2.skipIf(asyncio is None, "asyncio isn't available.")
+class AsyncFriendlyDBTestCase(FriendlyTestCase):
+    def setUp(self):
+        super(AsyncFriendlyDBTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super(AsyncFriendlyDBTestCase, self).tearDown()
+
+    def run_api(self, fdb):
+        # Exercises the whole API against the given ``AsyncFriendlyDB``.
+        async def run():
+            daniel = fdb['daniel']
+            self.assertEqual(await daniel.follow_many(['alice', 'bob', 'daniel']), {'alice': True, 'bob': True, 'daniel': False})
+            self.assertTrue(await fdb['alice'].follow('daniel'))
+            self.assertFalse(await daniel.follow('daniel'))
+            self.assertTrue(await daniel.follow('joe'))
+
+            self.assertEqual(sorted(await daniel.following()), ['alice', 'bob', 'joe'])
+            self.assertEqual(await daniel.followers(), ['alice'])
+            self.assertEqual(len(await daniel.following(limit=2)), 2)
+
+            page, cursor = await daniel.following_page(limit=2)
+            rest, cursor = await daniel.following_page(limit=2, cursor=cursor)
+            self.assertEqual(sorted(page + rest), ['alice', 'bob', 'joe'])
+            self.assertEqual(cursor, None)
+            self.assertEqual(sorted([username async for username in daniel.iter_following(batch_size=2)]), ['alice', 'bob', 'joe'])
+
+            self.assertTrue(await daniel.is_following('alice'))
+            self.assertFalse(await daniel.is_followed_by('bob'))
+            self.assertEqual(await daniel.is_following_many(['bob', 'sarah']), {'bob': True, 'sarah': False})
+            self.assertEqual(await daniel.friends(), ['alice'])
+            self.assertEqual(await daniel.friends(cache_ttl=30), ['alice'])
+            self.assertEqual(await daniel.counts(), {'following': 3, 'followers': 1, 'friends': 1})
+            self.assertEqual(await daniel.following_count(), 3)
+            self.assertEqual((await fdb.counts_many(['alice']))['alice'], {'following': 1, 'followers': 1, 'friends': 1})
+            self.assertEqual(await fdb.get_many(['bob'], fields=['followers']), {'bob': {'followers': ['daniel']}})
+            self.assertTrue(await fdb['bob'].follow('sarah'))
+            events, checkpoint = await fdb.read_changes()
+            self.assertEqual([(event['type'], event['other_username']) for event in events][-2:], [('follow', 'joe'), ('follow', 'sarah')])
+            self.assertEqual(await fdb.consume_changes('search', lambda events: None, batch_size=2), len(events))
+            self.assertEqual(await fdb.change_checkpoint('search'), checkpoint)
+            self.assertEqual(await daniel.suggestions(), [{'username': 'sarah', 'mutual_count': 1}])
+            self.assertEqual(await daniel.mutual_followers('sarah'), ['bob'])
+
+            self.assertTrue(await daniel.unfollow('joe'))
+            self.assertEqual(await fdb['joe'].followers(), [])
+
+            await fdb.delete_user('daniel')
+            self.assertEqual(await fdb['alice'].following(), [])
+            self.assertEqual(await fdb['bob'].followers(), [])
+            self.assertEqual(await fdb.tombstones(), set())
+
+        self.loop.run_until_complete(run())
+
+    def test_redis(self):
+        fdb = AsyncFriendlyDB(host=self.host, port=self.port, db=self.db, max_connections=2, change_feed_length=1000)
+        self.run_api(fdb)
+
+        # The data is stored just like ``FriendlyDB`` stores it.
+        self.assertEqual(FriendlyDB(host=self.host, port=self.port, db=self.db)['bob'].followers(), [])
+        self.loop.run_until_complete(fdb['sarah'].follow('alice'))
+        self.assertEqual(FriendlyDB(host=self.host, port=self.port, db=self.db)['alice'].followers(), ['sarah'])
+
+        stats = fdb.pool_stats()[0]
+        self.assertTrue(stats['created'] <= 2)
+        self.assertEqual(stats['in_use'], 0)
+        fdb.close()
+
+    def test_memory(self):
+        self.run_api(AsyncFriendlyDB(backend=AsyncBackend(MemoryBackend()), change_feed_length=1000))
+
+    def test_tombstones_and_changes(self):
+        # The same return types as ``FriendlyDB``.
+        fdb = AsyncFriendlyDB(backend=AsyncBackend(MemoryBackend()), change_feed_length=1000)
+
+        async def run():
+            self.assertEqual(await fdb['daniel'].follow_many(['alice', 'bob']), {'alice': True, 'bob': True})
+            self.assertTrue(await fdb['alice'].follow('daniel'))
+            self.assertTrue(await fdb['daniel'].tombstone())
+            self.assertTrue(await fdb['bob'].tombstone())
+            self.assertEqual(await fdb.tombstones(), set(['daniel', 'bob']))
+            self.assertEqual(await fdb.reap_tombstones(), 2)
+            self.assertEqual(await fdb['alice'].followers(), [])
+            self.assertEqual(await fdb['alice'].following(), [])
+
+            batches = [batch async for batch, checkpoint in fdb.iter_change_batches(batch_size=2)]
+            self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+            events, checkpoint = await fdb.read_changes()
+            self.assertEqual(batches[0] + batches[1] + batches[2], events)
+            self.assertEqual([event['type'] for event in events], ['follow', 'follow', 'follow', 'delete', 'delete'])
+            self.assertEqual(await fdb.read_changes(checkpoint), ([], checkpoint))
+
+        self.loop.run_until_complete(run())
+
+
+@unittest2.skipIf(asyncio is None, "asyncio isn't available.")
+class TaskLocalTestCase(unittest2.TestCase):
+    def test_per_task(self):
+        local = TaskLocal()
+        seen = []
+
+        async def run(name):
+            self.assertFalse(hasattr(local, 'request'))
+            local.request = name
+            await asyncio.sleep(0)
+            seen.append(local.request)
+
+        async def main():
+            await asyncio.gather(run('a'), run('b'))
+
+        loop = asyncio.new_event_loop()
+
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+        self.assertEqual(sorted(seen), ['a', 'b'])
+
+
+@unittest2.skipIf(asyncio is None, "asyncio isn't available.")
+class AioServerTestCase(unittest2.TestCase):
+    # Runs the asyncio server (on an in-memory backend) in a thread & talks
+    # to it over HTTP.
+    def setUp(self):
+        super(AioServerTestCase, self).setUp()
+        self.old_fdb = aio_server.fdb
+        self.old_metrics = aio_server.metrics
+        self.old_stream_batch_size = aio_server.stream_batch_size
+        aio_server.metrics = Metrics(local=TaskLocal())
+        aio_server.fdb = AsyncFriendlyDB(backend=AsyncBackend(ObservedBackend(MemoryBackend(), aio_server.metrics.observe_redis)))
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(aio_server.handle_connection, '127.0.0.1', 0))
+        self.server_port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        aio_server.fdb = self.old_fdb
+        aio_server.metrics = self.old_metrics
+        aio_server.stream_batch_size = self.old_stream_batch_size
+        super(AioServerTestCase, self).tearDown()
+
+    def request(self, method, path, body=None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server_port, timeout=10)
+
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            return response.status, response.getheader('Transfer-Encoding'), response.read().decode('utf-8')
+        finally:
+            conn.close()
+
+    def raw_request(self, data):
+        # Sends the bytes as-is & reads until the server hangs up.
+        conn = socket.create_connection(('127.0.0.1', self.server_port), timeout=10)
+        chunks = []
+
+        try:
+            conn.sendall(data)
+
+            while True:
+                chunk = conn.recv(65536)
+
+                if not chunk:
+                    break
+
+                chunks.append(chunk)
+        finally:
+            conn.close()
+
+        return b''.join(chunks)
+
+    def test_responses(self):
+        status, encoding, body = self.request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertTrue('version' in json.loads(body))
+
+        status, encoding, body = self.request('POST', '/daniel/follow/jos%C3%A9/')
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body), {'username': 'daniel', 'other_username': u'jos\xe9', 'followed': True})
+
+        status, encoding, body = self.request('GET', '/daniel/following/')
+        self.assertEqual(json.loads(body), {'username': 'daniel', 'following': [u'jos\xe9']})
+
+        status, encoding, body = self.request('GET', '/daniel/counts/')
+        self.assertEqual(json.loads(body)['counts'], {'following': 1, 'followers': 0, 'friends': 0})
+
+        status, encoding, body = self.request('GET', '/daniel/nope/')
+        self.assertEqual(status, 404)
+
+        status, encoding, body = self.request('GET', '/daniel/follow/alice/')
+        self.assertEqual(status, 405)
+
+        ops = [{'op': 'follow', 'username': 'daniel', 'other_username': 'bob'}, {'op': 'counts', 'username': 'daniel'}]
+        status, encoding, body = self.request('POST', '/_batch/', json.dumps(ops))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['results'][1]['counts']['following'], 2)
+
+        status, encoding, body = self.request('POST', '/_batch/', 'nope')
+        self.assertEqual(status, 400)
+
+        # Only the API's own paths (like ``/_batch/``) can't be usernames.
+        status, encoding, body = self.request('POST', '/daniel/follow/_alice/')
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)['followed'], True)
+
+        status, encoding, body = self.request('GET', '/_alice/followers/')
+        self.assertEqual(json.loads(body)['followers'], ['daniel'])
+
+        status, encoding, body = self.request('GET', '/_stats/following/')
+        self.assertEqual(status, 404)
+
+    def test_stats(self):
+        self.request('POST', '/daniel/follow/alice/')
+        self.request('POST', '/daniel/follow/bob/')
+        self.request('GET', '/daniel/nope/')
+
+        status, encoding, body = self.request('GET', '/_stats/')
+        self.assertEqual(status, 200)
+        self.assertTrue('friendlydb_requests_total{route="follow",status="201"} 2\n' in body)
+        self.assertTrue('friendlydb_requests_total{route="not_found",status="404"} 1\n' in body)
+        # Each follow was a single round-trip.
+        self.assertTrue('friendlydb_request_redis_round_trips_bucket{route="follow",le="1"} 2\n' in body)
+
+        status, encoding, body = self.request('GET', '/_stats/?format=json')
+        stats = json.loads(body)
+        self.assertEqual(stats['routes']['follow']['statuses'], {'201': 2})
+        self.assertEqual(stats['routes']['stats']['statuses'], {'200': 1})
+        self.assertEqual(stats['in_flight'], 1)
+
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server_port, timeout=10)
+
+        try:
+            for i in range(3):
+                conn.request('POST', '/daniel/follow/user{0}/'.format(i))
+                response = conn.getresponse()
+                self.assertEqual(response.status, 201)
+                response.read()
+        finally:
+            conn.close()
+
+        status, encoding, body = self.request('GET', '/daniel/following/')
+        self.assertEqual(len(json.loads(body)['following']), 3)
+
+    def test_streamed_list(self):
+        aio_server.stream_batch_size = 2
+
+        for i in range(5):
+            self.request('POST', '/user{0}/follow/daniel/'.format(i))
+
+        status, encoding, body = self.request('GET', '/daniel/followers/')
+        self.assertEqual(status, 200)
+        self.assertEqual(encoding, 'chunked')
+        self.assertEqual(sorted(json.loads(body)['followers']), ['user{0}'.format(i) for i in range(5)])
+
+        # HTTP/1.0 clients get the body up to the end of the connection.
+        response = self.raw_request(b'GET /daniel/ HTTP/1.0\r\n\r\n')
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(b'Connection: close' in head)
+        self.assertFalse(b'Transfer-Encoding' in head)
+        self.assertEqual(len(json.loads(body.decode('utf-8'))['followers']), 5)
+
+    def test_limits(self):
+        def status(response):
+            return response.split(b'\r\n', 1)[0]
+
+        def headers(count):
+            return b''.join([b'X-Header-' + str(i).encode('ascii') + b': 1\r\n' for i in range(count)])
+
+        self.assertEqual(status(self.raw_request(b'GET /' + b'a' * 9000 + b'/ HTTP/1.1\r\n\r\n')), b'HTTP/1.1 414 REQUEST-URI TOO LONG')
+        self.assertEqual(status(self.raw_request(b'nope\r\n\r\n')), b'HTTP/1.1 400 BAD REQUEST')
+        self.assertEqual(status(self.raw_request(b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * 9000 + b'\r\n\r\n')), b'HTTP/1.1 431 REQUEST HEADER FIELDS TOO LARGE')
+
+        self.assertEqual(status(self.raw_request(b'GET / HTTP/1.1\r\n' + headers(101) + b'\r\n')), b'HTTP/1.1 431 REQUEST HEADER FIELDS TOO LARGE')
+        # A hundred is fine.
+        self.assertEqual(status(self.raw_request(b'GET / HTTP/1.1\r\nConnection: close\r\n' + headers(99) + b'\r\n')), b'HTTP/1.1 200 OK')
+
+        self.assertEqual(status(self.raw_request(b'POST /_batch/ HTTP/1.1\r\nContent-Length: 2000000\r\n\r\n')), b'HTTP/1.1 413 REQUEST ENTITY TOO LARGE')
+        self.assertEqual(status(self.raw_request(b'POST /_batch/ HTTP/1.1\r\nContent-Length: nope\r\n\r\n')), b'HTTP/1.1 400 BAD REQUEST')
+        self.assertEqual(status(self.raw_request(b'POST /_batch/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n')), b'HTTP/1.1 400 BAD REQUEST')